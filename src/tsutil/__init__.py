@@ -1,3 +1,8 @@
-from .main import main
+def main():
+    # NOTE: GUIを使わないコマンド(tsutil-extract)からwxPythonを読み込まないように遅延importする
+    from .main import main as _main
+
+    _main()
+
 
 __all__ = ['main']
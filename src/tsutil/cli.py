@@ -0,0 +1,352 @@
+import argparse
+import cv2
+import json
+import numpy as np
+import concurrent.futures as futures
+import logging
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+from .extraction import (
+    logger,
+    ExtractionSetting,
+    SETTING_EXTENSION,
+    OUTPUT_FORMATS,
+    MAX_WORKERS,
+    MAX_SEGMENTS,
+    IMAGE_ENCODERS,
+    get_setting_file_path,
+    get_catalog_file_name,
+    extract_video,
+    export_image_catalog,
+    benchmark_image_encoders,
+)
+from .frame_stack import FRAME_STACK_EXTENSION, STACK_COMPRESSIONS, read_image_catalog, read_image
+from .phase_correlation import DEFAULT_REFINE_SIZE, DEFAULT_TRACKING_SIZE, benchmark_phase_correlation
+from .motion_gate import read_motion_scores, detect_motion_ranges
+from .thumbnail_cache import get_cache_dir, get_cache_entries, get_cache_size_limit, clear_thumbnail_cache
+
+# NOTE: wxPythonを読み込まずに動作するコマンドラインツール
+
+# MARK: constants
+
+DEFAULT_JOBS = max(1, (os.cpu_count() or 1) // 4)
+
+
+# MARK: workers
+
+
+def _extract_worker(
+    path: Path,
+    output_dir: Path | None,
+    format: str,
+    scale: float | None,
+    threads: int,
+    segments: int,
+    compression: str | None,
+    stack: bool,
+    direct: bool,
+    frame_range: tuple[int, int] | None,
+):
+    setting = ExtractionSetting.load(get_setting_file_path(path))
+    output_path = (output_dir or path.parent) / get_catalog_file_name(path, format)
+    if stack:
+        output_path = output_path.with_suffix(FRAME_STACK_EXTENSION)
+    start_time = time.time()
+    frame_ranges = None
+    if setting.motion_gate:
+        # 動画を小さくデコードして、動きのある範囲だけを展開する
+        scores = read_motion_scores(path, setting.make_crop(), setting.make_filter_complex())
+        frame_ranges = detect_motion_ranges(
+            scores, setting.motion_threshold, setting.motion_pre_roll, setting.motion_post_roll, frame_range
+        )
+        logger.info(f'{path}: {len(frame_ranges)} motion ranges, {sum(e - b for b, e in frame_ranges)} frames')
+    count = extract_video(
+        path,
+        output_path,
+        setting.rotation,
+        setting.make_filter_complex(),
+        format,
+        scale,
+        threads,
+        segments,
+        compression,
+        direct,
+        frame_range,
+        setting.make_crop(),
+        setting.frame_step,
+        frame_ranges,
+    )
+    return output_path, count, time.time() - start_time
+
+
+# MARK: commands
+
+
+def extract_main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog='tsutil-extract',
+        description='動画ファイルを連続画像とカタログファイルに展開します。'
+        f'展開時の設定は動画ファイルと同名の{SETTING_EXTENSION}ファイルから読み込みます。',
+    )
+    parser.add_argument('videos', nargs='+', type=Path, help='連続画像に展開する動画ファイル')
+    parser.add_argument(
+        '-o', '--output-dir', type=Path, default=None, help='カタログファイルの保存先 (省略時は動画ファイルと同じ場所)'
+    )
+    parser.add_argument(
+        '-f', '--format', choices=OUTPUT_FORMATS, default='PNG', help='画像形式 (PNG: 24bit, TIFF: 48bit)'
+    )
+    parser.add_argument(
+        '-c',
+        '--compression',
+        choices=sorted({j for i in IMAGE_ENCODERS.values() for j in i} | STACK_COMPRESSIONS.keys()),
+        default=None,
+        help='圧縮方式 (PNG: default, store, best / TIFF: lzw, none, deflate / --stack: none, zlib)',
+    )
+    parser.add_argument(
+        '--stack',
+        action='store_true',
+        help=f'連続画像を1つのフレームスタック({FRAME_STACK_EXTENSION})ファイルにまとめて保存する',
+    )
+    parser.add_argument(
+        '--direct',
+        action='store_true',
+        help='回転・縮小・画像の書き出しをffmpegで直接行う (--stackとは併用できません)',
+    )
+    parser.add_argument('--half', action='store_true', help='画像の横幅・縦幅を1/2に縮小する')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=DEFAULT_JOBS, help=f'同時に展開する動画の数 (default: {DEFAULT_JOBS})'
+    )
+    parser.add_argument(
+        '-t',
+        '--threads',
+        type=int,
+        default=MAX_WORKERS,
+        help=f'動画1本あたりの画像保存スレッド数 (default: {MAX_WORKERS})',
+    )
+    parser.add_argument(
+        '-s',
+        '--segments',
+        type=int,
+        default=1,
+        help=f'動画をキーフレーム位置で分割して並行してデコードする数 (max: {MAX_SEGMENTS}, default: 1)',
+    )
+    parser.add_argument(
+        '-r',
+        '--range',
+        type=int,
+        nargs=2,
+        metavar=('START', 'END'),
+        default=None,
+        help='展開するフレームの範囲 (0から始まるフレーム番号、ENDは含まない。画像の番号は元の動画の番号になります)',
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s')
+    logger.setLevel(logging.DEBUG if os.environ.get('DEBUG') else logging.INFO)
+
+    compressions = STACK_COMPRESSIONS if args.stack else IMAGE_ENCODERS[args.format]
+    if args.compression and args.compression not in compressions:
+        parser.error(f'{args.format}では圧縮方式{args.compression}を使用できません。')
+    if args.direct and args.stack:
+        parser.error('--directと--stackは併用できません。')
+    if args.range and not 0 <= args.range[0] < args.range[1]:
+        parser.error('--rangeにはSTART < ENDの範囲を指定してください。')
+    if not shutil.which('ffmpeg'):
+        logger.error('ffmpegが見つかりません。インストールしてください。')
+        sys.exit(1)
+    videos = [i for i in args.videos if i.exists()]
+    for i in set(args.videos) - set(videos):
+        logger.error(f'File not found: {i}')
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    failures = len(args.videos) - len(videos)
+    scale = 1 / 2 if args.half else None
+    with futures.ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        future_to_path = {
+            executor.submit(
+                _extract_worker,
+                path,
+                args.output_dir,
+                args.format,
+                scale,
+                max(1, args.threads),
+                max(1, args.segments),
+                args.compression,
+                args.stack,
+                args.direct,
+                tuple(args.range) if args.range else None,
+            ): path
+            for path in videos
+        }
+        for future in futures.as_completed(future_to_path):
+            path = future_to_path[future]
+            try:
+                output_path, count, elapsed = future.result()
+                logger.info(f'{path}: {count} frames -> {output_path} ({elapsed:.1f}s)')
+            except Exception as e:
+                failures += 1
+                logger.error(f'{path}: {e}')
+    sys.exit(1 if failures else 0)
+
+
+def stack_export_main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog='tsutil-stack-export',
+        description='フレームスタックをTrainScannerで読み込める連続画像とカタログファイルに書き出します。',
+    )
+    parser.add_argument('stacks', nargs='+', type=Path, help=f'フレームスタック({FRAME_STACK_EXTENSION})ファイル')
+    parser.add_argument(
+        '-o', '--output-dir', type=Path, default=None, help='カタログファイルの保存先 (省略時は元のファイルと同じ場所)'
+    )
+    parser.add_argument(
+        '-c',
+        '--compression',
+        choices=sorted({j for i in IMAGE_ENCODERS.values() for j in i}),
+        default=None,
+        help='圧縮方式 (PNG: default, store, best / TIFF: lzw, none, deflate)',
+    )
+    parser.add_argument(
+        '-t',
+        '--threads',
+        type=int,
+        default=MAX_WORKERS,
+        help=f'画像保存スレッド数 (default: {MAX_WORKERS})',
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s')
+    logger.setLevel(logging.DEBUG if os.environ.get('DEBUG') else logging.INFO)
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    failures = 0
+    for path in args.stacks:
+        output_path = (args.output_dir or path.parent) / path.with_suffix('.txt').name
+        try:
+            start_time = time.time()
+            count = export_image_catalog(path, output_path, args.compression, max(1, args.threads))
+            logger.info(f'{path}: {count} frames -> {output_path} ({time.time() - start_time:.1f}s)')
+        except Exception as e:
+            failures += 1
+            logger.error(f'{path}: {e}')
+    sys.exit(1 if failures else 0)
+
+
+def benchmark_main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog='tsutil-benchmark-encoders',
+        description='サンプル画像を各圧縮方式で書き込み、1フレームあたりの書き込み時間とファイルサイズを比較します。',
+    )
+    parser.add_argument('image', type=Path, help='サンプル画像 (16bitの画像はTIFFの圧縮方式で比較します)')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='書き込みの繰り返し回数 (default: 5)')
+    args = parser.parse_args(argv)
+
+    frame = cv2.imread(str(args.image), cv2.IMREAD_UNCHANGED)
+    if frame is None:
+        parser.error(f'画像を読み込めません: {args.image}')
+    format = 'TIFF' if frame.dtype == np.uint16 else 'PNG'
+    results = benchmark_image_encoders(frame, format, max(1, args.repeat))
+    base_time = results[0][1]
+    print(f'{format} {frame.shape[1]}x{frame.shape[0]}')
+    for name, elapsed, size in results:
+        label = IMAGE_ENCODERS[format][name].label
+        print(f'{name:8s} {label:16s} {elapsed * 1000:8.1f} ms {size / 1024 / 1024:8.2f} MB x{base_time / elapsed:.2f}')
+
+
+def benchmark_deshaking_main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog='tsutil-benchmark-deshaking',
+        description='連続画像のブレ測定枠のずれを1フレームずつ求める場合とまとめて求める場合の速度を比較します。'
+        'ブレ測定枠と基準画像はカタログファイルと同名の.correct.jsonファイルから読み込みます。',
+    )
+    parser.add_argument('catalog', type=Path, help='連続画像のカタログファイル、またはフレームスタック')
+    parser.add_argument('-n', '--frames', type=int, default=100, help='比較に使うフレーム数 (default: 100)')
+    parser.add_argument('-k', '--batch-size', type=int, default=16, help='まとめて求めるフレーム数 (default: 16)')
+    parser.add_argument(
+        '-p', '--pyramid-levels', type=int, default=None, help='ピラミッド探索の段数 (省略時は設定ファイルの値)'
+    )
+    parser.add_argument(
+        '--refine-size', type=int, default=None, help='ピラミッド探索の窓の大きさ (省略時は設定ファイルの値)'
+    )
+    parser.add_argument(
+        '-t',
+        '--tracking-size',
+        type=int,
+        default=None,
+        help='まとめて求める場合に追跡する窓の大きさ (0は追跡しない。省略時は設定ファイルの値)',
+    )
+    args = parser.parse_args(argv)
+
+    setting_path = args.catalog.with_suffix('.correct.json')
+    if not setting_path.exists():
+        parser.error(f'設定ファイルが見つかりません: {setting_path}')
+    with open(setting_path, 'r') as f:
+        setting = json.load(f)
+    # 補正画面(wxPython)のモデルを使わずに、デフォルトのブレ測定枠パターンだけを読み込む
+    fields = [
+        (i['left'], i['top'], i['right'], i['bottom'])
+        for i in setting.get('shaking_detection_fields', [])
+        if None not in (i.get('left'), i.get('top'), i.get('right'), i.get('bottom'))
+    ]
+    if not fields:
+        parser.error(f'ブレ測定枠が設定されていません: {setting_path}')
+    entries = read_image_catalog(args.catalog)
+    base_image = read_image(entries[setting.get('base_frame_pos') or 0])
+    samples = [read_image(i) for i in entries[: max(1, args.frames)]]
+    if base_image is None or any(i is None for i in samples):
+        parser.error(f'画像を読み込めません: {args.catalog}')
+    pyramid_levels = setting.get('pyramid_levels', 0) if args.pyramid_levels is None else args.pyramid_levels
+    refine_size = (
+        setting.get('pyramid_refine_size', DEFAULT_REFINE_SIZE) if args.refine_size is None else args.refine_size
+    )
+    tracking_size = (
+        (setting.get('tracking_size', DEFAULT_TRACKING_SIZE) if setting.get('use_tracking') else 0)
+        if args.tracking_size is None
+        else args.tracking_size
+    )
+    try:
+        single_fps, batch_fps, diff = benchmark_phase_correlation(
+            base_image,
+            samples,
+            fields,
+            max(1, args.batch_size),
+            max(0, pyramid_levels),
+            max(1, refine_size),
+            max(0, tracking_size),
+        )
+    except RuntimeError as e:
+        logger.error(f'まとめて求めたずれが1フレームずつ求めたずれと一致しません: {e}')
+        sys.exit(1)
+    print(f'{len(samples)} frames, {len(fields)} fields, {base_image.shape[1]}x{base_image.shape[0]}')
+    if pyramid_levels > 0:
+        print(f'pyramid  {pyramid_levels} levels, refine {refine_size}px')
+    if tracking_size > 0:
+        print(f'tracking {tracking_size}px')
+    print(f'single   {single_fps:8.1f} fps')
+    print(f'batch    {batch_fps:8.1f} fps x{batch_fps / single_fps:.2f} (K={max(1, args.batch_size)})')
+    print(f'max diff {diff:8.4f} px')
+
+
+def cache_main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog='tsutil-cache',
+        description='動画・連続画像のサムネイルのキャッシュの使用量を表示、または削除します。',
+    )
+    parser.add_argument('--clear', action='store_true', help='全てのキャッシュを削除する')
+    args = parser.parse_args(argv)
+
+    if args.clear:
+        print(f'{clear_thumbnail_cache()} entries removed: {get_cache_dir()}')
+        return
+    entries = get_cache_entries()
+    total = sum(size for _, size in entries)
+    print(f'{get_cache_dir()}')
+    print(f'{len(entries)} entries, {total / 1024 / 1024:.1f} MB / {get_cache_size_limit() / 1024 / 1024:.0f} MB')
+
+
+if __name__ == '__main__':
+    extract_main()
@@ -0,0 +1,246 @@
+import math
+import numpy as np
+from numba import njit, prange
+
+# NOTE: extractorのプレビュー用に、ffmpegのeq, colortemperature, huesaturationフィルターを移植したもの
+# (ffmpegのlibavfilter/vf_eq.c, vf_colortemperature.c, vf_huesaturation.cの8bit処理に合わせている)
+# eqはYUV(limited range)で、colortemperatureとhuesaturationはRGBで処理される。
+# YUVとRGBの変換は、ffmpegと同様にストリームの色空間(不明な場合はBT.601)で行う。
+# 入力動画のクロマサブサンプリングを再現しないため、ffmpegの出力とは数階調の誤差がある。
+
+# MARK: constants
+
+# (Kr, Kb)
+COLOR_MATRICES = {
+    'bt601': (0.299, 0.114),
+    'bt709': (0.2126, 0.0722),
+    'bt2020': (0.2627, 0.0593),
+}
+HUESATURATION_WEIGHTS = (0.333, 0.334, 0.333)  # rw, gw, bw (ffmpegのデフォルト値)
+
+# MARK: kernels
+
+
+@njit(parallel=True, cache=True)
+def _apply_filters(src, dst, kr, kb, eq_lut_y, eq_lut_c, ct_color, ct_mix, ct_pl, hs_matrix):
+    kg = 1.0 - kr - kb
+    use_eq = eq_lut_y.shape[0] > 0
+    use_ct = ct_color.shape[0] > 0
+    use_hs = hs_matrix.shape[0] > 0
+    for i in prange(src.shape[0]):
+        for j in range(src.shape[1]):
+            r = np.int64(src[i, j, 0])
+            g = np.int64(src[i, j, 1])
+            b = np.int64(src[i, j, 2])
+
+            # eq (YUV)
+            if use_eq:
+                fr, fg, fb = r / 255.0, g / 255.0, b / 255.0
+                y = kr * fr + kg * fg + kb * fb
+                cb = (fb - y) / (2.0 * (1.0 - kb))
+                cr = (fr - y) / (2.0 * (1.0 - kr))
+                iy = min(max(int(16.0 + 219.0 * y + 0.5), 0), 255)
+                icb = min(max(int(128.0 + 224.0 * cb + 0.5), 0), 255)
+                icr = min(max(int(128.0 + 224.0 * cr + 0.5), 0), 255)
+                y = (eq_lut_y[iy] - 16.0) / 219.0
+                cb = (eq_lut_c[icb] - 128.0) / 224.0
+                cr = (eq_lut_c[icr] - 128.0) / 224.0
+                fr = y + 2.0 * (1.0 - kr) * cr
+                fb = y + 2.0 * (1.0 - kb) * cb
+                fg = (y - kr * fr - kb * fb) / kg
+                r = min(max(int(fr * 255.0 + 0.5), 0), 255)
+                g = min(max(int(fg * 255.0 + 0.5), 0), 255)
+                b = min(max(int(fb * 255.0 + 0.5), 0), 255)
+
+            # colortemperature (RGB)
+            if use_ct:
+                fr, fg, fb = np.float32(r / 255.0), np.float32(g / 255.0), np.float32(b / 255.0)
+                nr = fr * ct_color[0]
+                ng = fg * ct_color[1]
+                nb = fb * ct_color[2]
+                nr = fr + (nr - fr) * ct_mix
+                ng = fg + (ng - fg) * ct_mix
+                nb = fb + (nb - fb) * ct_mix
+                l0 = max(fr, fg, fb) + min(fr, fg, fb) + np.float32(1.1920929e-07)
+                l1 = max(nr, ng, nb) + min(nr, ng, nb) + np.float32(1.1920929e-07)
+                lum = l0 / l1
+                nr = nr + (nr * lum - nr) * ct_pl
+                ng = ng + (ng * lum - ng) * ct_pl
+                nb = nb + (nb * lum - nb) * ct_pl
+                r = min(max(int(nr * 255.0), 0), 255)
+                g = min(max(int(ng * 255.0), 0), 255)
+                b = min(max(int(nb * 255.0), 0), 255)
+
+            # huesaturation (RGB, 16bit固定小数点)
+            if use_hs:
+                nr = (r * hs_matrix[0, 0] + g * hs_matrix[1, 0] + b * hs_matrix[2, 0]) >> 16
+                ng = (r * hs_matrix[0, 1] + g * hs_matrix[1, 1] + b * hs_matrix[2, 1]) >> 16
+                nb = (r * hs_matrix[0, 2] + g * hs_matrix[1, 2] + b * hs_matrix[2, 2]) >> 16
+                # 色の鮮やかさ(最大・最小の成分と中間の成分の差)の割合で元の色と混ぜる (strength=1, colors=all)
+                f = max(r - max(g, b), min(r, g) - b, g - max(r, b), min(g, b) - r, b - max(r, g), min(r, b) - g, 0)
+                nr = r + ((((nr - r) * f + 128) * 257) >> 16)
+                ng = g + ((((ng - g) * f + 128) * 257) >> 16)
+                nb = b + ((((nb - b) * f + 128) * 257) >> 16)
+                r = min(max(nr, 0), 255)
+                g = min(max(ng, 0), 255)
+                b = min(max(nb, 0), 255)
+
+            dst[i, j, 0] = r
+            dst[i, j, 1] = g
+            dst[i, j, 2] = b
+
+
+# MARK: eq
+
+
+def _c_div(a: int, b: int) -> int:
+    # C言語の整数除算(0方向への切り捨て)
+    q = abs(a) // abs(b)
+    return q if (a >= 0) == (b >= 0) else -q
+
+
+def _make_eq_lut(contrast: float, brightness: float, gamma: float, gamma_weight: float = 1.0) -> np.ndarray:
+    lut = np.arange(256, dtype=np.int64)
+    if contrast == 1.0 and brightness == 0.0 and gamma == 1.0:
+        return lut
+    if gamma == 1.0 and abs(contrast) < 7.9:
+        # vf_eq.c: process_c()
+        c = int(contrast * 256 * 16)
+        br = _c_div(int(100.0 * brightness + 100.0) * 511, 200) - 128 - _c_div(c, 32)
+        return np.clip(((lut * c) >> 12) + br, 0, 255)
+    # vf_eq.c: create_lut()
+    g = 1.0 / gamma
+    lw = 1.0 - gamma_weight
+    for i in range(256):
+        v = contrast * (i / 255.0 - 0.5) + 0.5 + brightness
+        if v <= 0.0:
+            lut[i] = 0
+        else:
+            v = v * lw + math.pow(v, g) * gamma_weight
+            lut[i] = 255 if v >= 1.0 else int(256.0 * v)
+    return lut
+
+
+# MARK: colortemperature
+
+
+def _kelvin_to_rgb(temperature: float) -> np.ndarray:
+    def _saturate(x):
+        return min(max(x, 0.0), 1.0)
+
+    kelvin = temperature / 100.0
+    if kelvin <= 66.0:
+        r = 1.0
+        g = _saturate(0.39008157876901960784 * math.log(kelvin) - 0.63184144378862745098)
+    else:
+        t = max(kelvin - 60.0, 0.0)
+        r = _saturate(1.29293618606274509804 * math.pow(t, -0.1332047592))
+        g = _saturate(1.12989086089529411765 * math.pow(t, -0.0755148492))
+    if kelvin >= 66.0:
+        b = 1.0
+    elif kelvin <= 19.0:
+        b = 0.0
+    else:
+        b = _saturate(0.54320678911019607843 * math.log(kelvin - 10.0) - 1.19625408914)
+    return np.array([r, g, b], dtype=np.float32)
+
+
+# MARK: huesaturation
+
+
+def _make_huesaturation_matrix(hue: float, saturation: float, intensity: float) -> np.ndarray:
+    rlw, glw, blw = HUESATURATION_WEIGHTS
+
+    def _multiply(matrix, m):
+        # vf_huesaturation.c: matrix_multiply(matrix, m, matrix)
+        return matrix @ m
+
+    def _rotate_x(matrix, rs, rc):
+        return _multiply(matrix, np.array([[1, 0, 0, 0], [0, rc, rs, 0], [0, -rs, rc, 0], [0, 0, 0, 1]]))
+
+    def _rotate_y(matrix, rs, rc):
+        return _multiply(matrix, np.array([[rc, 0, -rs, 0], [0, 1, 0, 0], [rs, 0, rc, 0], [0, 0, 0, 1]]))
+
+    def _rotate_z(matrix, rs, rc):
+        return _multiply(matrix, np.array([[rc, rs, 0, 0], [-rs, rc, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]]))
+
+    def _shear_z(matrix, dx, dy):
+        return _multiply(matrix, np.array([[1, 0, dx, 0], [0, 1, dy, 0], [0, 0, 1, 0], [0, 0, 0, 1]]))
+
+    matrix = np.eye(4)
+    i = 1.0 + intensity
+    matrix = _multiply(matrix, np.diag([i, i, i, 1.0]))
+
+    s = 1.0 + saturation
+    t = 1.0 - s
+    matrix = _multiply(
+        matrix,
+        np.array(
+            [
+                [t * rlw + s, t * rlw, t * rlw, 0],
+                [t * glw, t * glw + s, t * glw, 0],
+                [t * blw, t * blw, t * blw + s, 0],
+                [0, 0, 0, 1],
+            ]
+        ),
+    )
+
+    xrs = xrc = 1.0 / math.sqrt(2.0)
+    matrix = _rotate_x(matrix, xrs, xrc)
+    yrs = -1.0 / math.sqrt(3.0)
+    yrc = math.sqrt(2.0) / math.sqrt(3.0)
+    matrix = _rotate_y(matrix, yrs, yrc)
+    lx, ly, lz = np.array([rlw, glw, blw, 1.0]) @ matrix[:, :3]
+    zsx, zsy = lx / lz, ly / lz
+    matrix = _shear_z(matrix, zsx, zsy)
+    a = math.radians(hue)
+    matrix = _rotate_z(matrix, math.sin(a), math.cos(a))
+    matrix = _shear_z(matrix, -zsx, -zsy)
+    matrix = _rotate_y(matrix, -yrs, yrc)
+    matrix = _rotate_x(matrix, -xrs, xrc)
+    return np.rint(matrix[:3, :3] * 65536.0).astype(np.int64)
+
+
+# MARK: functions
+
+
+def get_color_matrix_name(color_space: str | None) -> str:
+    # ffmpeg(swscale)と同様に、ストリームの色空間(ffprobeのcolor_space)でRGBに変換する
+    # (色空間が不明な場合は、動画の大きさにかかわらずBT.601とみなす)
+    if color_space == 'bt709':
+        return 'bt709'
+    if color_space in ('bt2020nc', 'bt2020c'):
+        return 'bt2020'
+    return 'bt601'
+
+
+def apply_filter_complex(frame: np.ndarray, filter_complex: dict | None, color_matrix: str = 'bt709') -> np.ndarray:
+    # ExtractionSetting.make_filter_complex()が生成するフィルターをrgb24のフレームに適用する
+    if not filter_complex:
+        return frame
+    empty_lut = np.zeros(0, dtype=np.int64)
+    eq_lut_y = eq_lut_c = empty_lut
+    ct_color = np.zeros(0, dtype=np.float32)
+    ct_mix = ct_pl = np.float32(0.0)
+    hs_matrix = np.zeros((0, 0), dtype=np.int64)
+    for name, params in filter_complex.items():
+        if name == 'eq':
+            lut_y = _make_eq_lut(params.get('contrast', 1.0), params.get('brightness', 0.0), params.get('gamma', 1.0))
+            lut_c = _make_eq_lut(params.get('saturation', 1.0), 0.0, 1.0)
+            # 無調整の場合はffmpegと同様に何もしない (YUVとの変換誤差を避ける)
+            if not (np.array_equal(lut_y, np.arange(256)) and np.array_equal(lut_c, np.arange(256))):
+                eq_lut_y, eq_lut_c = lut_y, lut_c
+        elif name == 'colortemperature':
+            ct_color = _kelvin_to_rgb(params.get('temperature', 6500))
+            ct_mix = np.float32(params.get('mix', 1.0))
+            ct_pl = np.float32(params.get('pl', 0.0))
+        elif name == 'huesaturation':
+            hs_matrix = _make_huesaturation_matrix(
+                params.get('hue', 0.0), params.get('saturation', 0.0), params.get('intensity', 0.0)
+            )
+        else:
+            raise ValueError(f'unsupported filter: {name}')
+    kr, kb = COLOR_MATRICES[color_matrix]
+    dst = np.empty_like(frame)
+    _apply_filters(np.ascontiguousarray(frame), dst, kr, kb, eq_lut_y, eq_lut_c, ct_color, ct_mix, ct_pl, hs_matrix)
+    return dst
@@ -8,6 +8,7 @@ import sys
 import re
 import wx
 from dotenv import load_dotenv
+from .phase_correlation import DEFAULT_REFINE_SIZE, DEFAULT_TRACKING_MIN_RESPONSE, DEFAULT_TRACKING_SIZE
 
 load_dotenv()
 
@@ -18,6 +19,13 @@ MOVIE_FILE_SUFFIX = ['.mp4', '.mov', '.m4v']
 MOVIE_FILE_WILDCARD = '動画ファイル (*.mp4;*.mov;*.m4v)|*.mp4;*.mov;*.m4v'
 IMAGE_CATALOG_FILE_SUFFIX = ['.txt', '.lst']
 IMAGE_CATALOG_FILE_WILDCARD = '連続画像のカタログファイル (*.txt;*.lst)|*.txt;*.lst'
+FRAME_STACK_FILE_WILDCARD = 'フレームスタック (*.stack)|*.stack'
+IMAGE_SOURCE_FILE_WILDCARD = (
+    '連続画像のカタログファイル・フレームスタック (*.txt;*.lst;*.stack)|*.txt;*.lst;*.stack|'
+    + IMAGE_CATALOG_FILE_WILDCARD
+    + '|'
+    + FRAME_STACK_FILE_WILDCARD
+)
 IMAGE_FILE_WILDCARD = '画像ファイル (*.png;*.jpg)|*.png;*.jpg'
 GIF_FILE_WILDCARD = 'GIFファイル (*.gif)|*.gif'
 
@@ -321,6 +329,11 @@ class CorrectionDataModel(BaseModel):
     rotation_angle: float | None = None
     perspective_points: PerspectivePoints = PerspectivePoints()
     clip: Rect = Rect()
+    pyramid_levels: int = 0  # ブレ測定枠を縮小して探索する段数 (0はピラミッド探索を行わない)
+    pyramid_refine_size: int = DEFAULT_REFINE_SIZE  # ピラミッド探索で、元の解像度で比較する窓の大きさ
+    use_tracking: bool = False  # 書き出し時に、直前のフレームのずれの位置で小さな窓だけを比較する
+    tracking_size: int = DEFAULT_TRACKING_SIZE  # 追跡で比較する窓の大きさ
+    tracking_min_response: float = DEFAULT_TRACKING_MIN_RESPONSE  # これ未満の場合はブレ測定枠の全体で求め直す
 
     def get_shaking_detection_fields_index(self, sample_frame_pos: int | None = None):
         if sample_frame_pos is None:
@@ -357,6 +370,11 @@ class CorrectionDataModel(BaseModel):
         self.rotation_angle = None
         self.perspective_points.clear()
         self.clip.clear()
+        self.pyramid_levels = 0
+        self.pyramid_refine_size = DEFAULT_REFINE_SIZE
+        self.use_tracking = False
+        self.tracking_size = DEFAULT_TRACKING_SIZE
+        self.tracking_min_response = DEFAULT_TRACKING_MIN_RESPONSE
 
     def copy_from(self, other: 'CorrectionDataModel'):
         self.base_frame_pos = other.base_frame_pos
@@ -374,3 +392,8 @@ class CorrectionDataModel(BaseModel):
         self.rotation_angle = other.rotation_angle
         self.perspective_points.copy_from(other.perspective_points)
         self.clip.copy_from(other.clip)
+        self.pyramid_levels = other.pyramid_levels
+        self.pyramid_refine_size = other.pyramid_refine_size
+        self.use_tracking = other.use_tracking
+        self.tracking_size = other.tracking_size
+        self.tracking_min_response = other.tracking_min_response
@@ -2,27 +2,50 @@ import wx
 import numpy as np
 import matplotlib.pyplot as plt
 import io
+import math
+import threading
 from PIL import Image
-from numba import njit
+from numba import njit, prange
 from ..common import dpi_aware_size
 
 # MARK: constants
 
 MIN_SIZE = (400, 80)
+PARALLEL_MIN_PIXELS = 1 << 18  # これ以上の画素数のフレームは並列カーネルで集計する
+PARALLEL_CHUNKS = 16  # 並列カーネルの部分ヒストグラムの数
+PREVIEW_SAMPLE_PIXELS = 1 << 20  # プレビュー画像のヒストグラムで集計する画素数の目安
+
+# 並列カーネル(prange)は複数のスレッドから同時に呼び出さない (numbaのスレッドレイヤーによっては安全でないため)
+_parallel_lock = threading.Lock()
 
 # MARK: functions
 
 
-@njit
-def _compute_hist(frame, hist):
+@njit(nogil=True, cache=True)
+def _compute_hist(frame, hist, step):
     # hist = np.zeros((256, 3))
-    for i in range(frame.shape[0]):
-        for j in range(frame.shape[1]):
+    for i in range(0, frame.shape[0], step):
+        for j in range(0, frame.shape[1], step):
             hist[frame[i, j, 0], 0] += 1
             hist[frame[i, j, 1], 1] += 1
             hist[frame[i, j, 2], 2] += 1
 
 
+@njit(nogil=True, parallel=True, cache=True)
+def _compute_hist_parallel(frame, step, n_chunks):
+    # 行を n_chunks 個に振り分けて部分ヒストグラムを集計する (合計は呼び出し側で行う)
+    n_rows = (frame.shape[0] + step - 1) // step
+    partial = np.zeros((n_chunks, 256, 3), dtype=np.int64)
+    for c in prange(n_chunks):
+        for r in range(c, n_rows, n_chunks):
+            i = r * step
+            for j in range(0, frame.shape[1], step):
+                partial[c, frame[i, j, 0], 0] += 1
+                partial[c, frame[i, j, 1], 1] += 1
+                partial[c, frame[i, j, 2], 2] += 1
+    return partial
+
+
 # MARK: main class
 class HistogramView(wx.Panel):
     def __init__(self, parent, *args, **kwargs):
@@ -33,6 +56,8 @@ class HistogramView(wx.Panel):
         self.SetBackgroundStyle(wx.BG_STYLE_PAINT)
         self.hist = np.zeros((256, 3), dtype=np.int64)
         self.bitmap = None
+        self.__partial_hists = {}  # スレッドごとの部分ヒストグラム
+        self.__lock = threading.Lock()
 
         self.Bind(wx.EVT_PAINT, self.__on_paint)
         self.Bind(wx.EVT_SIZE, self.__on_size)
@@ -40,22 +65,50 @@ class HistogramView(wx.Panel):
 
     def clear(self):
         self.hist[:] = 0
+        with self.__lock:
+            self.__partial_hists.clear()
         self.bitmap = None
         self.Refresh()
 
     def begin_histogram(self):
         self.hist[:] = 0
+        with self.__lock:
+            self.__partial_hists.clear()
 
-    def add_histogram(self, frame):
+    def add_histogram(self, frame, max_pixels=None):
+        # 複数のスレッドから同時に呼び出せる (スレッドごとの部分ヒストグラムに集計し、end_histogram()でまとめる)
+        # max_pixelsを指定した場合は、集計する画素数がその程度になるように間引く
         # for i in range(3):
         #     self.hist[:, i] += np.histogram(frame[:, :, i], bins=256, range=(0, 256))[0]
-        _compute_hist(frame, self.hist)
+        thread_id = threading.get_ident()
+        hist = self.__partial_hists.get(thread_id)
+        if hist is None:
+            hist = np.zeros((256, 3), dtype=np.int64)
+            with self.__lock:
+                self.__partial_hists[thread_id] = hist
+        n_pixels = frame.shape[0] * frame.shape[1]
+        step = max(1, math.isqrt(n_pixels // max_pixels)) if max_pixels else 1
+        if n_pixels // (step * step) >= PARALLEL_MIN_PIXELS:
+            with _parallel_lock:
+                hist += _compute_hist_parallel(frame, step, PARALLEL_CHUNKS).sum(axis=0)
+        else:
+            _compute_hist(frame, hist, step)
 
     def end_histogram(self):
+        with self.__lock:
+            for hist in self.__partial_hists.values():
+                self.hist += hist
+            self.__partial_hists.clear()
         interp = (self.hist[:-2, :] + self.hist[2:, :]) * 0.5
         interp = np.pad(interp, ((1, 1), (0, 0)), mode='constant', constant_values=0)
         self.hist[self.hist == 0] = interp[self.hist == 0]
 
+    def set_histogram(self, hist):
+        # end_histogram()後のヒストグラムを復元する (キャッシュから読み込んだ場合)
+        with self.__lock:
+            self.__partial_hists.clear()
+        self.hist[:] = hist
+
     def update_view(self):
         size = self.GetSize()
         if size.GetWidth() == 0 or size.GetHeight() == 0:
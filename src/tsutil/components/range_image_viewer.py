@@ -25,12 +25,21 @@ class RangeImageViewer(ImageViewer):
         self.dragging_rect = None
         self.dragging_x = None
         self.dragging_y = None
+        self.selected_rect = None  # 選択済みの範囲 (表示のみ)
+
+    def set_selected_rect(self, rect: Rect | None):
+        self.selected_rect = rect
+        self.Refresh()
 
     def on_paint(self, event, gc: wx.GraphicsContext):
         super().on_paint(event, gc)
         if self.image is None:
             return
         gc.Clip(wx.Region(self.regions['preview']))
+        if self.selected_rect is not None and self.dragging_rect is None:
+            gc.SetPen(wx.Pen(wx.Colour(255, 255, 0, 255)))
+            gc.SetBrush(wx.TRANSPARENT_BRUSH)
+            self.__paint_rect(gc, self.selected_rect)
         if self.dragging_rect is not None:
             gc.SetPen(wx.Pen(wx.Colour(255, 0, 0, 255)))
             gc.SetBrush(wx.Brush(wx.Colour(255, 0, 0, 64)))
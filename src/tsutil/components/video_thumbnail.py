@@ -4,14 +4,32 @@ import numpy as np
 import cv2
 import time
 from pathlib import Path
-import os
-from types import SimpleNamespace
-import concurrent.futures as futures
 from numba import njit
-from fffio import FrameReader, Probe
 from .resource import resource
 from ..common import logger, dpi_aware, CorrectionDataModel, capture_mouse, release_mouse, APP_NAME
-from ..functions import DeshakingCorrection
+from ..functions import CorrectionPlan
+from ..extraction import (
+    rotate_frame,
+    scale_frame,
+    get_pix_fmt,
+    get_catalog_image_format,
+    make_output_stages,
+    make_video_segments,
+    read_frames,
+    read_frames_direct,
+    read_thumbnails,
+    read_thumbnail,
+    get_thumbnail_size,
+    make_filter_graph,
+    coarse_to_fine_order,
+    CatalogWriter,
+)
+from ..packet_index import load_packet_index
+from ..frame_stack import read_image_catalog, read_image, is_frame_stack
+from ..pipeline import QUEUE_TIMEOUT, Pipeline, PipelineStage
+from ..thumbnail_cache import make_video_cache_key, make_catalog_cache_key, load_thumbnails, save_thumbnails
+from ..thumbnail_store import ThumbnailStore
+from ..transform_table import make_table_key, load_transform_table, save_transform_table
 
 # MARK: constants
 
@@ -20,6 +38,7 @@ PROGRESS_BAR_HEIGHT = 10
 ARROW_SIZE = 12
 THUMBNAIL_SIZE = (1000, 100)
 FRAME_THUMBNAIL_MIN_WIDTH = 10
+FRAME_STRIP_MIN_WIDTH = 40  # 保持するサムネイルの最小の幅 (一部の範囲を広げて表示しても隙間が目立たない幅)
 DRAGGING_NONE = 0
 DRAGGING_LEFT = 1
 DRAGGING_RIGHT = 2
@@ -28,8 +47,13 @@ DRAGGING_X_ARROW = 4
 DRAGGING_LEFT_ARROW = 5
 DRAGGING_RIGHT_ARROW = 6
 
-MAX_WORKERS = 8
-MAX_WORKERS2 = 16
+# パイプラインの段ごとのスレッド数
+DECODE_WORKERS = 4
+TRANSFORM_WORKERS = 2
+CORRECTION_WORKERS = 16
+ENCODE_WORKERS = 8
+COARSE_WORKERS = 8  # 粗いサムネイルを並行してシークして読み込むffmpegの数
+COARSE_SAMPLES = 64  # 最初に動画全体から読み込むサムネイルの数
 
 # MARK: events
 
@@ -89,25 +113,34 @@ class VideoPositionChangedEvent(wx.ThreadEvent):
 
 
 @njit
-def _update_thumbnail(buf, frames, indices, x):
+def _update_thumbnail(buf, rows, widths, slots, indices, x):
     for i, index in enumerate(indices):
-        frame = frames[index]
+        row = slots[index]
+        if row < 0:
+            continue
+        frame = rows[row]
+        w = widths[row]
         fw = x[i + 1] - x[i]
-        if frame.shape[1] <= fw:
-            buf[:, x[i] : x[i] + frame.shape[1], :] = frame
+        if w <= fw:
+            buf[:, x[i] : x[i] + w, :] = frame[:, :w, :]
         else:
-            dwh = (frame.shape[1] - fw) // 2
+            dwh = (w - fw) // 2
             buf[:, x[i] : x[i + 1], :] = frame[:, dwh : dwh + fw, :]
 
 
 # MARK: main class
 class VideoThumbnail(wx.Panel):
-    def __init__(self, parent, use_range_bar=False, use_x_arrow=False, *args, **kwargs):
+    def __init__(self, parent, use_range_bar=False, use_x_arrow=False, keep_full_width=False, *args, **kwargs):
+        # keep_full_width: サムネイルを中央の幅に切り詰めずに保持する (get_thumbnails()で全体を使う場合)
         self.RANGE_BAR_WIDTH = dpi_aware(parent, RANGE_BAR_WIDTH)
         self.PROGRESS_BAR_HEIGHT = dpi_aware(parent, PROGRESS_BAR_HEIGHT)
         self.ARROW_SIZE = dpi_aware(parent, ARROW_SIZE)
         self.thumbnail_size = (dpi_aware(parent, THUMBNAIL_SIZE[0]), dpi_aware(parent, THUMBNAIL_SIZE[1]))
         self.frame_thumbnail_min_width = dpi_aware(parent, FRAME_THUMBNAIL_MIN_WIDTH)
+        self.frame_strip_min_width = dpi_aware(parent, FRAME_STRIP_MIN_WIDTH)
+        # ウィンドウを画面の幅まで広げても、1フレームあたりこれ以上の幅は表示しない
+        self.max_thumbnail_width = wx.GetDisplaySize().GetWidth()
+        self.keep_full_width = keep_full_width
 
         self.client_width = self.thumbnail_size[0] + self.RANGE_BAR_WIDTH * 2
         self.client_height = self.thumbnail_size[1] + (self.ARROW_SIZE if use_x_arrow else 0)
@@ -124,10 +157,11 @@ class VideoThumbnail(wx.Panel):
         self.histogram_view = None
         self.start_pos = 0.0
         self.end_pos = 1.0
+        self.marked_ranges = []  # 追加した範囲の(start_pos, end_pos)のリスト (複数の範囲をまとめてトリミングする)
         self.frame_pos = None
         self.dragging = DRAGGING_NONE
         self.dragging_dx = 0
-        self.frames = []
+        self.frames = ThumbnailStore()  # 読み込んだサムネイル (リストと同じように扱える)
         self.image_catalog = []
         self.progress_total = 0
         self.progress_current = 0
@@ -145,6 +179,8 @@ class VideoThumbnail(wx.Panel):
             self.Bind(wx.EVT_LEFT_UP, self.__on_mouse_up)
             self.Bind(wx.EVT_MOTION, self.__on_mouse_move)
         self.loading = None
+        self.refining = False  # 粗いサムネイルの読み込みが終わり、細かいサムネイルを読み込んでいる (操作できる)
+        self.__loaded = None  # 読み込み済みのフレーム (段階的に読み込む場合)
 
         self.Bind(EVT_VIDEO_LOADING, self.__on_video_loading)
         self.Bind(EVT_VIDEO_LOADED, self.__on_video_loaded)
@@ -160,33 +196,77 @@ class VideoThumbnail(wx.Panel):
     def clear(self):
         self.start_pos = 0.0
         self.end_pos = 1.0
+        self.marked_ranges.clear()
         self.dragging = DRAGGING_NONE
         self.dragging_dx = 0
         self.buf[:] = 192
         self.frames.clear()
         self.image_catalog.clear()
+        self.refining = False
         self.progress_total = 0
         self.progress_current = 0
         self.__update_bitmap()
 
     def load_video(
-        self, path: Path, rotation=0, filter_complex=None, output_path: Path = None, format='PNG', scale=None
+        self,
+        path: Path | list[Path],
+        rotation=0,
+        filter_complex=None,
+        output_path: Path = None,
+        format='PNG',
+        scale=None,
+        segments=1,
+        compression=None,
+        direct_output=False,
+        step=1,
+        keyframes_only=False,
+        frame_range=None,
+        crop=None,
+        frame_ranges=None,
     ):
+        # output_pathを指定しない場合(プレビューのみ)はサムネイルの大きさでデコードする
+        # その場合、step>1ではNフレームごと、keyframes_only=Trueではキーフレームだけをデコードし、
+        # デコードしなかったフレームは直前のサムネイルで埋める
+        # プレビューのみの場合は、pathに複数の動画ファイルを指定すると結合した1本のサムネイルにする
+        # frame_rangeを指定した場合は(開始フレーム, 終了フレーム + 1)の範囲だけを展開する (プレビューのみの場合は無視する)
+        # 展開する場合、step>1ではNフレームごとのフレームだけを展開し、cropを指定すると切り抜いて展開する
+        # frame_ranges(動きのある範囲など)を指定した場合は、それらの範囲だけを展開する
         self.ensure_stop_loading()
         self.SetCursor(wx.Cursor(wx.CURSOR_WAIT))
         self.loading = threading.Thread(
             target=self.__video_load_worker,
-            args=(path, rotation, filter_complex, output_path, format, scale),
+            args=(
+                path,
+                rotation,
+                filter_complex,
+                output_path,
+                format,
+                scale,
+                segments,
+                compression,
+                direct_output,
+                step,
+                keyframes_only,
+                frame_range,
+                crop,
+                frame_ranges,
+            ),
             daemon=True,
         )
         self.loading.start()
 
-    def load_image_catalog(self, path: Path, correction_model: CorrectionDataModel = None, output_path: Path = None):
+    def load_image_catalog(
+        self,
+        path: Path,
+        correction_model: CorrectionDataModel = None,
+        output_path: Path = None,
+        compression: str = None,
+    ):
         self.ensure_stop_loading()
         self.SetCursor(wx.Cursor(wx.CURSOR_WAIT))
         self.loading = threading.Thread(
             target=self.__image_catalog_load_worker,
-            args=(path, correction_model, output_path),
+            args=(path, correction_model, output_path, compression),
             daemon=True,
         )
         self.loading.start()
@@ -199,33 +279,72 @@ class VideoThumbnail(wx.Panel):
         self.SetCursor(wx.Cursor(wx.CURSOR_DEFAULT))
         self.clear()
 
+    def __is_busy(self):
+        # 読み込み中で、範囲やフレーム位置を操作できない
+        return bool(self.loading) and not self.refining
+
     def copy_frames(self, frames):
-        self.frames.clear()
+        self.__reset_frames(len(frames))
         self.frames.extend(frames)
         wx.QueueEvent(self, VideoLoadingEvent())
 
+    def get_thumbnails(self):
+        # 読み込み済みのサムネイル(RGB)のリストを返す (動きの検出などに使う)
+        return [] if self.__is_busy() else list(self.frames)
+
     def get_frame_count(self):
-        return 0 if self.loading else len(self.frames)
+        return 0 if self.__is_busy() else len(self.frames)
 
     def get_frame_range(self):
-        if self.loading or not self.frames:
+        if self.__is_busy() or not self.frames:
             return 0, 0
         start = int(len(self.frames) * self.start_pos + 0.5)
         end = int(len(self.frames) * self.end_pos + 0.5)
         logger.debug(f'{start=} {end=} {len(self.frames)=}')
         return start, end
 
+    def add_marked_range(self):
+        # 現在の範囲を追加する (追加できなかった場合はFalseを返す)
+        if self.__is_busy() or not self.frames or self.start_pos >= self.end_pos:
+            return False
+        self.marked_ranges.append((self.start_pos, self.end_pos))
+        self.marked_ranges.sort()
+        self.Refresh()
+        return True
+
+    def remove_marked_range(self, index=-1):
+        if self.marked_ranges:
+            del self.marked_ranges[index]
+            self.Refresh()
+
+    def clear_marked_ranges(self):
+        self.marked_ranges.clear()
+        self.Refresh()
+
+    def set_marked_frame_ranges(self, frame_ranges):
+        # (開始フレーム, 終了フレーム + 1)のリストを範囲として表示する (動きのある範囲など)
+        n = len(self.frames)
+        self.marked_ranges = [(start / n, end / n) for start, end in frame_ranges] if n else []
+        self.Refresh()
+
+    def get_marked_frame_ranges(self):
+        # 追加した範囲の(開始フレーム, 終了フレーム + 1)のリストを返す
+        if self.__is_busy() or not self.frames:
+            return []
+        n = len(self.frames)
+        return [(int(n * start + 0.5), int(n * end + 0.5)) for start, end in self.marked_ranges]
+
     def get_frame_position(self):
         return self.frame_pos
 
     def set_frame_position(self, frame_pos):
-        if self.loading or not self.frames:
+        if self.__is_busy() or not self.frames:
             return
         self.frame_pos = frame_pos
         self.Refresh()
 
     def get_image_catalog(self):
-        if self.loading:
+        if self.__is_busy():
             return []
         return self.image_catalog
 
@@ -246,18 +365,19 @@ class VideoThumbnail(wx.Panel):
 
     def __update_thumbnail(self):
         self.buf[:] = 192
-        if not self.frames:
+        rows, widths, slots = self.frames.snapshot()
+        if len(slots) == 0:
             self.__update_bitmap()
             return
-        count = len(self.frames)
+        count = len(slots)
         indices = np.arange(count)
         thumb_width = self.buf.shape[1] // count
         if thumb_width < self.frame_thumbnail_min_width:
             thumb_width = self.frame_thumbnail_min_width
             count = self.buf.shape[1] // thumb_width
-            indices = (np.linspace(0, len(self.frames) - 1, count) + 0.5).astype(int)
+            indices = (np.linspace(0, len(slots) - 1, count) + 0.5).astype(int)
         x = (np.linspace(0, self.buf.shape[1], count + 1) + 0.5).astype(int)
-        _update_thumbnail(self.buf, self.frames, indices, x)  # numbaで高速化
+        _update_thumbnail(self.buf, rows, widths, slots, indices, x)  # numbaで高速化
         self.__update_bitmap()
 
     def __on_size(self, event):
@@ -302,10 +422,16 @@ class VideoThumbnail(wx.Panel):
                 )
 
             # これ以降は動画読込中には表示しないもの(マウス操作の対象物)を描画する
-            if self.loading:
+            if self.__is_busy():
                 return
 
             if self.use_range_bar:
+                gc.SetBrush(wx.Brush(wx.Colour(0, 128, 255, 64)))
+                for start, end in self.marked_ranges:
+                    x0 = int(start * self.thumbnail_size[0] + 0.5)
+                    x1 = int(end * self.thumbnail_size[0] + 0.5)
+                    gc.DrawRectangle(self.RANGE_BAR_WIDTH + x0, 0, x1 - x0, self.thumbnail_size[1])
+
                 gc.SetBrush(wx.Brush(wx.Colour(0, 0, 0, 128)))
                 if self.RANGE_BAR_WIDTH < self.__get_start_pos_x():
                     gc.DrawRectangle(self.RANGE_BAR_WIDTH, 0, self.__get_start_pos_x(), self.thumbnail_size[1])
@@ -351,7 +477,7 @@ class VideoThumbnail(wx.Panel):
                 )
 
     def __on_mouse_down(self, event):
-        if self.loading:
+        if self.__is_busy():
             return
         x = event.GetX()
         y = event.GetY()
@@ -395,7 +521,7 @@ class VideoThumbnail(wx.Panel):
         event.Skip()
 
     def __on_mouse_up(self, event):
-        if self.loading:
+        if self.__is_busy():
             return
         if self.frames:
             if self.dragging in [DRAGGING_LEFT, DRAGGING_RIGHT, DRAGGING_RANGE]:
@@ -414,7 +540,7 @@ class VideoThumbnail(wx.Panel):
         event.Skip()
 
     def __on_mouse_move(self, event):
-        if self.loading or not event.Dragging() or not event.LeftIsDown():
+        if self.__is_busy() or not event.Dragging() or not event.LeftIsDown():
             return
         x = min(max(0, event.GetX()), self.client_width - 1)
         if self.dragging == DRAGGING_LEFT:
@@ -490,226 +616,406 @@ class VideoThumbnail(wx.Panel):
         self.ensure_stop_loading()
         event.Skip()
 
-    def __video_load_worker(self, path, rotation=0, filter_complex=None, output_path=None, format='PNG', scale=None):
-        output_fd = None
+    def __video_load_worker(
+        self,
+        path,
+        rotation=0,
+        filter_complex=None,
+        output_path=None,
+        format='PNG',
+        scale=None,
+        segments=1,
+        compression=None,
+        direct_output=False,
+        step=1,
+        keyframes_only=False,
+        frame_range=None,
+        crop=None,
+        frame_ranges=None,
+    ):
+        writer = None
         try:
-            self.frames.clear()
-            probe = Probe(path)
-            self.progress_total = probe.n_frames
+            # 複数の動画ファイルを結合して1本のサムネイルにできるのはプレビューのみ
+            paths = path if isinstance(path, list) else [path]
+            if len(paths) > 1 and output_path:
+                raise ValueError('複数の動画ファイルは連続画像に展開できません。')
+            path = paths[0]
+            packet_indices = [load_packet_index(i) for i in paths]
+            n_frames = sum(i.n_frames for i in packet_indices)
+            if not output_path:
+                frame_range = None
+                frame_ranges = None
+            video_segments = make_video_segments(path, segments, frame_range, frame_ranges) if output_path else None
+            # 展開するフレーム番号の順 (範囲を展開する場合は範囲の先頭から、間引いて展開する場合はstepおきに並ぶ)
+            output_step = max(1, step) if output_path else 1
+            if frame_range or frame_ranges is not None:
+                order = [i for segment in video_segments for i in segment.frame_numbers(output_step)]
+            else:
+                order = range(0, n_frames, output_step)
+            self.progress_total = len(order)
             self.progress_current = 0
+            # 段階的に読み込む場合は、粗いサムネイルの分も行を確保する
+            self.__reset_frames(len(order), extra=0 if output_path else COARSE_SAMPLES)
             wx.QueueEvent(self, VideoLoadingEvent())
-            if output_path:
-                output_fd = open(output_path, 'w')
-                output_parent_path = output_path.parent
-                output_dir = Path(output_path.stem)
-                os.makedirs(output_parent_path / output_dir, exist_ok=True)
-                if format == 'TIFF':
-                    pix_fmt = 'rgb48'
-                    image_file_ext = '.tif'
+            failures = []
+            progressive = False
+            cache_key = None
+            if not output_path:
+                cache_key = make_video_cache_key(
+                    paths,
+                    rotation=rotation,
+                    filter_complex=filter_complex,
+                    height=self.thumbnail_size[1],
+                    width=self.frames.strip_width,
+                    step=step,
+                    keyframes_only=keyframes_only,
+                )
+            cached = self.__load_from_cache(cache_key)
+            if not cached:
+                if not output_path:
+                    # プレビューのみの場合は、ffmpegでサムネイルの大きさに縮小したフレームだけを受け取る
+                    # 先に動画全体から等間隔に粗く読み込み、その後で先頭から細かく読み込み直す
+                    # (間引いた場合はフレーム番号が連続しないので、1スレッドで受け取った順に処理する)
+                    if not self.__load_coarse_thumbnails(paths, packet_indices, rotation, filter_complex):
+                        return
+
+                    def _read_thumbnails():
+                        # 結合する場合は、動画ファイルごとのフレーム番号を通し番号にする
+                        offset = 0
+                        for p, packet_index in zip(paths, packet_indices):
+                            h = self.thumbnail_size[1]
+                            for i, frame in read_thumbnails(p, h, rotation, filter_complex, step, keyframes_only):
+                                yield offset + i, frame
+                            offset += packet_index.n_frames
+
+                    stages = [PipelineStage('thumbnail', lambda index, frame: self.__make_thumbnail(frame))]
+                    source = _read_thumbnails()
+                    progressive = True
+                elif direct_output and not is_frame_stack(output_path):
+                    # 回転・縮小・画像の書き出しはffmpegが行い、パイプからはサムネイルの高さのフレームだけを受け取る
+                    stages = [PipelineStage('thumbnail', lambda index, frame: self.__make_thumbnail(frame))]
+                    source = read_frames_direct(
+                        path,
+                        output_path,
+                        self.thumbnail_size[1],
+                        rotation,
+                        filter_complex,
+                        format,
+                        scale,
+                        compression,
+                        video_segments,
+                        crop,
+                        output_step,
+                    )
                 else:
-                    pix_fmt = 'rgb24'
-                    image_file_ext = '.png'
+                    writer = CatalogWriter(output_path, format, compression)
+
+                    def _transform(index, frame):
+                        frame = scale_frame(rotate_frame(frame, rotation), scale)
+                        return cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), self.__make_thumbnail(frame)
+
+                    stages = [PipelineStage('transform', _transform, TRANSFORM_WORKERS)]
+                    stages += make_output_stages(writer, ENCODE_WORKERS, failures)
+                    source = read_frames(path, filter_complex, get_pix_fmt(format), video_segments, crop, output_step)
+                if progressive:
+                    if not self.__collect_progressive(Pipeline(stages), source, n_frames, sequential=True):
+                        return
+                    if step <= 1 and not keyframes_only and len(paths) == 1:
+                        # 全フレームを読み込んだ場合は、実際にデコードできたフレーム数に合わせる
+                        del self.frames[self.progress_current :]
+                        self.__loaded = self.__loaded[: self.progress_current]
+                    # 間引いた場合は、読み込んでいないフレームを直前のサムネイルで埋める
+                    self.__fill_unloaded(nearest=False)
+                elif not self.__collect_thumbnails(Pipeline(stages), source, order):
+                    return
+            if writer:
+                writer.close()
+            if failures:
+                wx.QueueEvent(self, VideoLoadErrorEvent('連続画像ファイルの保存に失敗したファイルがあります。'))
+            wx.QueueEvent(self, VideoLoadingEvent())
+            time.sleep(0.25)
+            self.loading = None
+            self.refining = False
+            if self.frame_pos is None:
+                self.frame_pos = len(self.frames) // 2
             else:
-                pix_fmt = 'rgb24'
-            future_list = []
-
-            def _save_frame(filename, frame):
-                cv2.imwrite(filename, frame)
-
-            with futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                with FrameReader(path, filter_complex=filter_complex, pix_fmt=pix_fmt) as reader:
-                    prev_time = time.time()
-                    if self.histogram_view:
-                        self.histogram_view.begin_histogram()
-                    for i, frame in enumerate(reader.frames()):
-                        if not self.loading:
-                            break
-                        self.progress_current = i + 1
-                        if rotation == 90:
-                            frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
-                        elif rotation == 180:
-                            frame = cv2.rotate(frame, cv2.ROTATE_180)
-                        elif rotation == 270:
-                            frame = cv2.rotate(frame, cv2.ROTATE_90_COUNTERCLOCKWISE)
-                        h, w, _ = frame.shape
-                        if scale is not None:
-                            w, h = int(w * scale) & ~1, int(h * scale) & ~1
-                            interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR_EXACT
-                            frame = cv2.resize(frame, (w, h), interpolation=interpolation)
-                        if output_path:
-                            image_filename = output_dir / f'f{i + 1:05d}{image_file_ext}'
-                            future = executor.submit(
-                                _save_frame, output_parent_path / image_filename, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-                            )
-                            future_list.append(future)
-                            if len(future_list) >= MAX_WORKERS:
-                                done, not_done = futures.wait(future_list, return_when=futures.FIRST_COMPLETED)
-                                future_list = list(not_done)
-                            output_fd.write(f'{str(image_filename)}\n')
-                        frame = cv2.resize(
-                            frame,
-                            ((w * self.thumbnail_size[1]) // h, self.thumbnail_size[1]),
-                            interpolation=cv2.INTER_LINEAR_EXACT,
-                        )
-                        if frame.dtype == np.uint16:
-                            frame = (frame // 256).astype(np.uint8)
-                        self.frames.append(frame)
-                        if self.histogram_view:
-                            self.histogram_view.add_histogram(frame)
-                        now = time.time()
-                        if now - prev_time >= 0.25:
-                            prev_time += 0.25
-                            wx.QueueEvent(self, VideoLoadingEvent())
-                    else:
-                        done, not_done = futures.wait(future_list, return_when=futures.ALL_COMPLETED)
-                        failures = [future for future in not_done if not future.result()]
-                        if failures:
-                            wx.QueueEvent(
-                                self, VideoLoadErrorEvent('連続画像ファイルの保存に失敗したファイルがあります。')
-                            )
-                        wx.QueueEvent(self, VideoLoadingEvent())
-                        time.sleep(0.25)
-                        self.loading = None
-                        if self.frame_pos is None:
-                            self.frame_pos = len(self.frames) // 2
-                        else:
-                            self.frame_pos = max(0, min(self.frame_pos, len(self.frames) - 1))
-                        self.progress_total = 0
-                        self.progress_current = 0
-                        if self.histogram_view:
-                            self.histogram_view.end_histogram()
-                        wx.QueueEvent(self, VideoLoadedEvent())
+                self.frame_pos = max(0, min(self.frame_pos, len(self.frames) - 1))
+            self.progress_total = 0
+            self.progress_current = 0
+            self.__end_histogram(cache_key, cached)
+            wx.QueueEvent(self, VideoLoadedEvent())
         except Exception as e:
-            if output_fd:
-                output_fd.close()
             wx.QueueEvent(self, VideoLoadErrorEvent(str(e)))
         finally:
+            if writer:
+                writer.close()
             self.loading = None
+            self.refining = False
+            self.__loaded = None
 
-    def __image_catalog_load_worker(self, path, correction_model, output_path):
-        output = None
+    def __image_catalog_load_worker(self, path, correction_model, output_path, compression=None):
+        writer = None
         try:
-            self.frames.clear()
-            parent_path = path.parent
-            with open(path, 'r') as reader:
-                self.image_catalog = [parent_path / line.rstrip() for line in reader]
+            self.image_catalog = read_image_catalog(path)
+            self.__reset_frames(len(self.image_catalog))
             self.progress_total = len(self.image_catalog)
             self.progress_current = 0
             wx.QueueEvent(self, VideoLoadingEvent())
             if output_path:
-                output = SimpleNamespace(
-                    **dict(
-                        fd=open(output_path, 'w'),
-                        indexed_filenames={},
-                        parent_path=output_path.parent,
-                        dir_name=Path(output_path.stem),
-                        log_fd=open(os.devnull, 'w'),  # open(output_path.with_suffix('.log'), 'w'),
-                    )
-                )
-                os.makedirs(output.parent_path / output.dir_name, exist_ok=True)
-            if correction_model is None:
-                base_frame = None
+                writer = CatalogWriter(output_path, get_catalog_image_format(path), compression)
+                cache_key = None
             else:
-                base_frame = cv2.cvtColor(
-                    cv2.imread(str(self.image_catalog[correction_model.base_frame_pos]), cv2.IMREAD_UNCHANGED),
-                    cv2.COLOR_BGR2RGB,
+                cache_key = make_catalog_cache_key(
+                    path, self.image_catalog, height=self.thumbnail_size[1], width=self.frames.strip_width
+                )
+            cached = self.__load_from_cache(cache_key)
+            # 基準画像の測定枠や補正の行列は、書き出しの開始時に1回だけ計算する
+            correction_plan = None
+            table_key = None
+            if correction_model is not None and writer:
+                correction_plan = CorrectionPlan(
+                    correction_model,
+                    read_image(self.image_catalog[correction_model.base_frame_pos]),
+                    len(self.image_catalog),
                 )
-            future_list = []
-            indexed_frame = {}
+                table_key = self.__prepare_transform_table(path, correction_plan)
+            failures = []
 
-            def _load_and_save_frame(lock, indexed_frame, index, image_path, output, correction_model, base_frame):
+            def _decode(index, image_path):
+                frame = None
                 if not image_path.exists():
                     logger.error(f'File not found: {image_path}')
-                    return
-                frame = cv2.imread(str(image_path), cv2.IMREAD_UNCHANGED)
-                if output:
-                    image_filename = output.dir_name / image_path.name
-                    if correction_model is not None:
-                        deshaking_correction = DeshakingCorrection()
-                        deshaking_correction.set_base_image(base_frame)
-                        deshaking_correction.set_sample_image(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), index)
-                        fields = (
-                            correction_model.get_shaking_detection_fields(index)
-                            if correction_model.use_deshake_correction
-                            else []
-                        )
-                        angle = correction_model.rotation_angle if correction_model.use_rotation_correction else 0.0
-                        mat = deshaking_correction.compute(fields, angle, output.log_fd)
-                        if correction_model.use_perspective_correction:
-                            mat = correction_model.perspective_points.get_transform_matrix() @ mat
-                        frame = cv2.warpPerspective(frame, mat, (frame.shape[1], frame.shape[0]), flags=cv2.INTER_AREA)
-                    if not correction_model.clip.is_none():
-                        frame = frame[
-                            correction_model.clip.top : correction_model.clip.bottom,
-                            correction_model.clip.left : correction_model.clip.right,
-                            :,
-                        ]
-                    cv2.imwrite(output.parent_path / image_filename, frame)
-                    output.indexed_filenames[index] = str(image_filename)
-                h, w, _ = frame.shape
-                frame = cv2.cvtColor(
-                    cv2.resize(
-                        frame,
-                        ((w * self.thumbnail_size[1]) // h, self.thumbnail_size[1]),
-                        interpolation=cv2.INTER_LINEAR_EXACT,
-                    ),
-                    cv2.COLOR_BGR2RGB,
-                )
-                if frame.dtype == np.uint16:
-                    frame = (frame / 256).astype(np.uint8)
-                with lock:
-                    indexed_frame[index] = frame
-                    if self.histogram_view:
-                        self.histogram_view.add_histogram(frame)
-
-            with futures.ThreadPoolExecutor(max_workers=MAX_WORKERS2) as executor:
-                lock = threading.Lock()
-                prev_time = time.time()
-                if self.histogram_view:
-                    self.histogram_view.begin_histogram()
-                for i, image_path in enumerate(self.image_catalog):
-                    if not self.loading:
-                        break
-                    self.progress_current = i + 1
-                    future = executor.submit(
-                        _load_and_save_frame, lock, indexed_frame, i, image_path, output, correction_model, base_frame
-                    )
-                    future_list.append(future)
-                    if len(future_list) >= MAX_WORKERS2:
-                        done, not_done = futures.wait(future_list, return_when=futures.FIRST_COMPLETED)
-                        future_list = list(not_done)
-                    now = time.time()
-                    if now - prev_time >= 0.25:
-                        prev_time += 0.25
-                        self.frames = [indexed_frame[i] for i in sorted(indexed_frame.keys())]
-                        wx.QueueEvent(self, VideoLoadingEvent())
                 else:
-                    done, not_done = futures.wait(future_list, return_when=futures.ALL_COMPLETED)
-                    failures = [future for future in not_done if not future.result()]
-                    if output:
-                        for i in sorted(output.indexed_filenames.keys()):
-                            output.fd.write(output.indexed_filenames[i] + '\n')
-                    if failures:
-                        wx.QueueEvent(
-                            self, VideoLoadErrorEvent('連続画像ファイルの入出力処理に失敗したファイルがあります。')
-                        )
-                    self.frames = [indexed_frame[i] for i in sorted(indexed_frame.keys())]
-                    wx.QueueEvent(self, VideoLoadingEvent())
-                    time.sleep(0.25)
-                    self.loading = None
-                    if self.frame_pos is None or self.frame_pos > len(self.frames) - 1:
-                        self.frame_pos = len(self.frames) // 2
-                    else:
-                        self.frame_pos = max(0, min(self.frame_pos, len(self.frames) - 1))
-                    self.progress_total = 0
-                    self.progress_current = 0
-                    if self.histogram_view:
-                        self.histogram_view.end_histogram()
-                    wx.QueueEvent(self, VideoLoadedEvent())
+                    frame = read_image(image_path)
+                    if frame is None:
+                        logger.error(f'Failed to read: {image_path}')
+                        failures.append(index)
+                if table_key:
+                    # ずれを推定しながら補正する場合は、読み込めなかったフレームも知らせる
+                    correction_plan.add_fields(index, frame)
+                return frame
+
+            def _transform(index, frame):
+                if writer:
+                    if correction_plan is not None:
+                        # フレームを含むチャンクのずれを推定してから補正する (中断された場合はフレームを破棄する)
+                        while not correction_plan.estimate_chunk(index, QUEUE_TIMEOUT):
+                            if pipeline.cancelled:
+                                return None
+                        frame = correction_plan.correct(index, frame)
+                    return frame, self.__make_thumbnail(frame, bgr=True)
+                return self.__make_thumbnail(frame, bgr=True)
+
+            stages = [
+                PipelineStage('decode', _decode, DECODE_WORKERS),
+                PipelineStage('correct', _transform, CORRECTION_WORKERS),
+            ]
+            if writer:
+                stages += make_output_stages(writer, ENCODE_WORKERS, failures, lambda i: self.image_catalog[i].stem)
+                pipeline = Pipeline(stages)
+                if not self.__collect_thumbnails(pipeline, enumerate(self.image_catalog)):
+                    return
+                if table_key:
+                    self.__save_transform_table(path, correction_plan)
+            elif not cached:
+                # プレビューのみの場合は、全体から等間隔に間引いた画像から順に細かく読み込む
+                count = len(self.image_catalog)
+                source = ((i, self.image_catalog[i]) for i in coarse_to_fine_order(count))
+                if not self.__collect_progressive(
+                    Pipeline(stages), source, count, refine_after=min(count, COARSE_SAMPLES)
+                ):
+                    return
+                # 読み込めなかった画像は直前のサムネイルで埋める
+                self.__fill_unloaded(nearest=False)
+            if writer:
+                writer.close()
+            if failures:
+                wx.QueueEvent(self, VideoLoadErrorEvent('連続画像ファイルの入出力処理に失敗したファイルがあります。'))
+            wx.QueueEvent(self, VideoLoadingEvent())
+            time.sleep(0.25)
+            self.loading = None
+            self.refining = False
+            if self.frame_pos is None or self.frame_pos > len(self.frames) - 1:
+                self.frame_pos = len(self.frames) // 2
+            else:
+                self.frame_pos = max(0, min(self.frame_pos, len(self.frames) - 1))
+            self.progress_total = 0
+            self.progress_current = 0
+            self.__end_histogram(cache_key, cached)
+            wx.QueueEvent(self, VideoLoadedEvent())
         except Exception as e:
-            if output:
-                output.fd.close()
-                output.log_fd.close()
             wx.QueueEvent(self, VideoLoadErrorEvent(str(e)))
         finally:
+            if writer:
+                writer.close()
             self.loading = None
+            self.refining = False
+            self.__loaded = None
+
+    def __prepare_transform_table(self, path, correction_plan):
+        # 同じ設定で推定したずれの表があれば使い、無ければ補正しながら推定する空の表を用意する
+        # (推定する場合は表のキーを返す。表を使う場合やブレ補正をしない場合はNone)
+        if not correction_plan.needs_table:
+            return None
+        key = make_table_key(path, self.image_catalog, **correction_plan.table_params)
+        table = load_transform_table(path, key, len(self.image_catalog))
+        if table is not None:
+            correction_plan.use_table(table)
+            return None
+        correction_plan.begin_estimation(key)
+        return key
+
+    def __save_transform_table(self, path, correction_plan):
+        table = correction_plan.end_estimation()
+        if table is None:
+            return
+        tracked = sum(c.tracked_count for c in correction_plan.correlators)
+        if tracked:
+            lost = sum(c.lost_count for c in correction_plan.correlators)
+            logger.debug(f'tracking: {tracked=} {lost=}')
+        save_transform_table(path, table)
+
+    def __collect_thumbnails(self, pipeline, source, order=None):
+        # パイプラインの出力(サムネイル)をフレーム番号の順(orderを指定した場合はその順)に受け取る
+        # (読み込みが中断された場合はFalseを返す)
+        prev_time = time.time()
+        if self.histogram_view:
+            self.histogram_view.begin_histogram()
+        results = pipeline.run(source, order=order)
+        try:
+            for _, frame in results:
+                if not self.loading:
+                    return False
+                self.progress_current += 1
+                self.frames.append(frame)
+                now = time.time()
+                if now - prev_time >= 0.25:
+                    prev_time += 0.25
+                    wx.QueueEvent(self, VideoLoadingEvent())
+        finally:
+            results.close()
+        return bool(self.loading)
+
+    def __collect_progressive(self, pipeline, source, total, sequential=False, refine_after=None):
+        # パイプラインの出力(サムネイル)をフレーム番号の順不同で受け取る (読み込みが中断された場合はFalseを返す)
+        # まだ読み込んでいないフレームには、最も近い読み込み済みのフレームのサムネイルを表示する
+        # sequential: sourceがフレーム番号順 (進捗をフレーム番号で表示する)
+        # refine_after: この数のフレームを読み込んだら、読み込み中でも範囲やフレーム位置を操作できるようにする
+        if self.__loaded is None:
+            self.__loaded = np.zeros(total, dtype=bool)
+            if self.histogram_view:
+                self.histogram_view.begin_histogram()
+        prev_time = time.time()
+        results = pipeline.run(source, ordered=False)
+        try:
+            for i, frame in results:
+                if not self.loading:
+                    return False
+                if i >= len(self.__loaded):
+                    self.__loaded = np.concatenate([self.__loaded, np.zeros(i + 1 - len(self.__loaded), dtype=bool)])
+                if len(self.frames) < len(self.__loaded):
+                    self.frames.resize(len(self.__loaded))
+                self.frames[i] = frame
+                self.__loaded[i] = True
+                if sequential:
+                    self.progress_current = i + 1
+                else:
+                    self.progress_current += 1
+                if refine_after is not None and not self.refining and self.progress_current >= refine_after:
+                    self.refining = True
+                now = time.time()
+                if now - prev_time >= 0.25:
+                    prev_time += 0.25
+                    self.__fill_unloaded()
+                    wx.QueueEvent(self, VideoLoadingEvent())
+        finally:
+            results.close()
+        return bool(self.loading)
+
+    def __fill_unloaded(self, nearest=True):
+        # 読み込んでいないフレームに、最も近い(nearest=Falseの場合は直前の)読み込み済みのサムネイルを割り当てる
+        loaded = np.flatnonzero(self.__loaded)
+        missing = np.flatnonzero(~self.__loaded)
+        if len(loaded) == 0 or len(missing) == 0:
+            return
+        pos = np.searchsorted(loaded, missing)
+        prev = loaded[np.maximum(pos - 1, 0)]
+        if nearest:
+            following = loaded[np.minimum(pos, len(loaded) - 1)]
+            prev = np.where(np.abs(missing - prev) <= np.abs(following - missing), prev, following)
+        self.frames.fill(missing, prev)
+
+    def __load_coarse_thumbnails(self, paths, packet_indices, rotation, filter_complex):
+        # 動画全体から等間隔にCOARSE_SAMPLESフレームをシークして並行して読み込む (読み込みが中断された場合はFalseを返す)
+        offsets = np.cumsum([0] + [i.n_frames for i in packet_indices])
+        count = int(offsets[-1])
+        if count < COARSE_SAMPLES * 4:
+            return True
+        thumbnail_size = get_thumbnail_size(paths[0], self.thumbnail_size[1], rotation)
+        filters = make_filter_graph(filter_complex, rotation)
+
+        def _decode(index, _):
+            k = int(np.searchsorted(offsets, index, side='right')) - 1
+            seek_time = packet_indices[k].seek_time(index - int(offsets[k]))
+            frame = read_thumbnail(paths[k], thumbnail_size, filters, seek_time)
+            # 後で読み込み直すので、ヒストグラムには加えない
+            return None if frame is None else self.__make_thumbnail(frame, histogram=False)
+
+        indices = [int((k + 0.5) * count / COARSE_SAMPLES) for k in range(COARSE_SAMPLES)]
+        pipeline = Pipeline([PipelineStage('coarse', _decode, COARSE_WORKERS)])
+        if not self.__collect_progressive(pipeline, ((i, None) for i in indices), count):
+            return False
+        self.__fill_unloaded()
+        self.refining = True
+        self.progress_current = 0
+        wx.QueueEvent(self, VideoLoadingEvent())
+        return True
+
+    def __load_from_cache(self, cache_key):
+        # キャッシュがあればサムネイルを読み込み、(サムネイル, ヒストグラム)を返す
+        cached = load_thumbnails(cache_key) if cache_key else None
+        if cached:
+            self.frames.extend(cached[0])
+            self.progress_current = self.progress_total = len(self.frames)
+            # キャッシュファイルのメモリーマップを早く閉じるように、読み込んだサムネイルに置き換える
+            cached = self.frames, cached[1]
+        return cached
+
+    def __end_histogram(self, cache_key, cached):
+        # ヒストグラムを確定させて、キャッシュから読み込んでいなければキャッシュに保存する
+        if self.histogram_view:
+            if cached and cached[1] is not None:
+                self.histogram_view.set_histogram(cached[1])
+            else:
+                if cached:
+                    # ヒストグラムの無いキャッシュの場合はサムネイルから集計する
+                    self.histogram_view.begin_histogram()
+                    for frame in self.frames:
+                        self.histogram_view.add_histogram(frame)
+                self.histogram_view.end_histogram()
+        if cache_key and (not cached or (cached[1] is None and self.histogram_view)):
+            save_thumbnails(cache_key, self.frames, self.histogram_view.hist if self.histogram_view else None)
+
+    def __reset_frames(self, count, extra=0):
+        # count個のフレームを読み込む準備をする
+        # (keep_full_width=Falseの場合は、画面の幅に広げたタイムラインで1フレームに表示できる幅だけを保持する)
+        strip_width = None
+        if not self.keep_full_width:
+            strip_width = max(self.frame_strip_min_width, -(-self.max_thumbnail_width // max(1, count)))
+        self.frames.reset(count + extra, strip_width)
+
+    def __make_thumbnail(self, frame, bgr=False, histogram=True):
+        h, w, _ = frame.shape
+        frame = cv2.resize(
+            frame,
+            ((w * self.thumbnail_size[1]) // h, self.thumbnail_size[1]),
+            interpolation=cv2.INTER_LINEAR_EXACT,
+        )
+        if bgr:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if frame.dtype == np.uint16:
+            frame = (frame // 256).astype(np.uint8)
+        # ヒストグラムもパイプラインの各スレッドで集計する (end_histogram()でまとめる)
+        if histogram and self.histogram_view:
+            self.histogram_view.add_histogram(frame)
+        return frame
@@ -7,6 +7,7 @@ from .common import (
     CorrectionDataModel,
     make_file_picker_ctrl,
     IMAGE_CATALOG_FILE_WILDCARD,
+    IMAGE_SOURCE_FILE_WILDCARD,
     get_path,
     path_exists,
     get_spin_ctrl_value,
@@ -17,6 +18,9 @@ from .components.base_image_viewer import BaseImageViewer, EVT_FIELD_ADDED, EVT_
 from .components.deshaking_image_viewer import DeshakingImageViewer, EVT_PERSPECTIVE_POINTS_CHANGED
 from .components.clip_image_viewer import ClipImageViewer, EVT_CLIP_RECT_CHANGED
 from .functions import DeshakingCorrection
+from .phase_correlation import DEFAULT_REFINE_SIZE, MIN_PYRAMID_SIZE
+from .extraction import IMAGE_ENCODERS, get_catalog_image_format
+from .frame_stack import read_image
 
 # MARK: constants
 
@@ -26,6 +30,8 @@ SETTING_EXTENSION = '.correct.json'
 CORR_SUFFIX = '_CORR'
 PNG_SUFFIX = '_PNG'
 TIFF_SUFFIX = '_TIFF'
+MAX_PYRAMID_LEVELS = 4
+MAX_REFINE_SIZE = 1024
 
 
 # MARK: main window
@@ -54,7 +60,7 @@ class MainFrame(ToolFrame):
         self.input_file_picker = make_file_picker_ctrl(
             input_file_panel,
             message='連続画像のカタログファイルを選択してください。',
-            wildcard=IMAGE_CATALOG_FILE_WILDCARD,
+            wildcard=IMAGE_SOURCE_FILE_WILDCARD,
             style=wx.FLP_OPEN | wx.FLP_USE_TEXTCTRL | wx.FLP_FILE_MUST_EXIST,
         )
         self.input_file_picker.Bind(wx.EVT_FILEPICKER_CHANGED, self.__on_input_file_changed)
@@ -111,6 +117,39 @@ class MainFrame(ToolFrame):
         user_correction_sizer.Add(
             self.use_deshake_correction_button, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN
         )
+        user_correction_sizer.Add(
+            wx.StaticText(use_correction_panel, label='ピラミッド探索(段数):'), flag=wx.ALIGN_CENTER_VERTICAL
+        )
+        self.pyramid_levels = wx.SpinCtrl(
+            use_correction_panel, value='0', min=0, max=MAX_PYRAMID_LEVELS, style=wx.SP_ARROW_KEYS | wx.ALIGN_RIGHT
+        )
+        self.pyramid_levels.SetToolTip(
+            '大きなブレ測定枠を縮小して大まかなブレを求めてから、中央の窓だけを元の解像度で比較します。'
+            '0の場合はブレ測定枠の全体を元の解像度で比較します。'
+        )
+        self.pyramid_levels.Bind(wx.EVT_TEXT, self.__on_input_value_changed)
+        self.pyramid_levels.Bind(wx.EVT_SPINCTRL, self.__on_input_value_changed)
+        user_correction_sizer.Add(self.pyramid_levels, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=4)
+        user_correction_sizer.Add(wx.StaticText(use_correction_panel, label='窓:'), flag=wx.ALIGN_CENTER_VERTICAL)
+        self.pyramid_refine_size = wx.SpinCtrl(
+            use_correction_panel,
+            value=str(DEFAULT_REFINE_SIZE),
+            min=MIN_PYRAMID_SIZE,
+            max=MAX_REFINE_SIZE,
+            style=wx.SP_ARROW_KEYS | wx.ALIGN_RIGHT,
+        )
+        self.pyramid_refine_size.SetToolTip('ピラミッド探索で、元の解像度で比較する窓の大きさ(ピクセル)')
+        self.pyramid_refine_size.Bind(wx.EVT_TEXT, self.__on_input_value_changed)
+        self.pyramid_refine_size.Bind(wx.EVT_SPINCTRL, self.__on_input_value_changed)
+        user_correction_sizer.Add(self.pyramid_refine_size, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
+        self.use_tracking_button = wx.CheckBox(use_correction_panel, label='書き出し時に追跡する')
+        self.use_tracking_button.SetToolTip(
+            '書き出し時に、直前のフレームのブレの位置で中央の小さな窓だけを比較します。'
+            '比較の結果が悪いフレームは、ブレ測定枠の全体で求め直します。'
+        )
+        self.use_tracking_button.SetValue(self.model.use_tracking)
+        self.use_tracking_button.Bind(wx.EVT_CHECKBOX, self.__on_input_value_changed)
+        user_correction_sizer.Add(self.use_tracking_button, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
         self.use_overlay_button = wx.CheckBox(use_correction_panel, label='基準画像を重ねて表示する')
         self.use_overlay_button.SetValue(self.model.use_overlay)
         self.use_overlay_button.Bind(wx.EVT_CHECKBOX, self.__on_input_value_changed)
@@ -144,9 +183,20 @@ class MainFrame(ToolFrame):
         row += 1
 
         # save button
-        save_button = wx.Button(panel, label='補正後の連続画像とカタログファイルを作成する...')
+        save_panel = wx.Panel(panel)
+        save_sizer = wx.FlexGridSizer(cols=3, gap=wx.Size(MARGIN, 0))
+        save_sizer.Add(wx.StaticText(save_panel, label='圧縮:'), flag=wx.ALIGN_CENTER_VERTICAL)
+        self.compression_selector = wx.Choice(save_panel)
+        self.compression_selector.SetToolTip(
+            'TrainScannerで読み込むだけの中間ファイルには、無圧縮を選ぶと書き込みが速くなります。'
+        )
+        save_sizer.Add(self.compression_selector, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
+        self.__reset_compression_selector()
+        save_button = wx.Button(save_panel, label='補正後の連続画像とカタログファイルを作成する...')
         save_button.Bind(wx.EVT_BUTTON, self.__on_save_button_clicked)
-        sizer.Add(save_button, flag=wx.ALIGN_CENTER | wx.BOTTOM, border=MARGIN)
+        save_sizer.Add(save_button, flag=wx.ALIGN_CENTER_VERTICAL)
+        save_panel.SetSizerAndFit(save_sizer)
+        sizer.Add(save_panel, flag=wx.ALIGN_CENTER | wx.BOTTOM, border=MARGIN)
 
         # output video thumbnail
         output_video_panel = wx.Panel(panel)
@@ -317,7 +367,7 @@ class MainFrame(ToolFrame):
         if not image_catalog or self.model.base_frame_pos is None or self.model.base_frame_pos >= len(image_catalog):
             self.base_image_viewer.clear()
             return
-        frame = cv2.imread(str(image_catalog[self.model.base_frame_pos]), cv2.IMREAD_UNCHANGED)
+        frame = read_image(image_catalog[self.model.base_frame_pos])
         if frame is None:
             self.base_image_viewer.clear()
             return
@@ -338,7 +388,7 @@ class MainFrame(ToolFrame):
             return
 
         # deshaking image
-        frame = cv2.imread(str(image_catalog[self.model.sample_frame_pos]), cv2.IMREAD_UNCHANGED)
+        frame = read_image(image_catalog[self.model.sample_frame_pos])
         if frame is None:
             self.deshaking_image_viewer.clear()
             self.clip_image_viewer.clear()
@@ -349,7 +399,9 @@ class MainFrame(ToolFrame):
         self.deshaking_correction.set_sample_image(self.sample_frame, self.model.sample_frame_pos)
         fields = self.model.get_shaking_detection_fields() if self.model.use_deshake_correction else []
         angle = self.model.rotation_angle if self.model.use_rotation_correction else 0.0
-        mat = self.deshaking_correction.compute(fields, angle)
+        mat = self.deshaking_correction.compute(
+            fields, angle, pyramid_levels=self.model.pyramid_levels, refine_size=self.model.pyramid_refine_size
+        )
         frame = (
             (self.sample_frame // 256).astype(np.uint8) if self.sample_frame.dtype == np.uint16 else self.sample_frame
         )
@@ -394,6 +446,9 @@ class MainFrame(ToolFrame):
         self.model.use_nega = self.use_nega_button.GetValue()
         self.model.use_grid = self.use_grid_button.GetValue()
         self.model.rotation_angle = get_spin_ctrl_value(self.rotation)
+        self.model.pyramid_levels = get_spin_ctrl_value(self.pyramid_levels)
+        self.model.pyramid_refine_size = get_spin_ctrl_value(self.pyramid_refine_size)
+        self.model.use_tracking = self.use_tracking_button.GetValue()
 
     def __reset_shaking_detection_selector(self, index: int | None = None):
         selected_index = index if index is not None else self.shaking_detection_selector.GetSelection()
@@ -451,6 +506,9 @@ class MainFrame(ToolFrame):
                 self.use_nega_button.SetValue(self.model.use_nega)
                 self.use_grid_button.SetValue(self.model.use_grid)
                 self.rotation.SetValue(_g(self.model.rotation_angle))
+                self.pyramid_levels.SetValue(self.model.pyramid_levels)
+                self.pyramid_refine_size.SetValue(self.model.pyramid_refine_size)
+                self.use_tracking_button.SetValue(self.model.use_tracking)
                 if self.model.select_sample_frame:
                     self.sample_frame_button.SetValue(True)
                 else:
@@ -478,8 +536,12 @@ class MainFrame(ToolFrame):
         self.use_nega_button.SetValue(self.model.use_nega)
         self.use_grid_button.SetValue(self.model.use_grid)
         self.rotation.SetValue('0.00')
+        self.pyramid_levels.SetValue(self.model.pyramid_levels)
+        self.pyramid_refine_size.SetValue(self.model.pyramid_refine_size)
+        self.use_tracking_button.SetValue(self.model.use_tracking)
         self.output_video_thumbnail.clear()
         self.output_filename_text.SetValue('')
+        self.__reset_compression_selector(get_catalog_image_format(path))
         self.__load_setting()
         self.input_video_thumbnail.load_image_catalog(path)
 
@@ -613,6 +675,12 @@ class MainFrame(ToolFrame):
         super().on_save_menu(event)
         self.__save_setting()
 
+    def __reset_compression_selector(self, format='PNG'):
+        # 補正後の画像は元の画像と同じ形式で保存されるので、カタログファイルの画像形式の圧縮方式を選択肢にする
+        self.compression_keys = list(IMAGE_ENCODERS[format].keys())
+        self.compression_selector.Set([i.label for i in IMAGE_ENCODERS[format].values()])
+        self.compression_selector.SetSelection(0)
+
     def __on_save_button_clicked(self, event):
         if self.input_video_thumbnail.get_frame_count() == 0:
             wx.MessageBox('連続画像が読み込まれていません。', 'エラー', wx.OK | wx.ICON_ERROR)
@@ -635,7 +703,12 @@ class MainFrame(ToolFrame):
             self.__save_setting()
             output_path = get_path(fileDialog.GetPath())
             self.output_filename_text.SetValue(str(output_path))
-            self.output_video_thumbnail.load_image_catalog(input_path, self.model, output_path)
+            self.output_video_thumbnail.load_image_catalog(
+                input_path,
+                self.model,
+                output_path,
+                self.compression_keys[self.compression_selector.GetSelection()],
+            )
         event.Skip()
 
     def __on_folder_button_clicked(self, event):
@@ -0,0 +1,841 @@
+from pathlib import Path
+from pydantic import BaseModel
+from fffio import Probe
+from .frame_stack import FrameStack, FrameStackWriter, is_frame_stack
+from .pipeline import Pipeline, PipelineStage
+from .packet_index import load_packet_index
+from typing import Callable, Iterator
+import subprocess
+import tempfile
+import threading
+import time
+import queue
+import numpy as np
+import cv2
+import logging
+import os
+
+# NOTE: このモジュールはwxPythonに依存しない (ディスプレイの無い環境からも使用する)
+
+# MARK: constants
+
+SETTING_EXTENSION = '.extract.json'
+RAW_SUFFIX = '_RAW'
+OUTPUT_FORMATS = ['PNG', 'TIFF']
+MAX_WORKERS = 8  # 画像のエンコードのスレッド数
+TRANSFORM_WORKERS = 2  # 回転・縮小のスレッド数
+WRITE_WORKERS = 2  # ファイル書き込みのスレッド数
+MAX_SEGMENTS = 32  # 並列デコード時の最大分割数
+DIRECT_OUTPUT_THUMBNAIL_HEIGHT = 16  # ffmpegから直接書き出す場合に、サムネイルを使わないときの高さ
+
+logger = logging.getLogger('tsutil')
+
+
+# MARK: extraction setting model
+class ExtractionSetting(BaseModel):
+    rotation: int = 0
+    eq: bool = False
+    eq_brightness: float = 0.0
+    eq_contrast: float = 1.0
+    eq_gamma: float = 1.0
+    eq_saturation: float = 1.0
+    colortemperature: bool = False
+    colortemperature_temperature: int = 6500
+    colortemperature_pl: float = 1.0
+    colortemperature_mix: float = 1.0
+    huesaturation: bool = False
+    huesaturation_hue: int = 0
+    huesaturation_saturation: float = 0.0
+    huesaturation_intensity: float = 0.0
+    crop: bool = False
+    crop_x: int = 0  # 切り抜く範囲 (回転前の動画のフレームの座標)
+    crop_y: int = 0
+    crop_width: int = 0
+    crop_height: int = 0
+    frame_step: int = 1  # Nフレームごとに展開する
+    motion_gate: bool = False  # 動きのある範囲だけを展開する
+    motion_threshold: float = 1.0  # 動きがあるとみなす、直前のフレームから変化したピクセルの割合(%)
+    motion_pre_roll: int = 30  # 動きの前に残すフレーム数
+    motion_post_roll: int = 30  # 動きの後に残すフレーム数
+
+    def make_crop(self) -> tuple[int, int, int, int] | None:
+        # ffmpegのcropフィルターの(x, y, 幅, 高さ)を返す (色差の間引きで丸められないように偶数にする)
+        if not self.crop or self.crop_width < 2 or self.crop_height < 2:
+            return None
+        return self.crop_x & ~1, self.crop_y & ~1, self.crop_width & ~1, self.crop_height & ~1
+
+    def make_filter_complex(self) -> dict[str, dict]:
+        filter_complex = {}
+        if self.eq:
+            filter_complex['eq'] = dict(
+                brightness=self.eq_brightness,
+                contrast=self.eq_contrast,
+                gamma=self.eq_gamma,
+                saturation=self.eq_saturation,
+            )
+        if self.colortemperature:
+            filter_complex['colortemperature'] = dict(
+                temperature=self.colortemperature_temperature,
+                pl=self.colortemperature_pl,
+                mix=self.colortemperature_mix,
+            )
+        if self.huesaturation:
+            filter_complex['huesaturation'] = dict(
+                hue=self.huesaturation_hue,
+                saturation=self.huesaturation_saturation,
+                intensity=self.huesaturation_intensity,
+            )
+        return filter_complex
+
+    @classmethod
+    def load(cls, path: Path) -> 'ExtractionSetting':
+        if not path.exists():
+            return cls()
+        with open(path, 'r') as f:
+            return cls.model_validate_json(f.read())
+
+    def save(self, path: Path):
+        with open(path, 'w') as f:
+            f.write(self.model_dump_json(indent=2))
+
+
+# MARK: image encoders
+class ImageEncoder(BaseModel):
+    label: str
+    params: list[int] = []
+    ffmpeg_args: list[str] = []  # ffmpegから直接書き出す場合のエンコーダーのオプション
+
+    def write(self, path: Path | str, frame: np.ndarray):
+        if not cv2.imwrite(str(path), frame, self.params):
+            raise IOError(f'failed to write: {path}')
+
+    def encode(self, frame: np.ndarray, ext: str) -> np.ndarray:
+        ok, buf = cv2.imencode(ext, frame, self.params)
+        if not ok:
+            raise IOError(f'failed to encode: {ext}')
+        return buf
+
+
+# 各形式の先頭が既定値
+IMAGE_ENCODERS: dict[str, dict[str, ImageEncoder]] = {
+    'PNG': {
+        'default': ImageEncoder(
+            label='標準', ffmpeg_args=['-compression_level', '1']
+        ),  # OpenCVの既定値 (圧縮レベル1, RLE)
+        # zlibの無圧縮ブロックで書き込むので、ファイルサイズは約1.5倍になるが最も速い
+        'store': ImageEncoder(
+            label='無圧縮 (最速)',
+            params=[cv2.IMWRITE_PNG_COMPRESSION, 0, cv2.IMWRITE_PNG_FILTER, cv2.IMWRITE_PNG_FILTER_NONE],
+            ffmpeg_args=['-compression_level', '0', '-pred', 'none'],
+        ),
+        'best': ImageEncoder(
+            label='高圧縮', params=[cv2.IMWRITE_PNG_COMPRESSION, 9], ffmpeg_args=['-compression_level', '9']
+        ),
+    },
+    'TIFF': {
+        'lzw': ImageEncoder(
+            label='LZW',
+            params=[cv2.IMWRITE_TIFF_COMPRESSION, cv2.IMWRITE_TIFF_COMPRESSION_LZW],
+            ffmpeg_args=['-compression_algo', 'lzw'],
+        ),
+        'none': ImageEncoder(
+            label='無圧縮 (最速)',
+            params=[cv2.IMWRITE_TIFF_COMPRESSION, cv2.IMWRITE_TIFF_COMPRESSION_NONE],
+            ffmpeg_args=['-compression_algo', 'raw'],
+        ),
+        'deflate': ImageEncoder(
+            label='Deflate (高圧縮)',
+            params=[cv2.IMWRITE_TIFF_COMPRESSION, cv2.IMWRITE_TIFF_COMPRESSION_ADOBE_DEFLATE],
+            ffmpeg_args=['-compression_algo', 'deflate'],
+        ),
+    },
+}
+
+
+def get_image_encoder(format: str = 'PNG', compression: str | None = None) -> ImageEncoder:
+    # 形式に無い圧縮方式を指定した場合は既定値を使う (PNGとTIFFが混在したカタログファイルのため)
+    encoders = IMAGE_ENCODERS[format]
+    return encoders.get(compression) or next(iter(encoders.values()))
+
+
+def benchmark_image_encoders(frame: np.ndarray, format: str = 'PNG', repeat: int = 5) -> list[tuple[str, float, int]]:
+    # 各圧縮方式で1フレームを書き込み、(圧縮方式, 1フレームあたりの秒数, ファイルサイズ)を返す
+    results = []
+    ext = get_image_file_extension(format)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, encoder in IMAGE_ENCODERS[format].items():
+            path = Path(temp_dir) / f'{name}{ext}'
+            start_time = time.perf_counter()
+            for _ in range(repeat):
+                encoder.write(path, frame)
+            results.append((name, (time.perf_counter() - start_time) / repeat, path.stat().st_size))
+    return results
+
+
+# MARK: functions
+
+
+def get_setting_file_path(video_path: Path) -> Path:
+    return video_path.with_suffix(SETTING_EXTENSION)
+
+
+def get_catalog_file_name(video_path: Path, format: str = 'PNG') -> str:
+    return video_path.stem.removesuffix(RAW_SUFFIX) + '_' + format + '.txt'
+
+
+def get_pix_fmt(format: str) -> str:
+    return 'rgb48' if format == 'TIFF' else 'rgb24'
+
+
+def get_image_file_extension(format: str) -> str:
+    return '.tif' if format == 'TIFF' else '.png'
+
+
+def get_image_format(path: Path) -> str:
+    return 'TIFF' if path.suffix.lower() in ('.tif', '.tiff') else 'PNG'
+
+
+def get_catalog_image_format(catalog_path: Path) -> str:
+    # カタログファイルの先頭の画像ファイル、またはフレームスタックの元の画像形式を返す
+    if is_frame_stack(catalog_path):
+        return FrameStack(catalog_path).format
+    with open(catalog_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                return get_image_format(Path(line.strip()))
+    return 'PNG'
+
+
+def rotate_frame(frame: np.ndarray, rotation: int) -> np.ndarray:
+    if rotation == 90:
+        return cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+    elif rotation == 180:
+        return cv2.rotate(frame, cv2.ROTATE_180)
+    elif rotation == 270:
+        return cv2.rotate(frame, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return frame
+
+
+def rotate_crop(
+    crop: tuple[int, int, int, int], frame_size: tuple[int, int], rotation: int
+) -> tuple[int, int, int, int]:
+    # 大きさframe_size(幅, 高さ)のフレーム上の範囲(x, y, 幅, 高さ)を、rotate_frame()で回転した後の範囲にする
+    # (回転後の範囲を回転前に戻す場合は、回転後のフレームの大きさと(360 - rotation) % 360を渡す)
+    x, y, w, h = crop
+    fw, fh = frame_size
+    if rotation == 90:
+        return fh - y - h, x, h, w
+    elif rotation == 180:
+        return fw - x - w, fh - y - h, w, h
+    elif rotation == 270:
+        return y, fw - x - w, h, w
+    return crop
+
+
+def scale_frame(frame: np.ndarray, scale: float | None) -> np.ndarray:
+    if scale is None:
+        return frame
+    h, w = frame.shape[:2]
+    w, h = int(w * scale) & ~1, int(h * scale) & ~1
+    interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR_EXACT
+    return cv2.resize(frame, (w, h), interpolation=interpolation)
+
+
+def extract_video(
+    path: Path,
+    output_path: Path,
+    rotation: int = 0,
+    filter_complex: dict | None = None,
+    format: str = 'PNG',
+    scale: float | None = None,
+    max_workers: int = MAX_WORKERS,
+    segments: int = 1,
+    compression: str | None = None,
+    direct_output: bool = False,
+    frame_range: tuple[int, int] | None = None,
+    crop: tuple[int, int, int, int] | None = None,
+    step: int = 1,
+    frame_ranges: list[tuple[int, int]] | None = None,
+) -> int:
+    # 動画の全フレームを連続画像に展開して、カタログファイル(またはフレームスタック)を作成する
+    # direct_output=Trueの場合は、回転・縮小・画像の書き出しをffmpegで行う (フレームスタックには対応しない)
+    # frame_rangeを指定した場合は(開始フレーム, 終了フレーム + 1)の範囲だけを展開する (画像の番号は元の動画の番号)
+    # crop(ExtractionSetting.make_crop())とstepを指定した場合は、切り抜き・間引きをffmpegのフィルターで行う
+    # frame_ranges(動きのある範囲など)を指定した場合は、それらの範囲だけを展開する
+    video_segments = make_video_segments(path, segments, frame_range, frame_ranges)
+    if direct_output and not is_frame_stack(output_path):
+        frames = read_frames_direct(
+            path,
+            output_path,
+            rotation=rotation,
+            filter_complex=filter_complex,
+            format=format,
+            scale=scale,
+            compression=compression,
+            segments=video_segments,
+            crop=crop,
+            step=step,
+        )
+        return sum(1 for _ in frames)
+
+    def _transform(i, frame):
+        return cv2.cvtColor(scale_frame(rotate_frame(frame, rotation), scale), cv2.COLOR_RGB2BGR), i
+
+    with CatalogWriter(output_path, format, compression) as writer:
+        pipeline = Pipeline(
+            [PipelineStage('transform', _transform, TRANSFORM_WORKERS)] + make_output_stages(writer, max_workers)
+        )
+        frames = read_frames(path, filter_complex, get_pix_fmt(format), video_segments, crop, step)
+        for _ in pipeline.run(frames, ordered=False):
+            pass
+    return len(writer)
+
+
+def export_image_catalog(
+    stack_path: Path, output_path: Path, compression: str | None = None, max_workers: int = MAX_WORKERS
+) -> int:
+    # フレームスタックをTrainScannerで読み込める連続画像とカタログファイルに書き出す
+    stack = FrameStack(stack_path)
+    with CatalogWriter(output_path, stack.format, compression) as writer:
+        pipeline = Pipeline(
+            [PipelineStage('decode', lambda i, _: (stack.read(i), i), TRANSFORM_WORKERS)]
+            + make_output_stages(writer, max_workers)
+        )
+        for _ in pipeline.run(((i, None) for i in range(len(stack))), ordered=False):
+            pass
+    return len(writer)
+
+
+def make_output_stages(
+    writer: 'CatalogWriter',
+    encode_workers: int = MAX_WORKERS,
+    failures: list[int] | None = None,
+    get_name: Callable[[int], str] | None = None,
+) -> list[PipelineStage]:
+    # エンコード→書き込みの段を作る
+    # 前段から(BGRのフレーム, 後段に渡す値)を受け取り、書き込み後に「後段に渡す値」を出力する
+    # failuresを指定した場合は、書き込みに失敗したフレームの番号を追加して処理を続ける
+    # get_nameはフレーム番号から画像ファイル名(拡張子を除く)を返す関数
+    def _encode(i, value):
+        frame, payload = value
+        try:
+            return writer.encode(frame), payload
+        except (IOError, ValueError) as e:
+            if failures is None:
+                raise
+            logger.error(f'frame {i + 1}: {e}')
+            failures.append(i)
+            return None, payload
+
+    def _write(i, value):
+        encoded, payload = value
+        if encoded is None:
+            return payload
+        try:
+            writer.write_encoded(i, encoded, get_name(i) if get_name else None)
+        except (IOError, ValueError) as e:
+            if failures is None:
+                raise
+            logger.error(f'frame {i + 1}: {e}')
+            failures.append(i)
+        return payload
+
+    return [
+        PipelineStage('encode', _encode, encode_workers),
+        PipelineStage('write', _write, WRITE_WORKERS),
+    ]
+
+
+def write_catalog(output_path: Path, indexed_filenames: dict[int, str]):
+    with open(output_path, 'w') as f:
+        for i in sorted(indexed_filenames.keys()):
+            f.write(indexed_filenames[i] + '\n')
+
+
+# MARK: catalog writer
+class CatalogWriter:
+    # 連続画像とカタログファイル、または(出力先の拡張子が.stackの場合は)フレームスタックに書き込む
+    # write()は複数のスレッドからフレーム番号の順不同で呼び出せる
+    # パイプラインで使う場合は、encode()とwrite_encoded()を別の段で呼び出す
+
+    def __init__(self, output_path: Path, format: str = 'PNG', compression: str | None = None):
+        self.output_path = output_path
+        self.__indexed_filenames: dict[int, str] = {}
+        self.__closed = False
+        if is_frame_stack(output_path):
+            self.__stack_writer = FrameStackWriter(output_path, format, compression)
+        else:
+            self.__stack_writer = None
+            self.__output_dir = Path(output_path.stem)
+            os.makedirs(output_path.parent / self.__output_dir, exist_ok=True)
+            self.__image_file_ext = get_image_file_extension(format)
+            self.__encoder = get_image_encoder(format, compression)
+
+    def __len__(self):
+        return len(self.__indexed_filenames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, index: int, frame: np.ndarray, name: str | None = None):
+        # frameはBGR(BGR48)のフレーム
+        self.write_encoded(index, self.encode(frame), name)
+
+    def encode(self, frame: np.ndarray):
+        if self.__stack_writer:
+            return self.__stack_writer.encode(frame)
+        return self.__encoder.encode(frame, self.__image_file_ext)
+
+    def write_encoded(self, index: int, encoded, name: str | None = None):
+        # nameは拡張子を除いた画像ファイル名 (省略時はフレーム番号から付ける)
+        image_filename = name or f'f{index + 1:05d}'
+        if self.__stack_writer:
+            self.__stack_writer.write_encoded(index, encoded)
+        else:
+            image_filename = str(self.__output_dir / (image_filename + self.__image_file_ext))
+            with open(self.output_path.parent / image_filename, 'wb') as f:
+                f.write(encoded)
+        self.__indexed_filenames[index] = image_filename
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        if self.__stack_writer:
+            self.__stack_writer.close()
+        else:
+            write_catalog(self.output_path, self.__indexed_filenames)
+
+
+# MARK: segmented decoding
+
+
+class VideoSegment(BaseModel):
+    start: int  # 先頭フレームの番号
+    count: int  # フレーム数
+    ss: float
+    to: float | None = None
+
+    def frame_numbers(self, step: int = 1) -> range:
+        # 動画の先頭からNフレームごとに間引いた場合に、この区間で残るフレームの番号
+        return range(self.start + (-self.start % step), self.start + self.count, step)
+
+
+def make_segments(path: Path, n_segments: int, frame_range: tuple[int, int] | None = None) -> list[VideoSegment]:
+    # 動画をキーフレームの位置でn_segments個の区間に分割する
+    # frame_rangeを指定した場合は、(開始フレーム, 終了フレーム + 1)の範囲だけを分割する
+    index = load_packet_index(path)
+    n = index.n_frames
+    start, end = (0, n) if frame_range is None else (max(0, frame_range[0]), min(frame_range[1], n))
+    keyframes = [k for k in index.keyframes if start < k < end]
+    if n_segments <= 1 or not keyframes or start >= end:
+        to = index.seek_time(end) if end < n else None
+        return [VideoSegment(start=start, count=max(0, end - start), ss=index.seek_time(start), to=to)]
+    targets = [start + (end - start) * j // n_segments for j in range(1, n_segments)]
+    bounds = sorted({start} | {min(keyframes, key=lambda k: abs(k - t)) for t in targets})
+    segments = []
+    for b, e in zip(bounds, bounds[1:] + [end]):
+        # シーク位置がキーフレームの表示時刻を越えないように、直前のフレームとの中間を指定する
+        to = index.seek_time(e) if e < n else None
+        segments.append(VideoSegment(start=b, count=e - b, ss=index.seek_time(b), to=to))
+    logger.debug(f'{segments=}')
+    return segments
+
+
+def make_video_segments(
+    path: Path,
+    segments: int = 1,
+    frame_range: tuple[int, int] | None = None,
+    frame_ranges: list[tuple[int, int]] | None = None,
+) -> list[VideoSegment] | None:
+    # 並列デコードの区間を返す (分割せずに動画全体を読み込む場合はNone)
+    # frame_rangesを指定した場合は、各範囲(frame_rangeと重なる部分)をそれぞれ分割する (範囲が無い場合は空のリスト)
+    if frame_ranges is not None:
+        start, end = frame_range or (0, load_packet_index(path).n_frames)
+        ranges = [(max(b, start), min(e, end)) for b, e in frame_ranges if max(b, start) < min(e, end)]
+        return [i for r in ranges for i in make_segments(path, min(segments, MAX_SEGMENTS), r)]
+    if segments <= 1 and frame_range is None:
+        return None
+    return make_segments(path, min(segments, MAX_SEGMENTS), frame_range)
+
+
+def read_frames(
+    path: Path,
+    filter_complex: dict | None = None,
+    pix_fmt: str = 'rgb24',
+    segments: list[VideoSegment] | None = None,
+    crop: tuple[int, int, int, int] | None = None,
+    step: int = 1,
+) -> Iterator[tuple[int, np.ndarray]]:
+    # (フレーム番号, フレーム)を返す
+    # 複数の区間を指定した場合は区間ごとにFrameReaderを並行して動かすので、フレーム番号の順序は保証されない
+    # step>1の場合は動画の先頭からNフレームごとのフレームだけを返す (フレーム番号は元の動画の番号)
+    # FrameReaderは固定フレームレートで出力する(可変フレームレートの動画ではフレームを複製する)ので使わない
+    # 切り抜き・間引きはffmpegで行い、残したフレームだけをパイプで受け取る
+    filters = make_filter_graph(filter_complex, crop=crop)
+    frame_size = get_output_frame_size(path, crop=crop)
+
+    def _open_reader(segment: VideoSegment | None):
+        return CroppedFrameReader(path, filters, frame_size, pix_fmt, segment, step)
+
+    yield from _read_segments(_open_reader, segments, step)
+
+
+def _read_segments(
+    open_reader: Callable, segments: list[VideoSegment] | None, step: int = 1
+) -> Iterator[tuple[int, np.ndarray]]:
+    # open_reader(区間)はframes()を持つリーダーを返す (区間を分割しない場合はNoneを渡す)
+    # step>1の場合、リーダーはVideoSegment.frame_numbers(step)のフレームだけを返すこと
+    # 同時に読み込む区間はMAX_SEGMENTSまで (飛び飛びの範囲を展開する場合は区間が多くなる)
+    if segments is not None and not segments:
+        return
+    if not segments or len(segments) == 1:
+        segment = segments[0] if segments else None
+        if segment and segment.start == 0 and segment.to is None:
+            # 動画全体の場合は、索引のフレーム数で打ち切らずに最後まで読み込む
+            segment = None
+        numbers = segment.frame_numbers(step) if segment else None
+        with open_reader(segment) as reader:
+            for count, frame in enumerate(reader.frames()):
+                if numbers is None:
+                    yield count * step, frame
+                elif count < len(numbers):
+                    yield numbers[count], frame
+                else:
+                    break
+        return
+
+    frame_queue = queue.Queue(maxsize=len(segments) * 2)
+    stop = threading.Event()
+    slots = threading.Semaphore(MAX_SEGMENTS)
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _read_segment(segment: VideoSegment):
+        try:
+            count = 0
+            numbers = segment.frame_numbers(step)
+            with slots:
+                if stop.is_set():
+                    return
+                with open_reader(segment) as reader:
+                    for frame in reader.frames():
+                        if count >= len(numbers) or stop.is_set():
+                            break
+                        _put((numbers[count], frame))
+                        count += 1
+            if count < len(numbers) and not stop.is_set():
+                logger.warning(f'segment {segment.start}: {count}/{len(numbers)} frames')
+        except Exception as e:
+            _put(e)
+        finally:
+            _put(None)
+
+    threads = [threading.Thread(target=_read_segment, args=(segment,), daemon=True) for segment in segments]
+    for th in threads:
+        th.start()
+    try:
+        running = len(threads)
+        while running:
+            item = frame_queue.get()
+            if item is None:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        for th in threads:
+            th.join()
+
+
+# MARK: direct output
+
+
+def get_output_frame_size(
+    path: Path, rotation: int = 0, scale: float | None = None, crop: tuple[int, int, int, int] | None = None
+) -> tuple[int, int]:
+    # 切り抜き・回転・縮小後のフレームの(幅, 高さ)を返す (rotate_frame()とscale_frame()の結果と同じ)
+    if crop is not None:
+        w, h = crop[2:]
+    else:
+        probe = Probe(str(path))
+        w, h = (probe.height, probe.width) if probe.rotation % 180 else (probe.width, probe.height)
+    if rotation in (90, 270):
+        w, h = h, w
+    if scale is not None:
+        w, h = int(w * scale) & ~1, int(h * scale) & ~1
+    return w, h
+
+
+def make_filter_graph(
+    filter_complex: dict | None,
+    rotation: int = 0,
+    size: tuple[int, int] | None = None,
+    scale: float | None = None,
+    crop: tuple[int, int, int, int] | None = None,
+) -> list[str]:
+    # ExtractionSetting.make_filter_complex()のフィルターと切り抜き・回転・縮小をffmpegのフィルターの文字列にする
+    # 切り抜きは色調整より前に行う (色調整するピクセル数を減らす)
+    filters = ['crop={}:{}:{}:{}:exact=1'.format(*crop[2:], *crop[:2])] if crop is not None else []
+    filters += [
+        name + '=' + ':'.join(f'{k}={v}' for k, v in params.items()) for name, params in (filter_complex or {}).items()
+    ]
+    if rotation == 90:
+        filters.append('transpose=clock')
+    elif rotation == 180:
+        filters += ['hflip', 'vflip']
+    elif rotation == 270:
+        filters.append('transpose=cclock')
+    if scale is not None and size is not None:
+        filters.append(f'scale={size[0]}:{size[1]}:flags={"area" if scale < 1.0 else "bilinear"}')
+    return filters
+
+
+class ThumbnailReader:
+    # ffmpegでサムネイルの大きさに縮小したrgb24のフレームをパイプで受け取る (FrameReaderと同じくframes()で読み出す)
+    # step>1の場合はNフレームごとに、keyframes_only=Trueの場合はキーフレームだけをデコードする
+
+    dtype = np.uint8
+
+    def __init__(
+        self,
+        path: Path,
+        filters: list[str],
+        thumbnail_size: tuple[int, int],
+        segment: VideoSegment | None = None,
+        step: int = 1,
+        keyframes_only: bool = False,
+    ):
+        self.thumbnail_size = thumbnail_size
+        args = ['ffmpeg', '-v', 'error', '-nostdin']
+        if keyframes_only:
+            args += ['-skip_frame', 'nokey']
+        if segment and segment.ss:
+            args += ['-ss', str(segment.ss)]
+        if segment and segment.to is not None:
+            args += ['-to', str(segment.to)]
+        args += ['-i', str(path)]
+        frames = ['-frames:v', str(len(segment.frame_numbers(step)))] if segment else []
+        if step > 1:
+            # 区間の先頭ではなく動画の先頭からNフレームごとに選ぶ
+            filters = [f'select=not(mod(n+{segment.start if segment else 0}\\,{step}))'] + filters
+        # rawvideo・image2は固定フレームレートで出力するので、可変フレームレートの動画や間引いたフレームの間を
+        # 複製したフレームで埋めないようにする (出力するフレームの番号をパケットの索引の番号と一致させる)
+        frames += ['-fps_mode', 'passthrough']
+        args += self._make_output_args(filters, frames)
+        logger.debug(f'{args=}')
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.__closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _make_output_args(self, filters: list[str], frames: list[str]) -> list[str]:
+        tw, th = self.thumbnail_size
+        graph = f'[0:v]{",".join(filters + [f"scale={tw}:{th}:flags=area"])}[thumb]'
+        return ['-filter_complex', graph, '-map', '[thumb]', *frames, '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:']
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        self.process.stdout.close()
+        if self.process.poll() is None:
+            # 途中で中断した場合は書き出しも止める
+            self.process.terminate()
+        self.process.wait()
+
+    def frames(self) -> Iterator[np.ndarray]:
+        tw, th = self.thumbnail_size
+        size = tw * th * 3 * np.dtype(self.dtype).itemsize
+        while len(data := self.process.stdout.read(size)) == size:
+            yield np.frombuffer(data, self.dtype).reshape(th, tw, 3)
+        if self.process.wait() != 0:
+            raise RuntimeError(f'ffmpeg exited with code {self.process.returncode}')
+
+
+class CroppedFrameReader(ThumbnailReader):
+    # フィルター(切り抜き・間引きを含む)を適用したフレームを縮小せずにパイプで受け取る (FrameReaderの代わりに使う)
+    # frame_sizeはフィルターを適用した後の(幅, 高さ)
+
+    def __init__(
+        self,
+        path: Path,
+        filters: list[str],
+        frame_size: tuple[int, int],
+        pix_fmt: str = 'rgb24',
+        segment: VideoSegment | None = None,
+        step: int = 1,
+    ):
+        self.pix_fmt = 'rgb48le' if pix_fmt == 'rgb48' else pix_fmt
+        self.dtype = np.dtype('<u2') if self.pix_fmt == 'rgb48le' else np.uint8
+        super().__init__(path, filters, frame_size, segment, step)
+
+    def _make_output_args(self, filters: list[str], frames: list[str]) -> list[str]:
+        graph = f'[0:v]{",".join(filters or ["null"])}[out]'
+        return ['-filter_complex', graph, '-map', '[out]', *frames, '-f', 'rawvideo', '-pix_fmt', self.pix_fmt, 'pipe:']
+
+
+class DirectOutputReader(ThumbnailReader):
+    # ffmpegのフィルターグラフを分岐し、フル解像度のフレームはimage2で画像ファイルに直接書き出して、
+    # サムネイルに縮小したフレームだけをパイプで受け取る
+
+    def __init__(
+        self,
+        path: Path,
+        output_dir: Path,
+        filters: list[str],
+        thumbnail_size: tuple[int, int],
+        format: str = 'PNG',
+        compression: str | None = None,
+        segment: VideoSegment | None = None,
+        step: int = 1,
+    ):
+        self.output_dir = output_dir
+        self.format = format
+        self.compression = compression
+        self.step = step
+        self.first = segment.frame_numbers(step).start if segment else 0
+        self.start_number = self.first + 1
+        self.count = 0
+        super().__init__(path, filters, thumbnail_size, segment, step)
+
+    def _make_output_args(self, filters: list[str], frames: list[str]) -> list[str]:
+        tw, th = self.thumbnail_size
+        graph = f'[0:v]{",".join(filters + ["split=2"])}[full][t];[t]scale={tw}:{th}:flags=area[thumb]'
+        args = ['-filter_complex', graph, '-map', '[full]', *frames, '-start_number', str(self.start_number)]
+        args += ['-pix_fmt', 'rgb48le' if self.format == 'TIFF' else 'rgb24']
+        args += get_image_encoder(self.format, self.compression).ffmpeg_args
+        args += ['-y', str(self.output_dir / ('f%05d' + get_image_file_extension(self.format)))]
+        args += ['-map', '[thumb]', *frames, '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:']
+        return args
+
+    def close(self):
+        super().close()
+        if self.step > 1:
+            self.__rename_images()
+
+    def frames(self) -> Iterator[np.ndarray]:
+        for frame in super().frames():
+            self.count += 1
+            yield frame
+
+    def __rename_images(self):
+        # image2は連番で書き出すので、間引いた場合は元の動画のフレーム番号のファイル名に付け直す
+        # (番号の大きい方から付け直すと、まだ付け直していないファイルを上書きしない)
+        ext = get_image_file_extension(self.format)
+        for k in range(self.count - 1, 0, -1):
+            src = self.output_dir / f'f{self.start_number + k:05d}{ext}'
+            if src.exists():
+                os.replace(src, self.output_dir / f'f{self.start_number + k * self.step:05d}{ext}')
+
+
+def get_thumbnail_size(path: Path, thumbnail_height: int, rotation: int = 0) -> tuple[int, int]:
+    w, h = get_output_frame_size(path, rotation)
+    return (w * thumbnail_height) // h, thumbnail_height
+
+
+def read_thumbnails(
+    path: Path,
+    thumbnail_height: int,
+    rotation: int = 0,
+    filter_complex: dict | None = None,
+    step: int = 1,
+    keyframes_only: bool = False,
+) -> Iterator[tuple[int, np.ndarray]]:
+    # プレビュー用に、サムネイルの大きさでデコードした(フレーム番号, サムネイル)を返す
+    # 間引いてデコードした場合のフレーム番号は元の動画の番号 (飛び飛びになる)
+    thumbnail_size = get_thumbnail_size(path, thumbnail_height, rotation)
+    keyframes = load_packet_index(path).keyframes if keyframes_only else None
+    with ThumbnailReader(
+        path, make_filter_graph(filter_complex, rotation), thumbnail_size, step=step, keyframes_only=keyframes_only
+    ) as reader:
+        count = 0
+        for i, frame in enumerate(reader.frames()):
+            if keyframes is None:
+                yield i * max(1, step), frame
+            elif i < len(keyframes):
+                yield keyframes[i], frame
+            else:
+                raise RuntimeError(f'more keyframes decoded than indexed: {path}')
+            count += 1
+        if keyframes is not None and count != len(keyframes):
+            raise RuntimeError(f'{count} keyframes decoded, {len(keyframes)} indexed: {path}')
+
+
+def read_thumbnail(path: Path, thumbnail_size: tuple[int, int], filters: list[str], ss: float) -> np.ndarray | None:
+    # ssの位置の1フレームだけをサムネイルの大きさでデコードする (動画全体の粗いサムネイルの先読み用)
+    with ThumbnailReader(path, filters, thumbnail_size, VideoSegment(start=0, count=1, ss=ss)) as reader:
+        return next(reader.frames(), None)
+
+
+def coarse_to_fine_order(count: int) -> Iterator[int]:
+    # 0..count-1を、全体から等間隔に間引いたものから順に細かくなるように返す
+    # (例: count=8の場合は 0, 4, 2, 6, 1, 3, 5, 7)
+    stride = 1
+    while stride * 2 < count:
+        stride *= 2
+    yield from range(0, count, stride)
+    while stride > 1:
+        yield from range(stride // 2, count, stride)
+        stride //= 2
+
+
+def read_frames_direct(
+    path: Path,
+    output_path: Path,
+    thumbnail_height: int = DIRECT_OUTPUT_THUMBNAIL_HEIGHT,
+    rotation: int = 0,
+    filter_complex: dict | None = None,
+    format: str = 'PNG',
+    scale: float | None = None,
+    compression: str | None = None,
+    segments: list[VideoSegment] | None = None,
+    crop: tuple[int, int, int, int] | None = None,
+    step: int = 1,
+) -> Iterator[tuple[int, np.ndarray]]:
+    # フル解像度のフレームをffmpegが連続画像(fNNNNN)に直接書き出し、(フレーム番号, サムネイル)を返す
+    # 終了時(中断した場合も)に書き出し済みの画像ファイルのカタログファイルを作成する (フレームスタックには対応しない)
+    # step>1の場合も、画像ファイルの番号は元の動画のフレーム番号
+    if is_frame_stack(output_path):
+        raise ValueError('direct output does not support frame stacks')
+    output_dir = Path(output_path.stem)
+    os.makedirs(output_path.parent / output_dir, exist_ok=True)
+    ext = get_image_file_extension(format)
+    size = get_output_frame_size(path, rotation, scale, crop)
+    thumbnail_size = ((size[0] * thumbnail_height) // size[1], thumbnail_height)
+    filters = make_filter_graph(filter_complex, rotation, size, scale, crop)
+
+    def _open_reader(segment: VideoSegment | None):
+        return DirectOutputReader(
+            path, output_path.parent / output_dir, filters, thumbnail_size, format, compression, segment, step
+        )
+
+    indices = []
+    frames = _read_segments(_open_reader, segments, step)
+    try:
+        for i, frame in frames:
+            indices.append(i)
+            yield i, frame
+    finally:
+        # 中断した場合も、リーダーを閉じて(画像ファイルの名前を付け直して)からカタログファイルを作成する
+        frames.close()
+        image_filenames = {i: str(output_dir / f'f{i + 1:05d}{ext}') for i in indices}
+        write_catalog(
+            output_path,
+            {i: name for i, name in image_filenames.items() if (output_path.parent / name).exists()},
+        )
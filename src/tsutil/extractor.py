@@ -6,26 +6,45 @@ from .common import (
     make_file_picker_ctrl,
     MOVIE_FILE_WILDCARD,
     IMAGE_CATALOG_FILE_WILDCARD,
+    FRAME_STACK_FILE_WILDCARD,
     get_path,
     path_exists,
     get_spin_ctrl_value,
+    Rect,
 )
 from .tool_frame import ToolFrame
-from .components.video_thumbnail import VideoThumbnail, EVT_VIDEO_LOADED, EVT_VIDEO_POSITION_CHANGED
-from .components.image_viewer import ImageViewer, EVT_MOUSE_OVER_IMAGE
-from .components.histogram_view import HistogramView
+from .components.video_thumbnail import (
+    VideoThumbnail,
+    EVT_VIDEO_LOADED,
+    EVT_VIDEO_POSITION_CHANGED,
+    EVT_VIDEO_RANGE_CHANGED,
+)
+from .components.image_viewer import EVT_MOUSE_OVER_IMAGE
+from .components.range_image_viewer import RangeImageViewer, EVT_FIELD_SELECTED
+from .components.histogram_view import HistogramView, PREVIEW_SAMPLE_PIXELS
+from .extraction import (
+    ExtractionSetting,
+    IMAGE_ENCODERS,
+    MAX_SEGMENTS,
+    get_setting_file_path,
+    get_catalog_file_name,
+    rotate_frame,
+    rotate_crop,
+)
+from .frame_stack import FRAME_STACK_EXTENSION, STACK_COMPRESSIONS
+from .motion_gate import compute_motion_scores, detect_motion_ranges, scale_roi
+from .preview_decoder import PreviewDecoder
+from .color_filters import apply_filter_complex, get_color_matrix_name
+from .trimming import probe_video_stream
 from fffio import Probe
-import ffmpeg
-import numpy as np
-import cv2
-import json
 
 # MARK: constants
 
 MARGIN = 10
 TOOL_NAME = '動画から連続画像の展開'
-SETTING_EXTENSION = '.extract.json'
-RAW_SUFFIX = '_RAW'
+COLOR_PREVIEW_DELAY = 0.1  # 色調整の値を変更してからプレビューを更新するまでの時間(秒)
+MAX_FRAME_STEP = 60
+MAX_MOTION_ROLL = 600  # 動きの前後に残すフレーム数の上限
 
 
 # MARK: main window
@@ -33,8 +52,13 @@ class MainFrame(ToolFrame):
     def __init__(self, parent: wx.Window | None = None, *args, **kw):
         super().__init__(parent, title=TOOL_NAME, *args, **kw)
         self.probe = None
+        self.color_matrix = get_color_matrix_name(None)  # プレビューの色調整でYUVと変換する色空間
+        self.preview_decoder = PreviewDecoder()
         self.frame = None
         self.rotation = 0
+        self.crop = None  # 切り抜く範囲 (回転前のフレームの(x, y, 幅, 高さ))
+        self.loaded_rotation = 0  # 入力動画のサムネイルを読み込んだときの回転
+        self.motion_scores = None  # 入力動画のサムネイルから求めた各フレームの動きの大きさ
 
         frame_sizer = wx.GridSizer(rows=1, cols=1, gap=wx.Size(0, 0))
         panel = wx.Panel(self)
@@ -66,10 +90,16 @@ class MainFrame(ToolFrame):
         input_video_sizer = wx.FlexGridSizer(cols=1, gap=wx.Size(0, 0))
         input_video_sizer.AddGrowableCol(0)
         input_video_sizer.Add(
-            wx.StaticText(input_video_panel, label='赤い▲をドラッグして、画像のフレームを指定できます。'),
+            wx.StaticText(
+                input_video_panel,
+                label='赤い▲をドラッグして、画像のフレームを指定できます。赤いバーで展開する範囲を指定できます。',
+            ),
             flag=wx.ALIGN_CENTER,
         )
-        self.input_video_thumbnail = VideoThumbnail(input_video_panel, use_x_arrow=True)
+        # 動きの検出にサムネイル全体を使うので、中央の幅に切り詰めない
+        self.input_video_thumbnail = VideoThumbnail(
+            input_video_panel, use_range_bar=True, use_x_arrow=True, keep_full_width=True
+        )
         input_video_sizer.Add(self.input_video_thumbnail, flag=wx.EXPAND)
         input_video_panel.SetSizerAndFit(input_video_sizer)
         sizer.Add(input_video_panel, flag=wx.EXPAND | wx.BOTTOM, border=MARGIN)
@@ -80,7 +110,8 @@ class MainFrame(ToolFrame):
         preview_sizer = wx.FlexGridSizer(rows=1, cols=2, gap=wx.Size(MARGIN, 0))
         preview_sizer.AddGrowableCol(0)
         preview_sizer.AddGrowableRow(0)
-        self.previewer = ImageViewer(preview_panel)
+        self.previewer = RangeImageViewer(preview_panel)
+        self.previewer.SetCursor(wx.Cursor(wx.CURSOR_CROSS))
         preview_sizer.Add(self.previewer, flag=wx.EXPAND)
         control_panel = self.__make_control_panel(preview_panel)
         preview_sizer.Add(control_panel, flag=wx.EXPAND)
@@ -127,7 +158,9 @@ class MainFrame(ToolFrame):
 
         self.input_video_thumbnail.Bind(EVT_VIDEO_LOADED, self.__on_video_loaded)
         self.input_video_thumbnail.Bind(EVT_VIDEO_POSITION_CHANGED, self.__on_video_position_changed)
+        self.input_video_thumbnail.Bind(EVT_VIDEO_RANGE_CHANGED, self.__on_video_range_changed)
         self.previewer.Bind(EVT_MOUSE_OVER_IMAGE, self.__on_mouse_over_image)
+        self.previewer.Bind(EVT_FIELD_SELECTED, self.__on_field_selected)
         self.Bind(wx.EVT_CLOSE, self.__on_close)
 
     def __make_control_panel(self, parent):
@@ -212,6 +245,63 @@ class MainFrame(ToolFrame):
         sizer.Add(rotation_panel, flag=wx.EXPAND | wx.BOTTOM, border=MARGIN)
         row += 1
 
+        # crop and frame step
+        crop_panel = wx.Panel(panel)
+        crop_sizer = wx.FlexGridSizer(cols=4, gap=wx.Size(4, 0))
+        crop_sizer.AddGrowableCol(1)
+        self.crop_button = wx.CheckBox(crop_panel, label='切り抜き:')
+        self.crop_button.SetToolTip(
+            'プレビューをドラッグして切り抜く範囲を指定します。切り抜きはffmpegで行うので、展開が速くなります。'
+        )
+        self.crop_button.Bind(wx.EVT_CHECKBOX, self.__on_crop_changed)
+        crop_sizer.Add(self.crop_button, flag=wx.ALIGN_CENTER_VERTICAL)
+        self.crop_text = wx.StaticText(crop_panel, label='', style=wx.ST_NO_AUTORESIZE)
+        crop_sizer.Add(self.crop_text, flag=wx.EXPAND | wx.RIGHT, border=MARGIN)
+        crop_sizer.Add(wx.StaticText(crop_panel, label='フレーム間隔:'), flag=wx.ALIGN_CENTER_VERTICAL)
+        self.frame_step_spin = wx.SpinCtrl(
+            crop_panel, value='1', min=1, max=MAX_FRAME_STEP, style=wx.SP_ARROW_KEYS | wx.ALIGN_RIGHT
+        )
+        self.frame_step_spin.SetToolTip('Nフレームごとに展開します。間引きはffmpegで行います。')
+        crop_sizer.Add(self.frame_step_spin, flag=wx.ALIGN_CENTER_VERTICAL)
+        crop_panel.SetSizerAndFit(crop_sizer)
+        sizer.Add(crop_panel, flag=wx.EXPAND | wx.BOTTOM, border=MARGIN)
+        row += 1
+
+        # motion gate
+        motion_panel = wx.Panel(panel)
+        motion_sizer = wx.FlexGridSizer(cols=8, gap=wx.Size(4, 0))
+        motion_sizer.AddGrowableCol(7)
+        self.motion_gate_button = wx.CheckBox(motion_panel, label='動きのある範囲だけ展開')
+        self.motion_gate_button.SetToolTip(
+            '列車の通過前後の動きの無いフレームを展開しません。切り抜きを指定した場合は、その範囲で動きを判定します。'
+        )
+        motion_sizer.Add(self.motion_gate_button, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
+        motion_sizer.Add(wx.StaticText(motion_panel, label='しきい値(%):'), flag=wx.ALIGN_CENTER_VERTICAL)
+        self.motion_threshold = wx.SpinCtrlDouble(
+            motion_panel, value='1.00', min=0.01, max=100.0, inc=0.1, style=wx.SP_ARROW_KEYS | wx.ALIGN_RIGHT
+        )
+        self.motion_threshold.SetToolTip(
+            '直前のフレームから変化したピクセルの割合がこの値を超えると、動きがあるとみなします。'
+        )
+        motion_sizer.Add(self.motion_threshold, flag=wx.ALIGN_CENTER_VERTICAL)
+        motion_sizer.Add(wx.StaticText(motion_panel, label='前:'), flag=wx.ALIGN_CENTER_VERTICAL)
+        self.motion_pre_roll = wx.SpinCtrl(
+            motion_panel, value='30', min=0, max=MAX_MOTION_ROLL, style=wx.SP_ARROW_KEYS | wx.ALIGN_RIGHT
+        )
+        self.motion_pre_roll.SetToolTip('動きの前に残すフレーム数')
+        motion_sizer.Add(self.motion_pre_roll, flag=wx.ALIGN_CENTER_VERTICAL)
+        motion_sizer.Add(wx.StaticText(motion_panel, label='後:'), flag=wx.ALIGN_CENTER_VERTICAL)
+        self.motion_post_roll = wx.SpinCtrl(
+            motion_panel, value='30', min=0, max=MAX_MOTION_ROLL, style=wx.SP_ARROW_KEYS | wx.ALIGN_RIGHT
+        )
+        self.motion_post_roll.SetToolTip('動きの後に残すフレーム数')
+        motion_sizer.Add(self.motion_post_roll, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
+        self.motion_text = wx.StaticText(motion_panel, label='', style=wx.ST_NO_AUTORESIZE)
+        motion_sizer.Add(self.motion_text, flag=wx.EXPAND)
+        motion_panel.SetSizerAndFit(motion_sizer)
+        sizer.Add(motion_panel, flag=wx.EXPAND | wx.BOTTOM, border=MARGIN)
+        row += 1
+
         # color adjustment
         color_adjustment_panel = wx.Panel(panel)
         color_adjustment_sizer = wx.FlexGridSizer(cols=2, gap=wx.Size(4, MARGIN - 6))
@@ -356,14 +446,40 @@ class MainFrame(ToolFrame):
         sizer.Add(line, flag=wx.EXPAND | wx.BOTTOM, border=MARGIN)
         row += 1
         output_panel = wx.Panel(panel)
-        output_sizer = wx.FlexGridSizer(cols=4, gap=wx.Size(MARGIN, 0))
+        output_sizer = wx.FlexGridSizer(cols=10, gap=wx.Size(MARGIN, 0))
         self.format_png_button = wx.RadioButton(output_panel, label='24bit PNG', style=wx.RB_GROUP)
         self.format_png_button.SetValue(True)
         output_sizer.Add(self.format_png_button, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
         self.format_tiff_button = wx.RadioButton(output_panel, label='48bit TIFF')
         output_sizer.Add(self.format_tiff_button, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
+        self.format_png_button.Bind(wx.EVT_RADIOBUTTON, self.__on_format_changed)
+        self.format_tiff_button.Bind(wx.EVT_RADIOBUTTON, self.__on_format_changed)
+        self.frame_stack_button = wx.CheckBox(output_panel, label='フレームスタック')
+        self.frame_stack_button.SetToolTip(
+            '連続画像を1つのファイル(.stack)にまとめて保存します。補正・分割画面で読み込むことができます。'
+        )
+        self.frame_stack_button.Bind(wx.EVT_CHECKBOX, self.__on_format_changed)
+        output_sizer.Add(self.frame_stack_button, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
+        output_sizer.Add(wx.StaticText(output_panel, label='圧縮:'), flag=wx.ALIGN_CENTER_VERTICAL)
+        self.compression_selector = wx.Choice(output_panel)
+        self.compression_selector.SetToolTip(
+            'TrainScannerで読み込むだけの中間ファイルには、無圧縮を選ぶと書き込みが速くなります。'
+        )
+        output_sizer.Add(self.compression_selector, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
+        self.direct_output_button = wx.CheckBox(output_panel, label='ffmpegで直接書き出す')
+        self.direct_output_button.SetToolTip(
+            '回転・縮小・画像の書き出しをffmpegで行い、サムネイルだけを受け取ります。フレームスタックには使えません。'
+        )
+        output_sizer.Add(self.direct_output_button, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
+        self.__reset_compression_selector()
         self.scale_half_button = wx.CheckBox(output_panel, label='1/2に縮小')
         output_sizer.Add(self.scale_half_button, flag=wx.ALIGN_CENTER_VERTICAL, border=MARGIN)
+        output_sizer.Add(wx.StaticText(output_panel, label='並列デコード数:'), flag=wx.ALIGN_CENTER_VERTICAL)
+        self.segments_spin = wx.SpinCtrl(
+            output_panel, value='1', min=1, max=MAX_SEGMENTS, style=wx.SP_ARROW_KEYS | wx.ALIGN_RIGHT
+        )
+        self.segments_spin.SetToolTip('動画をキーフレーム位置で分割して、複数のffmpegで並行してデコードします。')
+        output_sizer.Add(self.segments_spin, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
         save_button = wx.Button(output_panel, label='連続画像とカタログファイルを作成する...')
         save_button.Bind(wx.EVT_BUTTON, self.__on_save_button_clicked)
         output_sizer.Add(save_button, flag=wx.ALIGN_CENTER_VERTICAL | wx.ALIGN_CENTER)
@@ -398,6 +514,14 @@ class MainFrame(ToolFrame):
         self.huesaturation_intensity.Bind(wx.EVT_TEXT, self.__on_color_adjustment_changed)
         self.huesaturation_intensity.Bind(wx.EVT_SPINCTRLDOUBLE, self.__on_color_adjustment_changed)
 
+        self.motion_gate_button.Bind(wx.EVT_CHECKBOX, self.__on_motion_gate_changed)
+        self.motion_threshold.Bind(wx.EVT_TEXT, self.__on_motion_gate_changed)
+        self.motion_threshold.Bind(wx.EVT_SPINCTRLDOUBLE, self.__on_motion_gate_changed)
+        self.motion_pre_roll.Bind(wx.EVT_TEXT, self.__on_motion_gate_changed)
+        self.motion_pre_roll.Bind(wx.EVT_SPINCTRL, self.__on_motion_gate_changed)
+        self.motion_post_roll.Bind(wx.EVT_TEXT, self.__on_motion_gate_changed)
+        self.motion_post_roll.Bind(wx.EVT_SPINCTRL, self.__on_motion_gate_changed)
+
         reload_button.Bind(wx.EVT_BUTTON, self.__on_reload_button_clicked)
 
         panel.SetSizerAndFit(sizer)
@@ -409,33 +533,20 @@ class MainFrame(ToolFrame):
             return
         self.SetCursor(wx.Cursor(wx.CURSOR_WAIT))
         try:
-            stream = ffmpeg.input(path, ss=position / self.probe.fps).video
-            if filter_complex:
-                for k, v in filter_complex.items():
-                    if type(v) is dict:
-                        stream = stream.filter_(k, **v)
-                    elif type(v) is list or type(v) is tuple:
-                        stream = stream.filter_(k, *v)
-                    else:
-                        stream = stream.filter_(k, v)
-            out, err = (
-                stream.output('pipe:', format='rawvideo', pix_fmt='rgb24', loglevel='error', **{'frames:v': 1})
-                .overwrite_output()
-                .run(capture_stdout=True, capture_stderr=True)
-            )
-            if not len(out):
-                wx.MessageBox(f'画像の取り出しに失敗しました:\n{err}', TOOL_NAME, wx.OK | wx.ICON_ERROR)
-                return
-            w, h = (
-                (self.probe.height, self.probe.width)
-                if self.probe.rotation % 180
-                else (self.probe.width, self.probe.height)
-            )
-            self.frame = np.frombuffer(out, np.uint8).reshape(h, w, 3)
+            try:
+                # デコード済みの無調整フレームに色調整フィルターを適用する (ffmpegの再実行が不要)
+                self.frame = apply_filter_complex(
+                    self.preview_decoder.read_frame(position),
+                    filter_complex,
+                    self.color_matrix,
+                )
+            except ValueError:
+                self.frame = self.preview_decoder.read_frame(position, filter_complex)
             frame = self.__rotate_frame(self.frame)
             self.previewer.set_image(frame)
+            self.__update_crop_view()
             self.image_histogram_view.begin_histogram()
-            self.image_histogram_view.add_histogram(self.frame)
+            self.image_histogram_view.add_histogram(self.frame, PREVIEW_SAMPLE_PIXELS)
             self.image_histogram_view.end_histogram()
             self.image_histogram_view.update_view()
         except Exception as e:
@@ -444,13 +555,59 @@ class MainFrame(ToolFrame):
             self.SetCursor(wx.Cursor(wx.CURSOR_DEFAULT))
 
     def __rotate_frame(self, frame):
-        if self.rotation == 90:
-            return cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
-        elif self.rotation == 180:
-            return cv2.rotate(frame, cv2.ROTATE_180)
-        elif self.rotation == 270:
-            return cv2.rotate(frame, cv2.ROTATE_90_COUNTERCLOCKWISE)
-        return frame
+        return rotate_frame(frame, self.rotation)
+
+    def __update_crop_view(self):
+        # 切り抜く範囲を回転後のプレビューに表示する
+        if self.crop is not None and self.frame is not None:
+            # 大きさの違う動画の設定を読み込んだ場合は、フレームからはみ出す範囲を使わない
+            h, w = self.frame.shape[:2]
+            if self.crop[0] + self.crop[2] > w or self.crop[1] + self.crop[3] > h:
+                self.crop = None
+        if self.crop is None:
+            self.crop_text.SetLabel('(プレビューをドラッグして指定)')
+        else:
+            self.crop_text.SetLabel('x={} y={} {}x{}'.format(*self.crop))
+        if self.crop is None or self.frame is None or not self.crop_button.GetValue():
+            self.previewer.set_selected_rect(None)
+            return
+        h, w = self.frame.shape[:2]
+        x, y, w, h = rotate_crop(self.crop, (w, h), self.rotation)
+        self.previewer.set_selected_rect(Rect(left=x, top=y, right=x + w, bottom=y + h))
+
+    def __get_motion_ranges(self):
+        # 入力動画のサムネイルから求めた、動きのある範囲を返す (動きで絞り込まない場合はNone)
+        if not self.motion_gate_button.GetValue():
+            return None
+        if self.motion_scores is None:
+            thumbnails = self.input_video_thumbnail.get_thumbnails()
+            if not thumbnails or self.frame is None:
+                return None
+            # 切り抜く範囲を、回転したサムネイル上の範囲にする
+            roi = self.__make_setting().make_crop()
+            if roi is not None:
+                h, w = self.frame.shape[:2]
+                size = (h, w) if self.loaded_rotation in (90, 270) else (w, h)
+                th, tw = thumbnails[0].shape[:2]
+                roi = scale_roi(rotate_crop(roi, (w, h), self.loaded_rotation), size, (tw, th))
+            self.motion_scores = compute_motion_scores(thumbnails, roi)
+        return detect_motion_ranges(
+            self.motion_scores,
+            get_spin_ctrl_value(self.motion_threshold),
+            get_spin_ctrl_value(self.motion_pre_roll),
+            get_spin_ctrl_value(self.motion_post_roll),
+            self.input_video_thumbnail.get_frame_range(),
+        )
+
+    def __update_motion_view(self):
+        # 動きのある範囲を入力動画のサムネイルに表示する
+        frame_ranges = self.__get_motion_ranges()
+        if frame_ranges is None:
+            self.input_video_thumbnail.clear_marked_ranges()
+            self.motion_text.SetLabel('')
+            return
+        self.input_video_thumbnail.set_marked_frame_ranges(frame_ranges)
+        self.motion_text.SetLabel(f'{len(frame_ranges)}範囲 {sum(e - b for b, e in frame_ranges)}フレーム')
 
     def __update_color_adjustment_controls(self):
         if self.eq_button.GetValue():
@@ -480,41 +637,8 @@ class MainFrame(ToolFrame):
             self.huesaturation_saturation.Disable()
             self.huesaturation_intensity.Disable()
 
-    def __make_filter_complex(self):
-        filter_complex = {}
-        if self.eq_button.GetValue():
-            filter_complex['eq'] = dict(
-                brightness=get_spin_ctrl_value(self.eq_brightness),
-                contrast=get_spin_ctrl_value(self.eq_contrast),
-                gamma=get_spin_ctrl_value(self.eq_gamma),
-                saturation=get_spin_ctrl_value(self.eq_saturation),
-            )
-        if self.colortemperature_button.GetValue():
-            filter_complex['colortemperature'] = dict(
-                temperature=get_spin_ctrl_value(self.colortemperature_temperature),
-                pl=get_spin_ctrl_value(self.colortemperature_pl),
-                mix=get_spin_ctrl_value(self.colortemperature_mix),
-            )
-        if self.huesaturation_button.GetValue():
-            filter_complex['huesaturation'] = dict(
-                hue=get_spin_ctrl_value(self.huesaturation_hue),
-                saturation=get_spin_ctrl_value(self.huesaturation_saturation),
-                intensity=get_spin_ctrl_value(self.huesaturation_intensity),
-            )
-        logger.debug(f'{filter_complex=}')
-        return filter_complex
-
-    def __make_setting_file_path(self):
-        path = get_path(self.input_file_picker.GetPath())
-        if not path_exists(path):
-            return None
-        return path.with_suffix(SETTING_EXTENSION)
-
-    def __save_setting(self):
-        path = self.__make_setting_file_path()
-        if not path:
-            return
-        setting = dict(
+    def __make_setting(self):
+        return ExtractionSetting(
             rotation=self.rotation,
             eq=self.eq_button.GetValue(),
             eq_brightness=get_spin_ctrl_value(self.eq_brightness),
@@ -529,38 +653,73 @@ class MainFrame(ToolFrame):
             huesaturation_hue=get_spin_ctrl_value(self.huesaturation_hue),
             huesaturation_saturation=get_spin_ctrl_value(self.huesaturation_saturation),
             huesaturation_intensity=get_spin_ctrl_value(self.huesaturation_intensity),
+            motion_gate=self.motion_gate_button.GetValue(),
+            motion_threshold=get_spin_ctrl_value(self.motion_threshold),
+            motion_pre_roll=get_spin_ctrl_value(self.motion_pre_roll),
+            motion_post_roll=get_spin_ctrl_value(self.motion_post_roll),
+            crop=self.crop_button.GetValue() and self.crop is not None,
+            crop_x=self.crop[0] if self.crop else 0,
+            crop_y=self.crop[1] if self.crop else 0,
+            crop_width=self.crop[2] if self.crop else 0,
+            crop_height=self.crop[3] if self.crop else 0,
+            frame_step=self.frame_step_spin.GetValue(),
         )
-        with open(path, 'w') as f:
-            json.dump(setting, f, indent=2)
+
+    def __make_filter_complex(self):
+        filter_complex = self.__make_setting().make_filter_complex()
+        logger.debug(f'{filter_complex=}')
+        return filter_complex
+
+    def __make_setting_file_path(self):
+        path = get_path(self.input_file_picker.GetPath())
+        if not path_exists(path):
+            return None
+        return get_setting_file_path(path)
+
+    def __save_setting(self):
+        path = self.__make_setting_file_path()
+        if not path:
+            return
+        self.__make_setting().save(path)
 
     def __load_setting(self):
         path = self.__make_setting_file_path()
         if not path_exists(path):
             return
 
-        def _g(setting, name, default_value):
-            if name not in setting:
-                return default_value
-            if type(setting[name]) is float:
-                return f'{setting[name]:.2f}'
-            return setting[name]
-
-        with open(path, 'r') as f:
-            setting = json.load(f)
-        self.rotation = _g(setting, 'rotation', 0)
-        self.eq_button.SetValue(_g(setting, 'eq', False))
-        self.eq_brightness.SetValue(_g(setting, 'eq_brightness', '0.00'))
-        self.eq_contrast.SetValue(_g(setting, 'eq_contrast', '1.00'))
-        self.eq_gamma.SetValue(_g(setting, 'eq_gamma', '1.00'))
-        self.eq_saturation.SetValue(_g(setting, 'eq_saturation', '1.00'))
-        self.colortemperature_button.SetValue(_g(setting, 'colortemperature', False))
-        self.colortemperature_temperature.SetValue(_g(setting, 'colortemperature_temperature', '6500'))
-        self.colortemperature_pl.SetValue(_g(setting, 'colortemperature_pl', '1.00'))
-        self.colortemperature_mix.SetValue(_g(setting, 'colortemperature_mix', '1.00'))
-        self.huesaturation_button.SetValue(_g(setting, 'huesaturation', False))
-        self.huesaturation_hue.SetValue(_g(setting, 'huesaturation_hue', '0'))
-        self.huesaturation_saturation.SetValue(_g(setting, 'huesaturation_saturation', '0.00'))
-        self.huesaturation_intensity.SetValue(_g(setting, 'huesaturation_intensity', '0.00'))
+        def _g(value):
+            if type(value) is float:
+                return f'{value:.2f}'
+            return value
+
+        try:
+            setting = ExtractionSetting.load(path)
+        except Exception as e:
+            wx.MessageBox(f'設定の読み込みに失敗しました:\n{e}', TOOL_NAME, wx.OK | wx.ICON_ERROR)
+            return
+        self.rotation = setting.rotation
+        self.eq_button.SetValue(setting.eq)
+        self.eq_brightness.SetValue(_g(setting.eq_brightness))
+        self.eq_contrast.SetValue(_g(setting.eq_contrast))
+        self.eq_gamma.SetValue(_g(setting.eq_gamma))
+        self.eq_saturation.SetValue(_g(setting.eq_saturation))
+        self.colortemperature_button.SetValue(setting.colortemperature)
+        self.colortemperature_temperature.SetValue(_g(setting.colortemperature_temperature))
+        self.colortemperature_pl.SetValue(_g(setting.colortemperature_pl))
+        self.colortemperature_mix.SetValue(_g(setting.colortemperature_mix))
+        self.huesaturation_button.SetValue(setting.huesaturation)
+        self.huesaturation_hue.SetValue(_g(setting.huesaturation_hue))
+        self.huesaturation_saturation.SetValue(_g(setting.huesaturation_saturation))
+        self.huesaturation_intensity.SetValue(_g(setting.huesaturation_intensity))
+        self.crop = (
+            (setting.crop_x, setting.crop_y, setting.crop_width, setting.crop_height) if setting.crop_width else None
+        )
+        self.crop_button.SetValue(setting.crop)
+        self.frame_step_spin.SetValue(setting.frame_step)
+        self.motion_gate_button.SetValue(setting.motion_gate)
+        self.motion_threshold.SetValue(_g(setting.motion_threshold))
+        self.motion_pre_roll.SetValue(setting.motion_pre_roll)
+        self.motion_post_roll.SetValue(setting.motion_post_roll)
         self.rotation_buttons[str(self.rotation)].SetValue(True)
         self.__update_color_adjustment_controls()
 
@@ -569,6 +728,8 @@ class MainFrame(ToolFrame):
         if not path_exists(path):
             return
         self.probe = Probe(path)
+        self.color_matrix = get_color_matrix_name(probe_video_stream(path).get('color_space'))
+        self.preview_decoder.open(path, self.probe)
         self.input_video_thumbnail.clear()
         self.input_video_histogram_view.clear()
         self.image_histogram_view.clear()
@@ -581,7 +742,12 @@ class MainFrame(ToolFrame):
         self.info_b.SetLabel('')
         self.output_video_thumbnail.clear()
         self.output_filename_text.SetValue('')
+        self.frame = None
+        self.motion_scores = None
+        self.motion_text.SetLabel('')
         self.__load_setting()
+        self.__update_crop_view()
+        self.loaded_rotation = self.rotation
         self.input_video_thumbnail.load_video(path, self.rotation, self.__make_filter_complex())
 
     def __on_input_file_changed(self, event):
@@ -618,10 +784,46 @@ class MainFrame(ToolFrame):
             self.info_b.SetLabel(f'{image[y, x, 2]}')
         event.Skip()
 
+    def __on_field_selected(self, event):
+        if self.frame is None:
+            event.Skip()
+            return
+        # プレビューは回転後の画像なので、回転前のフレームの範囲に戻す
+        h, w = self.frame.shape[:2]
+        size = (h, w) if self.rotation in (90, 270) else (w, h)
+        left, top, right, bottom = event.field.to_tuple()
+        x, y, cw, ch = rotate_crop((left, top, right - left, bottom - top), size, (360 - self.rotation) % 360)
+        x, y = max(0, x), max(0, y)
+        cw, ch = min(cw, w - x) & ~1, min(ch, h - y) & ~1
+        if cw >= 2 and ch >= 2:
+            self.crop = (x & ~1, y & ~1, cw, ch)
+            self.crop_button.SetValue(True)
+            self.__update_crop_view()
+            self.motion_scores = None
+            self.__update_motion_view()
+            self.__save_setting()
+        event.Skip()
+
+    def __on_crop_changed(self, event):
+        self.__update_crop_view()
+        self.motion_scores = None
+        self.__update_motion_view()
+        self.__save_setting()
+        event.Skip()
+
+    def __on_motion_gate_changed(self, event):
+        self.__update_motion_view()
+        event.Skip()
+
+    def __on_video_range_changed(self, event):
+        self.__update_motion_view()
+        event.Skip()
+
     def __on_rotation_changed(self, event):
         self.rotation = int(event.GetEventObject().GetName())
         frame = self.__rotate_frame(self.frame)
         self.previewer.set_image(frame)
+        self.__update_crop_view()
         event.Skip()
 
     def __on_color_adjustment_control_changed(self, event):
@@ -642,7 +844,7 @@ class MainFrame(ToolFrame):
         if self.color_control_changed_time is None:
             event.Skip()
             return
-        if time.time() - self.color_control_changed_time >= 1.0:
+        if time.time() - self.color_control_changed_time >= COLOR_PREVIEW_DELAY:
             self.color_control_changed_time = None
             if self.input_video_thumbnail.get_frame_count():
                 position = self.input_video_thumbnail.get_frame_position()
@@ -653,28 +855,53 @@ class MainFrame(ToolFrame):
     def __on_close(self, event):
         self.color_control_timer.Stop()
         self.__save_setting()
+        self.preview_decoder.close()
         event.Skip()
 
     def on_save_menu(self, event):
         super().on_save_menu(event)
         self.__save_setting()
 
+    def __get_output_format(self):
+        return 'TIFF' if self.format_tiff_button.GetValue() else 'PNG'
+
+    def __reset_compression_selector(self):
+        self.direct_output_button.Enable(not self.frame_stack_button.GetValue())
+        if self.frame_stack_button.GetValue():
+            self.compression_keys = list(STACK_COMPRESSIONS.keys())
+            self.compression_selector.Set(list(STACK_COMPRESSIONS.values()))
+        else:
+            self.compression_keys = list(IMAGE_ENCODERS[self.__get_output_format()].keys())
+            self.compression_selector.Set([i.label for i in IMAGE_ENCODERS[self.__get_output_format()].values()])
+        self.compression_selector.SetSelection(0)
+
+    def __on_format_changed(self, event):
+        self.__reset_compression_selector()
+        event.Skip()
+
     def __on_save_button_clicked(self, event):
         if self.input_video_thumbnail.get_frame_count() == 0:
             wx.MessageBox('連続画像を取り出す動画が読み込まれていません。', 'エラー', wx.OK | wx.ICON_ERROR)
             event.Skip()
             return
 
-        output_format = 'TIFF' if self.format_tiff_button.GetValue() else 'PNG'
+        output_format = self.__get_output_format()
         input_path = get_path(self.input_file_picker.GetPath())
-        output_filename = input_path.stem.removesuffix(RAW_SUFFIX) + '_' + output_format + '.txt'
+        output_filename = get_catalog_file_name(input_path, output_format)
+        if self.frame_stack_button.GetValue():
+            output_filename = output_filename.removesuffix('.txt') + FRAME_STACK_EXTENSION
+            message = '保存先のフレームスタックのファイル名を入力してください。'
+            wildcard = FRAME_STACK_FILE_WILDCARD
+        else:
+            message = '保存先の連続画像のカタログファイル名を入力してください。(連続画像のフォルダー名にもなります)'
+            wildcard = IMAGE_CATALOG_FILE_WILDCARD
 
         with wx.FileDialog(
             self,
-            '保存先の連続画像のカタログファイル名を入力してください。(連続画像のフォルダー名にもなります)',
+            message,
             defaultDir=str(input_path.parent),
             defaultFile=output_filename,
-            wildcard=IMAGE_CATALOG_FILE_WILDCARD,
+            wildcard=wildcard,
             style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT,
         ) as fileDialog:
             if fileDialog.ShowModal() == wx.ID_CANCEL:
@@ -682,6 +909,17 @@ class MainFrame(ToolFrame):
             self.__save_setting()
             output_path = get_path(fileDialog.GetPath())
             self.output_filename_text.SetValue(str(output_path))
+            # 範囲を指定した場合は、トリミングした動画を作らずに範囲だけを展開する (画像の番号は元の動画の番号)
+            frame_range = self.input_video_thumbnail.get_frame_range()
+            if frame_range == (0, self.input_video_thumbnail.get_frame_count()):
+                frame_range = None
+            # 切り抜き・間引きはffmpegのフィルターで行う (パイプ以降は残したピクセルとフレームだけを処理する)
+            setting = self.__make_setting()
+            # 動きで絞り込む場合は、動きのある範囲だけをデコードして展開する
+            frame_ranges = self.__get_motion_ranges()
+            if frame_ranges is not None and not frame_ranges:
+                wx.MessageBox('動きのある範囲が見つかりませんでした。', TOOL_NAME, wx.OK | wx.ICON_ERROR)
+                return
             self.output_video_thumbnail.load_video(
                 input_path,
                 self.rotation,
@@ -689,6 +927,13 @@ class MainFrame(ToolFrame):
                 output_path,
                 output_format,
                 1 / 2 if self.scale_half_button.GetValue() else None,
+                self.segments_spin.GetValue(),
+                self.compression_keys[self.compression_selector.GetSelection()],
+                self.direct_output_button.IsEnabled() and self.direct_output_button.GetValue(),
+                step=setting.frame_step,
+                frame_range=frame_range,
+                crop=setting.make_crop(),
+                frame_ranges=frame_ranges,
             )
         event.Skip()
 
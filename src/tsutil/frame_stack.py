@@ -0,0 +1,216 @@
+from pathlib import Path
+import threading
+import logging
+import json
+import zlib
+import numpy as np
+import cv2
+
+# NOTE: 連続画像を1つのファイルにまとめたフレームスタック (wxPythonに依存しない)
+# ファイルの構成:
+#   [0, HEADER_SIZE)     : MAGIC + JSON形式のヘッダー (0x00で埋める)
+#   [HEADER_SIZE, ...)   : フレームデータ (BGR/BGR48、FRAME_ALIGNMENTバイト境界に配置)
+#   [index_offset, ...)  : インデックス (フレーム番号順に(フレーム番号, オフセット, バイト数)のuint64配列)
+# フレーム番号はインデックスに記録するので、飛び飛びの範囲を展開してもヘッダーの大きさは変わらない。
+# 無圧縮の場合はnp.memmapのビューをそのまま返すので、任意のフレームをO(1)で読み出せる。
+
+# MARK: constants
+
+FRAME_STACK_EXTENSION = '.stack'
+MAGIC = b'TSSTACK\x00'
+VERSION = 2
+INDEX_FIELDS = 3  # インデックスの1フレームあたりの要素数 (フレーム番号, オフセット, バイト数)
+HEADER_SIZE = 4096
+FRAME_ALIGNMENT = 64
+ZLIB_LEVEL = 1
+STACK_COMPRESSIONS = {
+    'none': '無圧縮 (最速)',
+    'zlib': 'zlib (軽量圧縮)',
+}
+
+logger = logging.getLogger('tsutil')
+
+
+# MARK: frame stack reader
+class FrameStack:
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if not header.startswith(MAGIC):
+            raise ValueError(f'not a frame stack file: {path}')
+        self.header = json.loads(header[len(MAGIC) :].rstrip(b'\x00').decode('utf-8'))
+        if self.header.get('version') != VERSION:
+            raise ValueError(f'unsupported frame stack version: {self.header.get("version")}')
+        self.shape = (self.header['height'], self.header['width'], self.header['channels'])
+        self.dtype = np.dtype(self.header['dtype'])
+        self.compression = self.header['compression']
+        self.format = self.header['format']
+        count = self.header['count']
+        self.__mm = np.memmap(path, dtype=np.uint8, mode='r')
+        index_size = count * INDEX_FIELDS * 8
+        self.__index = (
+            self.__mm[self.header['index_offset'] : self.header['index_offset'] + index_size]
+            .view(np.uint64)
+            .reshape(count, INDEX_FIELDS)
+        )
+
+    def __len__(self):
+        return len(self.__index)
+
+    def frame_number(self, index: int) -> int:
+        # 展開元の動画のフレーム番号
+        return int(self.__index[index][0])
+
+    def read(self, index: int) -> np.ndarray:
+        # cv2.imread(..., cv2.IMREAD_UNCHANGED)と同じBGR(BGR48)のフレームを返す
+        # (無圧縮の場合は読み取り専用のビュー)
+        offset, size = (int(i) for i in self.__index[index][1:])
+        data = self.__mm[offset : offset + size]
+        if self.compression == 'zlib':
+            data = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+        return np.asarray(data).view(self.dtype).reshape(self.shape)
+
+    def get_frames(self) -> list['StackFrame']:
+        return [StackFrame(self, i) for i in range(len(self))]
+
+
+class StackFrame:
+    # カタログファイルの画像ファイルのパス(Path)の代わりに使う、フレームスタック内の1フレーム
+
+    def __init__(self, stack: FrameStack, index: int):
+        self.stack = stack
+        self.index = index
+
+    def __str__(self):
+        return f'{self.stack.path}#{self.index + 1}'
+
+    @property
+    def suffix(self) -> str:
+        return '.tif' if self.stack.format == 'TIFF' else '.png'
+
+    @property
+    def stem(self) -> str:
+        return f'f{self.stack.frame_number(self.index) + 1:05d}'
+
+    @property
+    def name(self) -> str:
+        # 連続画像に書き出すときのファイル名
+        return self.stem + self.suffix
+
+    def exists(self) -> bool:
+        return True
+
+    def read(self) -> np.ndarray:
+        return self.stack.read(self.index)
+
+
+# MARK: frame stack writer
+class FrameStackWriter:
+    # 複数のスレッドからフレーム番号の順不同で書き込める (フレーム番号は飛び飛びでもよい)
+
+    def __init__(self, path: Path, format: str = 'PNG', compression: str | None = None):
+        self.path = path
+        self.format = format
+        self.compression = compression if compression in STACK_COMPRESSIONS else 'none'
+        self.__header = None
+        self.__index: dict[int, tuple[int, int]] = {}
+        self.__lock = threading.Lock()
+        self.__fd = open(path, 'wb')
+        self.__fd.write(b'\x00' * HEADER_SIZE)
+        self.__offset = HEADER_SIZE
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, index: int, frame: np.ndarray):
+        # frameはcv2.imwrite()に渡すのと同じBGR(BGR48)のフレーム
+        self.write_encoded(index, self.encode(frame))
+
+    def encode(self, frame: np.ndarray) -> tuple[bytes, tuple[int, int, int], str]:
+        # 圧縮は書き込みのロックの外で行う
+        frame = np.ascontiguousarray(frame if frame.ndim == 3 else frame[:, :, np.newaxis])
+        data = frame.tobytes()
+        if self.compression == 'zlib':
+            data = zlib.compress(data, ZLIB_LEVEL)
+        return data, frame.shape, frame.dtype.str
+
+    def write_encoded(self, index: int, encoded: tuple[bytes, tuple[int, int, int], str]):
+        data, shape, dtype = encoded
+        with self.__lock:
+            if self.__header is None:
+                self.__header = dict(
+                    version=VERSION,
+                    height=shape[0],
+                    width=shape[1],
+                    channels=shape[2],
+                    dtype=dtype,
+                    compression=self.compression,
+                    format=self.format,
+                )
+            elif (
+                self.__header['height'],
+                self.__header['width'],
+                self.__header['channels'],
+                self.__header['dtype'],
+            ) != (*shape, dtype):
+                raise ValueError(f'frame {index + 1}: shape or dtype differs from the first frame')
+            self.__fd.write(data)
+            self.__index[index] = (self.__offset, len(data))
+            self.__offset += len(data)
+            padding = -self.__offset % FRAME_ALIGNMENT
+            self.__fd.write(b'\x00' * padding)
+            self.__offset += padding
+
+    def close(self):
+        with self.__lock:
+            if self.__fd is None:
+                return
+            try:
+                count = len(self.__index)
+                header = self.__header or dict(
+                    version=VERSION,
+                    height=0,
+                    width=0,
+                    channels=3,
+                    dtype='|u1',
+                    compression=self.compression,
+                    format=self.format,
+                )
+                header.update(count=count, index_offset=self.__offset)
+                index = np.array([(i, *self.__index[i]) for i in sorted(self.__index.keys())], dtype=np.uint64)
+                self.__fd.write(index.reshape(-1, INDEX_FIELDS).tobytes())
+                data = MAGIC + json.dumps(header).encode('utf-8')
+                if len(data) > HEADER_SIZE:
+                    raise ValueError('frame stack header is too large')
+                self.__fd.seek(0)
+                self.__fd.write(data)
+            finally:
+                self.__fd.close()
+                self.__fd = None
+
+
+# MARK: functions
+
+
+def is_frame_stack(path: Path) -> bool:
+    return path.suffix.lower() == FRAME_STACK_EXTENSION
+
+
+def read_image_catalog(path: Path) -> list[Path | StackFrame]:
+    # カタログファイルの画像ファイルのパス、またはフレームスタックの各フレームのリストを返す
+    if is_frame_stack(path):
+        return FrameStack(path).get_frames()
+    parent_path = path.parent
+    with open(path, 'r') as reader:
+        return [parent_path / line.rstrip() for line in reader]
+
+
+def read_image(entry: Path | StackFrame) -> np.ndarray | None:
+    # read_image_catalog()が返すリストの要素を読み込む (cv2.imread()と同様に失敗した場合はNone)
+    if isinstance(entry, StackFrame):
+        return entry.read()
+    return cv2.imread(str(entry), cv2.IMREAD_UNCHANGED)
@@ -1,9 +1,22 @@
 import numpy as np
 import cv2
-from .common import Rect
+from .common import Rect, CorrectionDataModel
+from .phase_correlation import (
+    DEFAULT_REFINE_SIZE,
+    BatchPhaseCorrelator,
+    phase_correlate_fields,
+    estimate_rigid_transform_homography,
+)
+from .transform_table import TransformTable
 from typing import TextIO, Sequence
+import hashlib
+import threading
 import sys
 
+# MARK: constants
+
+ESTIMATION_BATCH_SIZE = 16  # ずれをまとめて推定するフレーム数 (追跡する場合は、この枚数ごとに測定枠の全体から求める)
+
 
 # MARK: deshaking correction
 class DeshakingCorrection:
@@ -34,8 +47,14 @@ class DeshakingCorrection:
         self.frame_index = frame_index
 
     def compute(
-        self, shaking_detection_fields: list[Rect], rotation_angle: float = 0.0, fd: TextIO = sys.stdout
+        self,
+        shaking_detection_fields: list[Rect],
+        rotation_angle: float = 0.0,
+        fd: TextIO = sys.stdout,
+        pyramid_levels: int = 0,
+        refine_size: int = DEFAULT_REFINE_SIZE,
     ) -> np.ndarray:
+        # pyramid_levels > 0の場合は、縮小したブレ測定枠で大まかなずれを求めてから、元の解像度の窓で求め直す
         if self.base_image is None or self.sample_image is None:
             raise Exception('No base image or sample image.')
         frame_info = '' if self.frame_index is None else f'f{self.frame_index + 1:05d}: '
@@ -45,23 +64,12 @@ class DeshakingCorrection:
         if not len(shaking_detection_fields):
             self.__mat = mat_r
             return self.__mat
-        base_points = []
-        sample_points = []
-        for i, f in enumerate(shaking_detection_fields):
-            hann = cv2.createHanningWindow(f.get_size(), cv2.CV_32F)
-            delta, response = cv2.phaseCorrelate(
-                normalize_array(self.__gray_base_image[f.top : f.bottom, f.left : f.right]),
-                normalize_array(self.__gray_sample_image[f.top : f.bottom, f.left : f.right]),
-                hann,
-            )
-            print(f'{frame_info}A{i + 1}: {delta=} {response=}', file=fd)
-            # Image.fromarray(self.base_image[f.top:f.bottom, f.left:f.right, :]).save('base.png')
-            # Image.fromarray(self.sample_image[f.top:f.bottom, f.left:f.right, :]).save('sample.png')
-            cx, cy = f.get_center()
-            base_points.append([cx, cy])
-            sample_points.append([cx + delta[0], cy + delta[1]])
-        base_points = np.array(base_points, dtype=np.float32)
-        sample_points = np.array(sample_points, dtype=np.float32)
+        fields = [f.to_tuple() for f in shaking_detection_fields]
+        shifts, _ = phase_correlate_fields(
+            self.__gray_base_image, self.__gray_sample_image, fields, fd, frame_info, pyramid_levels, refine_size
+        )
+        base_points = np.array([f.get_center() for f in shaking_detection_fields], dtype=np.float32)
+        sample_points = (base_points + shifts).astype(np.float32)
         print(f'{frame_info}{base_points=}', file=fd)
         print(f'{frame_info}{sample_points=}', file=fd)
         mat, angle, offset = estimate_rigid_transform_homography(sample_points, base_points)
@@ -77,42 +85,172 @@ class DeshakingCorrection:
         return self.__mat
 
 
-# MARK: functions
-
+# MARK: correction plan
+class CorrectionPlan:
+    # 補正後の連続画像を書き出すときに、全フレームで共通の計算を1回だけ行っておく
+    # - ブレ測定枠パターンごとの基準画像の測定枠 (BatchPhaseCorrelator)
+    # - 傾き補正と歪み補正の行列、切り抜く範囲
+    # - フレーム位置ごとに使うブレ測定枠パターンの表
+    # ずれの表(TransformTable)が保存されている場合は、use_table()で表を設定し、correct()で各フレームを補正する
+    # 表が無い場合は、各フレームを1回だけ読み込んで、ずれを推定しながら補正する
+    # 1. begin_estimation()で空の表を用意する
+    # 2. 読み込んだフレームをadd_fields()に渡して測定枠だけを切り出しておく
+    # 3. 補正の前にestimate_chunk()で、そのフレームを含むESTIMATION_BATCH_SIZE枚のずれをまとめて推定する
+    #    (チャンクごとに独立しているので、補正のスレッドで並行して推定できる)
+    # base_imageとadd_fields(), correct()に渡す画像は、read_image()で読み込んだBGRの画像
+
+    def __init__(self, model: CorrectionDataModel, base_image: np.ndarray, frame_count: int):
+        h, w = base_image.shape[:2]
+        angle = (model.rotation_angle or 0.0) if model.use_rotation_correction else 0.0
+        mat = np.vstack([cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0), (0, 0, 1)], dtype=np.float32)
+        if model.use_perspective_correction:
+            mat = model.perspective_points.get_transform_matrix() @ mat
+        self.matrix = mat
+        self.clip = None if model.clip.is_none() else model.clip.to_tuple()
+        self.table: TransformTable | None = None
+        self.__chunks: list[_EstimationChunk] = []
+
+        field_sets = [model.shaking_detection_fields] + list(model.extra_shaking_detection_fields or [])
+        field_sets = [[f.to_tuple() for f in fields] for fields in field_sets]
+        if model.use_deshake_correction and any(field_sets):
+            gray_base_image = cv2.cvtColor(base_image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+            tracking_size = model.tracking_size if model.use_tracking else 0
+            self.correlators = [
+                BatchPhaseCorrelator(
+                    fields,
+                    gray_base_image,
+                    model.pyramid_levels,
+                    model.pyramid_refine_size,
+                    tracking_size,
+                    model.tracking_min_response,
+                )
+                for fields in field_sets
+            ]
+        else:
+            self.correlators = []
+        # get_shaking_detection_fields_index()の結果 (-1はデフォルトのパターン) をフレーム位置ごとに引けるようにする
+        table = np.full(frame_count, -1, dtype=np.int32)
+        if model.use_deshake_correction and model.extra_deshaking_sample_frame_pos:
+            positions = np.array(sorted(model.extra_deshaking_sample_frame_pos), dtype=np.int64)
+            values = np.array([model.extra_deshaking_sample_frame_pos[i] for i in positions], dtype=np.int32)
+            k = np.searchsorted(positions, np.arange(frame_count), side='right') - 1
+            table = np.where(k >= 0, values[np.maximum(k, 0)], -1).astype(np.int32)
+        self.field_set_table = table
+        # ずれの表のキーに含める設定 (傾き・歪み・切り抜く範囲はずれに影響しないので含めない)
+        self.table_params = dict(
+            fields=field_sets if self.correlators else [],
+            field_set_table=hashlib.sha1(table.tobytes()).hexdigest(),
+            base_frame_pos=model.base_frame_pos,
+            pyramid=(model.pyramid_levels, model.pyramid_refine_size),
+            tracking=(model.tracking_size, model.tracking_min_response) if model.use_tracking else None,
+        )
 
-def estimate_rigid_transform_homography(
-    src1: np.ndarray, src2: np.ndarray
-) -> tuple[np.ndarray, np.float32, np.ndarray]:
-    # 1. 重心で中心化
-    centroid1 = np.mean(src1, axis=0)
-    centroid2 = np.mean(src2, axis=0)
-    centered1 = src1 - centroid1
-    centered2 = src2 - centroid2
+    @property
+    def needs_table(self) -> bool:
+        # ブレ補正を行う場合は、先にずれの表が必要
+        return bool(self.correlators) and self.table is None
+
+    def get_field_set(self, frame_index: int) -> int:
+        # フレーム位置で使うブレ測定枠パターン (self.correlatorsの番号)
+        k = int(self.field_set_table[frame_index]) if frame_index < len(self.field_set_table) else -1
+        return k + 1
+
+    def crop_fields(self, frame_index: int, image: np.ndarray) -> list[np.ndarray]:
+        # フレーム位置で使うブレ測定枠パターンの、各測定枠の部分(グレースケール)を返す
+        return self.correlators[self.get_field_set(frame_index)].crop(image)
+
+    def begin_estimation(self, key: str):
+        # ずれを推定しながら補正するための空の表を用意する (推定しなかったフレームのずれは0)
+        n = len(self.field_set_table)
+        self.table = TransformTable(key=key, dx=[0.0] * n, dy=[0.0] * n, angle=[0.0] * n, response=[None] * n)
+        self.__chunks = [
+            _EstimationChunk(min(ESTIMATION_BATCH_SIZE, n - i)) for i in range(0, n, ESTIMATION_BATCH_SIZE)
+        ]
+
+    def add_fields(self, frame_index: int, image: np.ndarray | None):
+        # 推定中の場合は、フレームの測定枠の部分だけを切り出しておく (読み込めなかったフレームはNoneを渡す)
+        if not self.__chunks:
+            return
+        crops = None if image is None else self.crop_fields(frame_index, image)
+        self.__chunks[frame_index // ESTIMATION_BATCH_SIZE].add(frame_index, crops)
+
+    def estimate_chunk(self, frame_index: int, timeout: float | None = None) -> bool:
+        # フレームを含むチャンクのずれを推定して表に書き込む (推定済みの場合や推定中でない場合は何もしない)
+        # 同じブレ測定枠パターンのフレームをフレーム位置の順にまとめて推定する (追跡はチャンクの最初のフレームから始める)
+        # timeout秒以内にチャンクの全フレームが切り出されなかった場合はFalseを返す (中断を確認して呼び直す)
+        if not self.__chunks:
+            return True
+        chunk = self.__chunks[frame_index // ESTIMATION_BATCH_SIZE]
+        if not chunk.ready.wait(timeout):
+            return False
+        with chunk.lock:
+            if chunk.estimated:
+                return True
+            t = self.table
+            batches: dict[int, list[tuple[int, list[np.ndarray]]]] = {}
+            for index in sorted(chunk.crops):
+                crops = chunk.crops[index]
+                k = self.get_field_set(index)
+                if crops is not None and len(self.correlators[k]):
+                    batches.setdefault(k, []).append((index, crops))
+            for k, batch in batches.items():
+                indices, crops = zip(*batch)
+                _, angles, offsets, responses = self.correlators[k].estimate(crops)
+                for i, a, (dx, dy), r in zip(indices, angles, offsets, responses.min(axis=1)):
+                    t.dx[i], t.dy[i], t.angle[i], t.response[i] = float(dx), float(dy), float(a), float(r)
+            chunk.crops.clear()
+            chunk.estimated = True
+        return True
+
+    def end_estimation(self) -> TransformTable | None:
+        # 残りのチャンク(全フレームを読み込めなかったチャンク)も推定して、表を返す
+        # (読み込みが中断されて切り出していないフレームがある場合はNone)
+        for i in range(0, len(self.__chunks) * ESTIMATION_BATCH_SIZE, ESTIMATION_BATCH_SIZE):
+            if not self.estimate_chunk(i, 0):
+                return None
+        self.__chunks = []
+        return self.table
+
+    def use_table(self, table: TransformTable):
+        self.table = table
+
+    def compute_matrix(self, frame_index: int) -> np.ndarray:
+        # DeshakingCorrection.compute()と同じ変換行列に歪み補正の行列を掛けたもの
+        if not self.correlators:
+            return self.matrix
+        if self.table is None:
+            raise Exception('No transform table.')
+        t = self.table
+        return self.matrix @ compute_rigid_transform_homography(
+            t.angle[frame_index], t.dx[frame_index], t.dy[frame_index]
+        )
 
-    # 2. 最小二乗誤差で回転行列を求める（SVD）
-    #    Kabschアルゴリズム: https://en.wikipedia.org/wiki/Kabsch_algorithm
-    H = centered1.T @ centered2
-    U, S, Vt = np.linalg.svd(H)
-    R = Vt.T @ U.T
+    def correct(self, frame_index: int, image: np.ndarray) -> np.ndarray:
+        mat = self.compute_matrix(frame_index)
+        image = cv2.warpPerspective(image, mat, (image.shape[1], image.shape[0]), flags=cv2.INTER_AREA)
+        if self.clip is not None:
+            left, top, right, bottom = self.clip
+            image = image[top:bottom, left:right, :]
+        return image
 
-    # 反転のチェック（反射対策）
-    if np.linalg.det(R) < 0:
-        Vt[1, :] *= -1
-        R = Vt.T @ U.T
 
-    # 3. 並進ベクトル
-    t = centroid2 - R @ centroid1
+class _EstimationChunk:
+    # 連続したESTIMATION_BATCH_SIZE枚のフレームの切り出した測定枠 (全フレームが揃ったらまとめて推定する)
+    def __init__(self, count: int):
+        self.count = count
+        self.crops: dict[int, list[np.ndarray] | None] = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.estimated = False
 
-    # 4. アフィン行列（2×3）→ ホモグラフィ行列（3×3）に拡張
-    H_affine = np.eye(3, dtype=np.float32)
-    H_affine[:2, :2] = R.astype(np.float32)
-    H_affine[:2, 2] = t.astype(np.float32)
+    def add(self, frame_index: int, crops: list[np.ndarray] | None):
+        with self.lock:
+            self.crops[frame_index] = crops
+            if len(self.crops) >= self.count:
+                self.ready.set()
 
-    # 5. 回転角の算出
-    theta_deg = np.degrees(np.arctan2(R[1, 0], R[0, 0]))
 
-    # 6. 戻り値は(回転+平行移動のアフィン変換行列(3x3), 回転角, 平行移動量
-    return H_affine, theta_deg, H_affine[:2, 2]
+# MARK: functions
 
 
 def compute_rigid_transform_homography(angle: float, dx: float, dy: float):
@@ -122,14 +260,6 @@ def compute_rigid_transform_homography(angle: float, dx: float, dy: float):
     return np.array([[c, -s, dx], [s, c, dy], [0, 0, 1]], dtype=np.float32)
 
 
-def normalize_array(src: np.ndarray) -> np.ndarray:
-    min = np.min(src)
-    max = np.max(src)
-    if min == max:
-        return np.full_like(src, 0)
-    return (src - min) / (max - min)
-
-
 def unsharp_mask(img: np.ndarray, k: float = 1.5):
     kernel = _make_sharp_kernel(k)
     return np.clip(cv2.filter2D(img, -1, kernel), 0, 255).astype(np.uint8)
@@ -0,0 +1,95 @@
+from pathlib import Path
+from typing import Iterable
+from .extraction import get_output_frame_size, get_thumbnail_size, read_thumbnails
+from .packet_index import load_packet_index
+import logging
+import numpy as np
+import cv2
+
+# NOTE: 列車の通過前後の静止したフレームを展開しないための動き検出 (wxPythonに依存しない)
+# - サムネイルの大きさのフレームで、直前のフレームから変化したピクセルの割合(%)を動きの大きさとする
+# - 動きの大きさがしきい値を超えたフレームの前後に、指定したフレーム数(プリロール・ポストロール)を加えた範囲を展開する
+# - 範囲(roi)を指定した場合は、その範囲だけで動きを判定する (列車が写る帯だけを見ると、木の揺れなどを無視できる)
+
+# MARK: constants
+
+MOTION_THUMBNAIL_HEIGHT = 64  # サムネイルが無い場合(コマンドライン)にデコードするフレームの高さ
+PIXEL_THRESHOLD = 16  # 変化したとみなす輝度の差 (圧縮ノイズを無視する)
+
+logger = logging.getLogger('tsutil')
+
+
+# MARK: functions
+
+
+def scale_roi(
+    roi: tuple[int, int, int, int], frame_size: tuple[int, int], thumbnail_size: tuple[int, int]
+) -> tuple[int, int, int, int]:
+    # フレーム(幅, 高さ)上の範囲(x, y, 幅, 高さ)をサムネイル上の範囲にする (1ピクセル以上残す)
+    sx, sy = thumbnail_size[0] / frame_size[0], thumbnail_size[1] / frame_size[1]
+    x, y = int(roi[0] * sx), int(roi[1] * sy)
+    return x, y, max(1, int((roi[0] + roi[2]) * sx + 0.5) - x), max(1, int((roi[1] + roi[3]) * sy + 0.5) - y)
+
+
+def compute_motion_scores(frames: Iterable[np.ndarray], roi: tuple[int, int, int, int] | None = None) -> np.ndarray:
+    # 各フレームの、直前のフレームから変化したピクセルの割合(%)を返す (先頭のフレームは0)
+    # framesはRGBのサムネイル、roiはサムネイル上の範囲(x, y, 幅, 高さ)
+    # (1フレームずつ処理するので、フレームをまとめて保持しなくてよい)
+    scores = []
+    prev_frame = None
+    prev = None
+    for frame in frames:
+        if frame is prev_frame:
+            # 間引いて読み込んだサムネイル(直前と同じ配列)は直前と同じ大きさにする
+            scores.append(scores[-1])
+            continue
+        prev_frame = frame
+        if roi is not None:
+            x, y, w, h = roi
+            frame = frame[y : y + h, x : x + w]
+        gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        if prev is None or prev.shape != gray.shape:
+            scores.append(0.0)
+        else:
+            scores.append(np.count_nonzero(cv2.absdiff(gray, prev) > PIXEL_THRESHOLD) * 100 / gray.size)
+        prev = gray
+    return np.array(scores, dtype=np.float32)
+
+
+def detect_motion_ranges(
+    scores: np.ndarray,
+    threshold: float,
+    pre_roll: int = 0,
+    post_roll: int = 0,
+    frame_range: tuple[int, int] | None = None,
+) -> list[tuple[int, int]]:
+    # 動きの大きさがthresholdを超えたフレームの範囲にプリロール・ポストロールを加え、
+    # 重なる範囲をまとめた(開始フレーム, 終了フレーム + 1)のリストを返す
+    # frame_rangeを指定した場合は、その範囲と重なる部分だけを返す
+    n = len(scores)
+    start, end = (0, n) if frame_range is None else (max(0, frame_range[0]), min(frame_range[1], n))
+    ranges = []
+    for i in np.flatnonzero(np.asarray(scores) > threshold):
+        b, e = max(start, i - pre_roll), min(end, i + 1 + post_roll)
+        if b >= e:
+            continue
+        if ranges and b <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], e)
+        else:
+            ranges.append([b, e])
+    logger.debug(f'motion ranges: {ranges}')
+    return [(int(b), int(e)) for b, e in ranges]
+
+
+def read_motion_scores(
+    path: Path, roi: tuple[int, int, int, int] | None = None, filter_complex: dict | None = None
+) -> np.ndarray:
+    # サムネイルが無い場合に、動画を小さくデコードして動きの大きさを求める (roiは回転前のフレーム上の範囲)
+    thumbnail_size = get_thumbnail_size(path, MOTION_THUMBNAIL_HEIGHT)
+    if roi is not None:
+        roi = scale_roi(roi, get_output_frame_size(path), thumbnail_size)
+    n_frames = load_packet_index(path).n_frames
+    frames = (frame for _, frame in read_thumbnails(path, MOTION_THUMBNAIL_HEIGHT, filter_complex=filter_complex))
+    scores = compute_motion_scores(frames, roi)[:n_frames]
+    # 索引よりデコードできたフレームが少ない場合は、残りを動きが無いものとする
+    return np.pad(scores, (0, n_frames - len(scores)))
@@ -0,0 +1,210 @@
+from pathlib import Path
+from pydantic import BaseModel
+from collections import OrderedDict
+import bisect
+import logging
+import subprocess
+import threading
+
+# NOTE: 動画のフレーム(パケット)の表示時刻とキーフレームの索引 (wxPythonに依存しない)
+# - ffprobeでパケットを読むだけ(デコードしない)で作成し、動画ファイルと同じフォルダーに保存する
+# - 可変フレームレート(VFR)の動画でも、フレーム番号と時刻を正確に対応付ける
+#   (フレーム番号 / fps や 再生時間 * フレーム番号 / フレーム数 では数フレームずれる)
+# - 動画ファイルのサイズ・更新日時が変わった場合は作り直す
+
+# MARK: constants
+
+INDEX_EXTENSION = '.index.json'
+MAX_MEMORY_INDICES = 16  # メモリー上に保持する索引の数
+
+logger = logging.getLogger('tsutil')
+
+
+# MARK: packet index model
+class PacketIndex(BaseModel):
+    size: int = -1  # 動画ファイルのサイズ (索引の検証用)
+    mtime_ns: int = -1  # 動画ファイルの更新日時 (索引の検証用)
+    start_time: float = 0.0  # 動画の開始時刻 (ffmpegの-ssはこの時刻からの相対時刻)
+    pts: list[float] = []  # 全フレームの表示時刻 (表示順、start_timeからの相対時刻)
+    keyframes: list[int] = []  # キーフレームのフレーム番号 (昇順)
+
+    @property
+    def n_frames(self) -> int:
+        return len(self.pts)
+
+    @property
+    def duration(self) -> float:
+        # 最後のフレームの表示時間(直前のフレームとの間隔)までを含めた長さ
+        # (結合するときの次のファイルの開始時刻。seek_time(n_frames)は最後のフレームの途中なので使わない)
+        if not self.pts:
+            return 0.0
+        interval = self.pts[-1] - self.pts[-2] if self.n_frames > 1 else 0.0
+        return self.pts[-1] + interval
+
+    def frame_time(self, index: int) -> float:
+        # フレームの表示時刻
+        if not self.pts:
+            return 0.0
+        return self.pts[max(0, min(index, self.n_frames - 1))]
+
+    def seek_time(self, index: int) -> float:
+        # ffmpegの-ss(デコードしてシークする場合)で、このフレームから読み込むための時刻
+        # (直前のフレームとの中間を指定すると、表示時刻の丸め誤差があっても前後のフレームにずれない)
+        # -toに指定すると、直前のフレームまでを読み込む
+        if index <= 0 or not self.pts:
+            return 0.0
+        if index >= self.n_frames:
+            interval = self.pts[-1] - self.pts[-2] if self.n_frames > 1 else 0.0
+            return self.pts[-1] + interval / 2
+        return (self.pts[index - 1] + self.pts[index]) / 2
+
+    def copy_seek_time(self, index: int) -> float:
+        # ffmpegの-ss(-c copyで切り出す場合)で、このフレームの直前のキーフレームから切り出すための時刻
+        # (-c copyではシーク位置以前の最後のキーフレームから切り出されるので、キーフレームと次のフレームの中間を指定する)
+        return self.seek_time(self.keyframe_before(index) + 1)
+
+    def frame_at(self, time: float) -> int:
+        # 時刻に最も近いフレーム番号
+        if not self.pts:
+            return 0
+        i = bisect.bisect_left(self.pts, time)
+        if i >= self.n_frames:
+            return self.n_frames - 1
+        if i > 0 and time - self.pts[i - 1] <= self.pts[i] - time:
+            return i - 1
+        return i
+
+    def keyframe_before(self, index: int) -> int:
+        # フレーム番号以前で最後のキーフレーム
+        i = bisect.bisect_right(self.keyframes, index)
+        return self.keyframes[i - 1] if i > 0 else 0
+
+    def keyframe_after(self, index: int) -> int:
+        # フレーム番号以降で最初のキーフレーム (無い場合はフレーム数)
+        i = bisect.bisect_left(self.keyframes, index)
+        return self.keyframes[i] if i < len(self.keyframes) else self.n_frames
+
+    def nearest_keyframe(self, index: int) -> int:
+        before = self.keyframe_before(index)
+        after = self.keyframe_after(index)
+        if after >= self.n_frames or index - before <= after - index:
+            return before
+        return after
+
+    def is_valid(self, path: Path) -> bool:
+        size, mtime_ns = _stat(path)
+        return size == self.size and mtime_ns == self.mtime_ns
+
+
+# MARK: functions
+
+_indices: OrderedDict[str, PacketIndex] = OrderedDict()
+_indices_lock = threading.Lock()
+
+
+def get_index_file_path(video_path: Path) -> Path:
+    # 拡張子だけが違う動画ファイル(clip.mp4とclip.mov)の索引が同じファイルにならないように、拡張子の後に付ける
+    return video_path.with_name(video_path.name + INDEX_EXTENSION)
+
+
+def _stat(path: Path) -> tuple[int, int]:
+    try:
+        st = path.stat()
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return -1, -1
+
+
+def probe_packets(path: Path) -> PacketIndex:
+    # ffprobeで全パケットの表示時刻とキーフレームを読み込む (デコードしないので短時間で終わる)
+    size, mtime_ns = _stat(path)
+    args = [
+        'ffprobe',
+        '-v',
+        'error',
+        '-select_streams',
+        'v:0',
+        '-show_entries',
+        'packet=pts_time,flags:format=start_time',
+        '-of',
+        'csv=p=0',
+        str(path),
+    ]
+    result = subprocess.run(args, capture_output=True, text=True, check=True)
+    packets = []
+    start_time = 0.0
+    for line in result.stdout.splitlines():
+        values = line.split(',')
+        if len(values) == 1:
+            start_time = float(values[0]) if values[0] not in ('', 'N/A') else 0.0
+        elif values[0] != 'N/A':
+            packets.append((float(values[0]), 'K' in values[1]))
+    # パケットはデコード順なので、表示順に並べ替える
+    packets.sort()
+    return PacketIndex(
+        size=size,
+        mtime_ns=mtime_ns,
+        start_time=start_time,
+        pts=[t - start_time for t, _ in packets],
+        keyframes=[i for i, (_, key) in enumerate(packets) if key],
+    )
+
+
+def load_packet_index(path: Path) -> PacketIndex:
+    # メモリー上の索引、動画ファイルと同じフォルダーの索引ファイルの順に探し、無ければ作成して保存する
+    path = Path(path)
+    key = str(path.resolve())
+    with _indices_lock:
+        index = _indices.get(key)
+        if index is not None and index.is_valid(path):
+            _indices.move_to_end(key)
+            return index
+    index = _load_index_file(path)
+    if index is None:
+        index = probe_packets(path)
+        _save_index_file(path, index)
+    with _indices_lock:
+        _indices[key] = index
+        _indices.move_to_end(key)
+        while len(_indices) > MAX_MEMORY_INDICES:
+            _indices.popitem(last=False)
+    return index
+
+
+def load_joined_packet_index(paths: list[Path]) -> PacketIndex:
+    # 複数の動画ファイルをconcat demuxerで結合した動画の索引を返す (索引ファイルには保存しない)
+    # 各ファイルの長さはPacketIndex.durationとする (concat demuxerのdurationにも同じ値を指定すること)
+    if len(paths) == 1:
+        return load_packet_index(paths[0])
+    pts = []
+    keyframes = []
+    offset = 0.0
+    for path in paths:
+        index = load_packet_index(path)
+        keyframes += [len(pts) + i for i in index.keyframes]
+        pts += [offset + t for t in index.pts]
+        offset += index.duration
+    return PacketIndex(pts=pts, keyframes=keyframes)
+
+
+def _load_index_file(path: Path) -> PacketIndex | None:
+    index_path = get_index_file_path(path)
+    try:
+        with open(index_path, 'r') as f:
+            index = PacketIndex.model_validate_json(f.read())
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f'failed to load packet index: {index_path}: {e}')
+        return None
+    return index if index.is_valid(path) else None
+
+
+def _save_index_file(path: Path, index: PacketIndex):
+    # 書き込めないフォルダーの場合は保存しない (メモリー上の索引だけを使う)
+    index_path = get_index_file_path(path)
+    try:
+        with open(index_path, 'w') as f:
+            f.write(index.model_dump_json())
+    except OSError as e:
+        logger.warning(f'failed to save packet index: {index_path}: {e}')
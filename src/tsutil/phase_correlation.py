@@ -0,0 +1,428 @@
+from typing import Sequence, TextIO
+import threading
+import time
+import numpy as np
+import cv2
+
+# NOTE: ブレ補正のための位相限定相関と剛体変換の推定 (wxPythonに依存しない)
+# - ブレ測定枠は(left, top, right, bottom)のタプル、画像はBGR(またはグレースケール)で受け取る
+# - PhaseCorrelatorはcv2.phaseCorrelate(基準画像, サンプル画像, 窓関数)と同じ計算をnumpyで行い、
+#   基準画像の正規化・窓掛け・フーリエ変換を済ませておく
+#   (cv2.phaseCorrelateはパディングが不要な大きさでは内部のバッファーを使い回し、結果が直前の呼び出しに左右されるので、
+#    常に窓関数を掛けたものを正しい結果とする)
+# - FieldCorrelatorは1つの測定枠のずれを求める。ピラミッド探索(pyramid_levels > 0)では、
+#   1/2をpyramid_levels回繰り返して縮小した測定枠で大まかなずれを求め、元の解像度では測定枠の中央の
+#   refine_sizeの窓だけを大まかなずれの分だけ動かして比較する
+#   (大きな測定枠でもフーリエ変換が小さくて済み、窓の大きさを超える大きなずれも求められる)
+# - 追跡(tracking_size > 0)では、BatchPhaseCorrelatorが直前に求めたずれの位置で、測定枠の中央の
+#   tracking_sizeの窓だけを比較する (手ブレは連続的に変化するので、直前のずれの近くにある)
+#   responseがtracking_min_response未満のフレームは、測定枠の全体(またはピラミッド探索)で求め直す
+#   (1回の呼び出しで渡すK枚を連続したフレームとして扱い、最初のフレームは測定枠の全体で求める。書き出しだけで使う)
+#   予測は直前のフレームのずれだけなので、追跡する測定枠はまとめずに1フレームずつ比較する
+#   (前後のフレームのずれの差が窓の大きさの1/4程度を超えると、追跡できずに測定枠の全体で求め直すことになる)
+# - BatchPhaseCorrelatorは呼び出しの間で状態を持たないので、別々のスレッドから並行して呼び出せる
+# - BatchPhaseCorrelatorは、K枚のサンプル画像を測定枠ごとに重ねた(K, 高さ, 幅)の配列で扱い、
+#   相互パワースペクトル・ピークの検出・ずれの推定(Kabschアルゴリズム)をK枚分まとめて行う
+#   (フーリエ変換はnumpyより速いcv2.dftで1枚ずつ行い、cv2.phaseCorrelateと同じfloat32で計算する)
+
+# MARK: constants
+
+PEAK_BOX_SIZE = 5  # サブピクセルのずれを求めるピークの周囲の大きさ (cv2.phaseCorrelateと同じ)
+DEFAULT_REFINE_SIZE = 128  # ピラミッド探索で、元の解像度で比較する窓の大きさ(ピクセル)
+MIN_PYRAMID_SIZE = 16  # ピラミッド探索で縮小した測定枠の幅・高さの下限 (小さい測定枠では段数を減らす)
+DEFAULT_TRACKING_SIZE = 128  # 追跡で比較する窓の大きさ(ピクセル)
+DEFAULT_TRACKING_MIN_RESPONSE = 0.3  # 追跡で比較した窓のresponseがこれ未満の場合は、測定枠の全体で求め直す
+BATCH_TOLERANCE = 0.01  # まとめて求めたずれと1フレームずつ求めたずれの差の許容値(ピクセル)
+TRACKING_TOLERANCE = 1.0  # 追跡したずれと測定枠の全体で求めたずれの差の許容値(ピクセル)
+
+
+# MARK: phase correlator
+class PhaseCorrelator:
+    # 基準画像の1つの領域と、K枚のサンプル画像の同じ大きさの領域のずれを求める
+
+    def __init__(self, gray_base_crop: np.ndarray):
+        h, w = gray_base_crop.shape
+        self.dft_size = (cv2.getOptimalDFTSize(h), cv2.getOptimalDFTSize(w))
+        self.window = cv2.createHanningWindow((w, h), cv2.CV_32F)
+        self.base_spectrum = self.spectrum(normalize_array(gray_base_crop))
+
+    def spectrum(self, normalized_crops: np.ndarray) -> np.ndarray:
+        # (K, 高さ, 幅)の領域を窓掛けしてパディングし、(K, 高さ, 幅)の複素数の配列にフーリエ変換する
+        # (1枚の場合は(高さ, 幅)で受け取り、(高さ, 幅)で返す)
+        crops = normalized_crops.reshape(-1, *normalized_crops.shape[-2:])
+        h, w = crops.shape[1:]
+        padded = np.zeros((len(crops), *self.dft_size), dtype=np.float32)
+        np.multiply(crops, self.window, out=padded[:, :h, :w])
+        spectra = _dft(padded)
+        return spectra.reshape(*normalized_crops.shape[:-2], *self.dft_size)
+
+    def correlate(self, normalized_crops: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # (K, 高さ, 幅)の正規化したサンプル画像の領域から、((K, 2)のずれ(dx, dy), (K,)のresponse)を返す
+        return _find_phase_peaks(_cross_power(self.base_spectrum, self.spectrum(normalized_crops), self.dft_size))
+
+
+# MARK: field correlator
+class FieldCorrelator:
+    # 1つのブレ測定枠について、基準画像とサンプル画像のずれを求める
+
+    def __init__(
+        self,
+        field: tuple[int, int, int, int],
+        gray_base_image: np.ndarray,
+        pyramid_levels: int = 0,
+        refine_size: int = DEFAULT_REFINE_SIZE,
+        tracking_size: int = 0,
+    ):
+        self.field = field
+        left, top, right, bottom = field
+        self.center = ((left + right) // 2, (top + bottom) // 2)
+        crop = self.crop(gray_base_image)
+        self.pyramid_levels = get_pyramid_levels(crop.shape, pyramid_levels)
+        if self.pyramid_levels:
+            self.coarse = PhaseCorrelator(pyramid_down(crop, self.pyramid_levels))
+            self.refine_rect = get_refine_rect(crop.shape, refine_size)
+        else:
+            self.coarse = None
+            self.refine_rect = (0, 0, crop.shape[1], crop.shape[0])
+        x, y, w, h = self.refine_rect
+        self.fine = PhaseCorrelator(crop[y : y + h, x : x + w])
+        if tracking_size > 0:
+            self.tracking_rect = get_refine_rect(crop.shape, tracking_size)
+            x, y, w, h = self.tracking_rect
+            self.tracker = PhaseCorrelator(crop[y : y + h, x : x + w])
+        else:
+            self.tracking_rect = None
+            self.tracker = None
+
+    def crop(self, image: np.ndarray) -> np.ndarray:
+        # 測定枠の部分だけをグレースケール(float32)にする
+        left, top, right, bottom = self.field
+        crop = image[top:bottom, left:right]
+        if crop.ndim == 3:
+            crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+        return crop.astype(np.float32)
+
+    def correlate(self, crops: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # (K, 高さ, 幅)のサンプル画像の測定枠(crop()の戻り値)から、((K, 2)のずれ(dx, dy), (K,)のresponse)を返す
+        x, y, w, h = self.refine_rect
+        offsets = np.zeros((len(crops), 2), dtype=np.int64)
+        if self.coarse is not None:
+            coarse_crops = np.stack([pyramid_down(c, self.pyramid_levels) for c in crops])
+            coarse_shifts, _ = self.coarse.correlate(normalize_arrays(coarse_crops))
+            offsets = get_refine_offsets(coarse_shifts, self.pyramid_levels, self.refine_rect, crops.shape[1:])
+            crops = np.stack([c[y + oy : y + oy + h, x + ox : x + ox + w] for c, (ox, oy) in zip(crops, offsets)])
+        shifts, responses = self.fine.correlate(normalize_arrays(crops))
+        return shifts + offsets, responses
+
+    def track(
+        self, crops: np.ndarray, predicted_shift: np.ndarray, min_response: float
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # predicted_shift(dx, dy)の位置の窓だけを比較し、((K, 2)のずれ, (K,)のresponse, (K,)の求め直したフレーム)を返す
+        # (responseがmin_response未満のフレームは、correlate()で求め直す)
+        x, y, w, h = self.tracking_rect
+        predicted = np.broadcast_to(predicted_shift, (len(crops), 2))
+        offsets = get_refine_offsets(predicted, 0, self.tracking_rect, crops.shape[1:])
+        windows = np.stack([c[y + oy : y + oy + h, x + ox : x + ox + w] for c, (ox, oy) in zip(crops, offsets)])
+        shifts, responses = self.tracker.correlate(normalize_arrays(windows))
+        shifts = shifts + offsets
+        lost = responses < min_response
+        if np.any(lost):
+            shifts[lost], responses[lost] = self.correlate(crops[lost])
+        return shifts, responses, lost
+
+
+# MARK: batch phase correlator
+class BatchPhaseCorrelator:
+    # 1つのブレ測定枠パターンについて、K枚のサンプル画像のずれと剛体変換をまとめて求める
+
+    def __init__(
+        self,
+        fields: Sequence[tuple[int, int, int, int]],
+        gray_base_image: np.ndarray,
+        pyramid_levels: int = 0,
+        refine_size: int = DEFAULT_REFINE_SIZE,
+        tracking_size: int = 0,
+        tracking_min_response: float = DEFAULT_TRACKING_MIN_RESPONSE,
+    ):
+        self.correlators = [
+            FieldCorrelator(f, gray_base_image, pyramid_levels, refine_size, tracking_size) for f in fields
+        ]
+        self.base_points = np.array([c.center for c in self.correlators], dtype=np.float32).reshape(-1, 2)
+        self.tracking_min_response = tracking_min_response
+        self.tracked_count = 0  # 追跡で求めたフレーム数 (測定枠ごとに数える)
+        self.lost_count = 0  # 追跡できずに測定枠の全体で求め直したフレーム数 (測定枠ごとに数える)
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.correlators)
+
+    def crop(self, image: np.ndarray) -> list[np.ndarray]:
+        # 各測定枠の部分だけをグレースケールにする (フレーム全体を保持せずに、まとめてずれを求めるため)
+        return [c.crop(image) for c in self.correlators]
+
+    def correlate(self, crops: Sequence[Sequence[np.ndarray]]) -> tuple[np.ndarray, np.ndarray]:
+        # K枚分のcrop()の戻り値から、((K, 測定枠の数, 2)のずれ(dx, dy), (K, 測定枠の数)のresponse)を返す
+        shifts = np.zeros((len(crops), len(self.correlators), 2), dtype=np.float64)
+        responses = np.zeros((len(crops), len(self.correlators)), dtype=np.float64)
+        for j, c in enumerate(self.correlators):
+            stacked = np.stack([i[j] for i in crops])
+            if c.tracker is None:
+                shifts[:, j], responses[:, j] = c.correlate(stacked)
+                continue
+            # 追跡する測定枠は、1フレームずつ直前のフレームのずれの近くを探す
+            # (最初のフレームと、求められなかったフレームの次は、測定枠の全体で求める)
+            last_shift = None
+            tracked = lost_count = 0
+            for k in range(len(stacked)):
+                crop = stacked[k : k + 1]
+                if last_shift is None:
+                    shift, response = c.correlate(crop)
+                else:
+                    shift, response, lost = c.track(crop, last_shift, self.tracking_min_response)
+                    tracked += 1
+                    lost_count += int(lost[0])
+                shifts[k, j], responses[k, j] = shift[0], response[0]
+                last_shift = shift[0] if response[0] >= self.tracking_min_response else None
+            with self.__lock:
+                self.tracked_count += tracked
+                self.lost_count += lost_count
+        return shifts, responses
+
+    def estimate(self, crops: Sequence[Sequence[np.ndarray]]) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # ((K, 3, 3)の変換行列, (K,)の回転角, (K, 2)の平行移動量, (K, 測定枠の数)のresponse)を返す
+        # (DeshakingCorrection.compute()のestimated_matrix, estimated_angle, (estimated_dx, estimated_dy)に相当する)
+        shifts, responses = self.correlate(crops)
+        sample_points = (self.base_points + shifts).astype(np.float32)
+        base_points = np.broadcast_to(self.base_points, sample_points.shape)
+        mats, angles, offsets = estimate_rigid_transforms(sample_points, base_points)
+        return mats, angles, offsets, responses
+
+
+# MARK: functions
+
+
+def normalize_array(src: np.ndarray) -> np.ndarray:
+    min = np.min(src)
+    max = np.max(src)
+    if min == max:
+        return np.full_like(src, 0)
+    return (src - min) / (max - min)
+
+
+def normalize_arrays(src: np.ndarray) -> np.ndarray:
+    # (K, 高さ, 幅)の配列を1枚ずつnormalize_array()する
+    min = src.min(axis=(1, 2), keepdims=True)
+    d = src.max(axis=(1, 2), keepdims=True) - min
+    scale = np.divide(1, d, out=np.zeros_like(d), where=d > 0)
+    return (src - min) * scale
+
+
+def pyramid_down(image: np.ndarray, levels: int) -> np.ndarray:
+    # 1/2の縮小をlevels回繰り返す
+    for _ in range(levels):
+        image = cv2.pyrDown(image)
+    return image
+
+
+def get_pyramid_levels(shape: tuple[int, ...], levels: int) -> int:
+    # 縮小した幅・高さがMIN_PYRAMID_SIZE以上になるように段数を減らす
+    while levels > 0 and min(shape[:2]) >> levels < MIN_PYRAMID_SIZE:
+        levels -= 1
+    return max(0, levels)
+
+
+def get_refine_rect(shape: tuple[int, ...], refine_size: int) -> tuple[int, int, int, int]:
+    # 測定枠の中央のrefine_sizeの窓(x, y, 幅, 高さ) (測定枠の方が小さい場合は測定枠の大きさ)
+    h, w = shape[:2]
+    rw, rh = min(w, refine_size), min(h, refine_size)
+    return w // 2 - rw // 2, h // 2 - rh // 2, rw, rh
+
+
+def get_refine_offsets(
+    coarse_shifts: np.ndarray, levels: int, refine_rect: tuple[int, int, int, int], shape: tuple[int, ...]
+) -> np.ndarray:
+    # 縮小した測定枠の(K, 2)のずれから、サンプル画像の窓を動かす(K, 2)の整数のずれを求める
+    # (窓は測定枠の外に出ないようにする)
+    x, y, w, h = refine_rect
+    offsets = np.rint(coarse_shifts * (1 << levels)).astype(np.int64)
+    offsets[:, 0] = np.clip(offsets[:, 0], -x, shape[1] - w - x)
+    offsets[:, 1] = np.clip(offsets[:, 1], -y, shape[0] - h - y)
+    return offsets
+
+
+def phase_correlate_fields(
+    gray_base_image: np.ndarray,
+    gray_sample_image: np.ndarray,
+    fields: Sequence[tuple[int, int, int, int]],
+    fd: TextIO | None = None,
+    frame_info: str = '',
+    pyramid_levels: int = 0,
+    refine_size: int = DEFAULT_REFINE_SIZE,
+) -> tuple[np.ndarray, np.ndarray]:
+    # 1フレームの各測定枠をcv2.phaseCorrelateで比較し、((測定枠の数, 2)のずれ, (測定枠の数,)のresponse)を返す
+    # ピラミッド探索はBatchPhaseCorrelatorで求める (書き出しと同じ結果にする)
+    if pyramid_levels > 0:
+        correlator = BatchPhaseCorrelator(fields, gray_base_image, pyramid_levels, refine_size)
+        shifts, responses = correlator.correlate([correlator.crop(gray_sample_image)])
+        shifts, responses = shifts[0], responses[0]
+        if fd:
+            for i, c in enumerate(correlator.correlators):
+                print(
+                    f'{frame_info}A{i + 1}: levels={c.pyramid_levels} delta={tuple(shifts[i])} response={responses[i]}',
+                    file=fd,
+                )
+        return shifts, responses
+    shifts = np.zeros((len(fields), 2), dtype=np.float64)
+    responses = np.zeros(len(fields), dtype=np.float64)
+    for i, (left, top, right, bottom) in enumerate(fields):
+        hann = cv2.createHanningWindow((right - left, bottom - top), cv2.CV_32F)
+        delta, response = cv2.phaseCorrelate(
+            normalize_array(gray_base_image[top:bottom, left:right]),
+            normalize_array(gray_sample_image[top:bottom, left:right]),
+            hann,
+        )
+        if fd:
+            print(f'{frame_info}A{i + 1}: {delta=} {response=}', file=fd)
+        shifts[i] = delta
+        responses[i] = response
+    return shifts, responses
+
+
+def estimate_rigid_transform_homography(
+    src1: np.ndarray, src2: np.ndarray
+) -> tuple[np.ndarray, np.float32, np.ndarray]:
+    mats, angles, offsets = estimate_rigid_transforms(src1[np.newaxis], src2[np.newaxis])
+    return mats[0], angles[0], offsets[0]
+
+
+def estimate_rigid_transforms(src1: np.ndarray, src2: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # (K, 点の数, 2)の点の組ごとに、src1をsrc2に重ねる回転+平行移動を求める
+    # 1. 重心で中心化
+    centroid1 = np.mean(src1, axis=1, keepdims=True)
+    centroid2 = np.mean(src2, axis=1, keepdims=True)
+    centered1 = src1 - centroid1
+    centered2 = src2 - centroid2
+
+    # 2. 最小二乗誤差で回転行列を求める（SVD）
+    #    Kabschアルゴリズム: https://en.wikipedia.org/wiki/Kabsch_algorithm
+    H = centered1.transpose(0, 2, 1) @ centered2
+    U, S, Vt = np.linalg.svd(H)
+    R = Vt.transpose(0, 2, 1) @ U.transpose(0, 2, 1)
+
+    # 反転のチェック（反射対策）
+    flip = np.linalg.det(R) < 0
+    if np.any(flip):
+        Vt[flip, 1, :] *= -1
+        R = Vt.transpose(0, 2, 1) @ U.transpose(0, 2, 1)
+
+    # 3. 並進ベクトル
+    t = centroid2[:, 0] - (R @ centroid1[:, 0, :, np.newaxis])[:, :, 0]
+
+    # 4. アフィン行列（2×3）→ ホモグラフィ行列（3×3）に拡張
+    H_affine = np.tile(np.eye(3, dtype=np.float32), (len(src1), 1, 1))
+    H_affine[:, :2, :2] = R.astype(np.float32)
+    H_affine[:, :2, 2] = t.astype(np.float32)
+
+    # 5. 回転角の算出
+    theta_deg = np.degrees(np.arctan2(R[:, 1, 0], R[:, 0, 0]))
+
+    # 6. 戻り値は(回転+平行移動のアフィン変換行列(K×3x3), 回転角, 平行移動量
+    return H_affine, theta_deg, H_affine[:, :2, 2]
+
+
+def benchmark_phase_correlation(
+    base_image: np.ndarray,
+    sample_images: Sequence[np.ndarray],
+    fields: Sequence[tuple[int, int, int, int]],
+    batch_size: int = 16,
+    pyramid_levels: int = 0,
+    refine_size: int = DEFAULT_REFINE_SIZE,
+    tracking_size: int = 0,
+    tolerance: float | None = None,
+) -> tuple[float, float, float]:
+    # 1フレームずつphase_correlate_fields()で求める場合と、batch_size枚ずつまとめて求める場合の
+    # (1フレームずつの毎秒フレーム数, まとめた場合の毎秒フレーム数, ずれの差の最大値(ピクセル))を返す
+    # (どちらもグレースケールへの変換とずれの推定を含む。tracking_size > 0の場合は、まとめた方で追跡する)
+    # ずれの差がtolerance(省略時はBATCH_TOLERANCE、追跡する場合はTRACKING_TOLERANCE)を超えた場合はRuntimeErrorを送出する
+    gray_base_image = cv2.cvtColor(base_image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    base_points = np.array([((f[0] + f[2]) // 2, (f[1] + f[3]) // 2) for f in fields], dtype=np.float32)
+    start_time = time.perf_counter()
+    single_shifts = []
+    for image in sample_images:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        shifts, _ = phase_correlate_fields(
+            gray_base_image, gray, fields, pyramid_levels=pyramid_levels, refine_size=refine_size
+        )
+        estimate_rigid_transform_homography((base_points + shifts).astype(np.float32), base_points)
+        single_shifts.append(shifts)
+    single_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    correlator = BatchPhaseCorrelator(fields, gray_base_image, pyramid_levels, refine_size, tracking_size)
+    batch_shifts = []
+    for i in range(0, len(sample_images), batch_size):
+        shifts, _ = correlator.correlate([correlator.crop(image) for image in sample_images[i : i + batch_size]])
+        sample_points = (correlator.base_points + shifts).astype(np.float32)
+        estimate_rigid_transforms(sample_points, np.broadcast_to(correlator.base_points, sample_points.shape))
+        batch_shifts.append(shifts)
+    batch_time = time.perf_counter() - start_time
+
+    diff = float(np.abs(np.concatenate(batch_shifts) - np.array(single_shifts)).max()) if single_shifts else 0.0
+    if tolerance is None:
+        tolerance = TRACKING_TOLERANCE if tracking_size > 0 else BATCH_TOLERANCE
+    if diff > tolerance:
+        raise RuntimeError(f'batch shifts differ from single shifts by {diff:.4f} px (tolerance {tolerance} px)')
+    n = len(sample_images)
+    return n / single_time, n / batch_time, diff
+
+
+def _cross_power(base_spectrum: np.ndarray, sample_spectrum: np.ndarray, dft_size: tuple[int, int]) -> np.ndarray:
+    # 正規化した相互パワースペクトルを逆変換する (sample_spectrumは上書きする)
+    # (OpenCVのfftShift()で象限を入れ替える代わりに、_find_phase_peaks()で位置を読み替える)
+    p = np.conjugate(sample_spectrum, out=sample_spectrum)
+    p *= base_spectrum
+    magnitude = np.abs(p)
+    np.maximum(magnitude, np.finfo(np.float32).tiny, out=magnitude)
+    p /= magnitude
+    return _idft_real(p.reshape(-1, *dft_size))
+
+
+def _dft(arrays: np.ndarray) -> np.ndarray:
+    # (K, 高さ, 幅)のfloat32の配列を1枚ずつフーリエ変換し、(K, 高さ, 幅)のcomplex64の配列にする
+    spectra = np.empty((*arrays.shape, 2), dtype=np.float32)
+    for i, array in enumerate(arrays):
+        spectra[i] = cv2.dft(array, flags=cv2.DFT_COMPLEX_OUTPUT)
+    return spectra.view(np.complex64)[..., 0]
+
+
+def _idft_real(spectra: np.ndarray) -> np.ndarray:
+    # (K, 高さ, 幅)のcomplex64の配列を1枚ずつ逆フーリエ変換し、実部を(K, 高さ, 幅)のfloat32の配列にする
+    arrays = np.empty(spectra.shape, dtype=np.float32)
+    planes = spectra[..., np.newaxis].view(np.float32)
+    for i, plane in enumerate(planes):
+        arrays[i] = cv2.idft(plane, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+    return arrays
+
+
+def _find_phase_peaks(c: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # (K, 高さ, 幅)の相関ごとに、ピークの周囲の重心をサブピクセルのずれ、その合計をresponseとする
+    # (画像の端にかかる部分は除く。cv2.phaseCorrelateと同じ)
+    # cはfftShift()の前の相関で、fftShift()後の位置iの値はc[(i - 大きさ // 2) % 大きさ]
+    k, rows, cols = c.shape
+    py, px = np.divmod(c.reshape(k, -1).argmax(axis=1), cols)
+    py, px = (py + rows // 2) % rows, (px + cols // 2) % cols
+    offsets = np.arange(PEAK_BOX_SIZE) - PEAK_BOX_SIZE // 2
+    ys = py[:, np.newaxis] + offsets
+    xs = px[:, np.newaxis] + offsets
+    valid = ((ys >= 0) & (ys < rows))[:, :, np.newaxis] & ((xs >= 0) & (xs < cols))[:, np.newaxis, :]
+    box = c[
+        np.arange(k)[:, np.newaxis, np.newaxis],
+        ((np.clip(ys, 0, rows - 1) - rows // 2) % rows)[:, :, np.newaxis],
+        ((np.clip(xs, 0, cols - 1) - cols // 2) % cols)[:, np.newaxis, :],
+    ]
+    box = np.where(valid, box, 0)
+    responses = box.sum(axis=(1, 2))
+    total = responses + np.finfo(np.float64).eps
+    cy = (box.sum(axis=2) * ys).sum(axis=1) / total
+    cx = (box.sum(axis=1) * xs).sum(axis=1) / total
+    return np.stack([cols / 2 - cx, rows / 2 - cy], axis=1), responses
@@ -0,0 +1,207 @@
+from typing import Any, Callable, Iterable, Iterator
+import itertools
+import threading
+import logging
+import queue
+import time
+
+# NOTE: デコード→変換→エンコード→書き込みのような多段の処理を、段ごとのスレッド数で並行して実行する (wxPythonに依存しない)
+# - 段と段の間はサイズ制限付きのキューでつなぐので、遅い段があっても処理中のフレームの数(メモリー使用量)は一定に保たれる
+# - 出力はフレーム番号順に並べ替えて返す (並べ替えバッファーには最後の段の出力だけが溜まる)
+# - 段の関数がNoneを返した場合、そのフレームは後段に渡さずに破棄する
+
+# MARK: constants
+
+QUEUE_TIMEOUT = 0.1  # キャンセルを確認する間隔(秒)
+
+logger = logging.getLogger('tsutil')
+
+_END = object()  # ストリームの終端
+_DROPPED = object()  # 段の関数が破棄したフレーム
+
+
+# MARK: pipeline stage
+class PipelineStage:
+    def __init__(self, name: str, func: Callable[[int, Any], Any], workers: int = 1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.count = 0
+        self.busy_time = 0.0  # funcの実行時間の合計
+        self.starved_time = 0.0  # 前段の出力を待っていた時間の合計
+        self.blocked_time = 0.0  # 後段が空くのを待っていた時間の合計
+        self.__lock = threading.Lock()
+
+    def add_stats(self, busy_time: float, starved_time: float, blocked_time: float):
+        with self.__lock:
+            self.count += 1
+            self.busy_time += busy_time
+            self.starved_time += starved_time
+            self.blocked_time += blocked_time
+
+    def get_load(self) -> float:
+        # 1スレッドあたりの実行時間 (最も大きい段がボトルネック)
+        return self.busy_time / self.workers
+
+
+# MARK: pipeline
+class Pipeline:
+    def __init__(self, stages: list[PipelineStage], queue_size: int | None = None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.__cancel = threading.Event()
+        self.__error: BaseException | None = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__cancel.is_set()
+
+    def cancel(self):
+        self.__cancel.set()
+
+    def run(
+        self,
+        source: Iterable[tuple[int, Any]],
+        ordered: bool = True,
+        start: int = 0,
+        step: int = 1,
+        order: Iterable[int] | None = None,
+    ) -> Iterator[tuple[int, Any]]:
+        # source: (フレーム番号, データ)を返すイテレーター (別スレッドで読み出す)
+        # ordered=Trueの場合はstartからstepおきのフレーム番号の順に出力する
+        # (orderを指定した場合は、その順に出力する。飛び飛びの範囲を読み込む場合など)
+        self.__cancel.clear()
+        self.__error = None
+        queues = [queue.Queue(maxsize=self.queue_size or stage.workers * 2) for stage in self.stages] + [
+            queue.Queue(maxsize=self.queue_size or 8)
+        ]
+        threads = [threading.Thread(target=self.__feed, args=(source, queues[0]), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for _ in range(stage.workers):
+                threads.append(
+                    threading.Thread(
+                        target=self.__work, args=(stage, queues[i], queues[i + 1], remaining, lock), daemon=True
+                    )
+                )
+        for th in threads:
+            th.start()
+
+        pending = {}
+        order = iter(order) if order is not None else itertools.count(start, step)
+        next_index = next(order, None)
+        try:
+            while True:
+                item = self.__get(queues[-1])[0]
+                if item is _END or item is None:
+                    break
+                index, value = item
+                if not ordered:
+                    if value is not _DROPPED:
+                        yield index, value
+                    continue
+                pending[index] = value
+                while next_index in pending:
+                    value = pending.pop(next_index)
+                    if value is not _DROPPED:
+                        yield next_index, value
+                    next_index = next(order, None)
+            if self.__error:
+                raise self.__error
+            # フレーム番号が連続していない場合も、残りを番号順に出力する
+            for index in sorted(pending.keys()):
+                if pending[index] is not _DROPPED:
+                    yield index, pending[index]
+        finally:
+            self.cancel()
+            for th in threads:
+                th.join()
+            self.log_stats()
+
+    def log_stats(self):
+        if not self.stages:
+            return
+        bottleneck = max(self.stages, key=lambda stage: stage.get_load())
+        for stage in self.stages:
+            logger.debug(
+                f'pipeline stage {stage.name}: {stage.count} items, {stage.workers} workers, '
+                f'busy {stage.busy_time:.2f}s, starved {stage.starved_time:.2f}s, blocked {stage.blocked_time:.2f}s'
+                + (' (bottleneck)' if stage is bottleneck else '')
+            )
+
+    def __fail(self, e: BaseException):
+        if self.__error is None:
+            self.__error = e
+        self.cancel()
+
+    def __put(self, q: queue.Queue, item) -> float:
+        # 後段が空くまで待った時間を返す (キャンセルされた場合は諦める)
+        start_time = time.perf_counter()
+        while not self.__cancel.is_set():
+            try:
+                q.put(item, timeout=QUEUE_TIMEOUT)
+                break
+            except queue.Full:
+                pass
+        return time.perf_counter() - start_time
+
+    def __get(self, q: queue.Queue) -> tuple[Any, float]:
+        # (前段の出力, 待った時間)を返す (キャンセルされた場合はNone)
+        start_time = time.perf_counter()
+        while not self.__cancel.is_set():
+            try:
+                return q.get(timeout=QUEUE_TIMEOUT), time.perf_counter() - start_time
+            except queue.Empty:
+                pass
+        return None, time.perf_counter() - start_time
+
+    def __feed(self, source: Iterable[tuple[int, Any]], q: queue.Queue):
+        try:
+            for item in source:
+                if self.__cancel.is_set():
+                    break
+                self.__put(q, item)
+        except BaseException as e:
+            self.__fail(e)
+        finally:
+            # ジェネレーターの後始末 (read_frames()の並列デコードのスレッドを止める)
+            close = getattr(source, 'close', None)
+            if close:
+                close()
+            self.__put(q, _END)
+
+    def __work(
+        self,
+        stage: PipelineStage,
+        input_queue: queue.Queue,
+        output_queue: queue.Queue,
+        remaining: list[int],
+        lock: threading.Lock,
+    ):
+        try:
+            while True:
+                item, starved_time = self.__get(input_queue)
+                if item is None:
+                    break
+                if item is _END:
+                    # 同じ段の他のスレッドにも終端を知らせる
+                    self.__put(input_queue, _END)
+                    break
+                index, value = item
+                start_time = time.perf_counter()
+                if value is not _DROPPED:
+                    value = stage.func(index, value)
+                    if value is None:
+                        value = _DROPPED
+                busy_time = time.perf_counter() - start_time
+                blocked_time = self.__put(output_queue, (index, value))
+                stage.add_stats(busy_time, starved_time, blocked_time)
+        except BaseException as e:
+            self.__fail(e)
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.__put(output_queue, _END)
@@ -0,0 +1,166 @@
+from pathlib import Path
+from collections import OrderedDict
+from fffio import Probe
+from .packet_index import PacketIndex, load_packet_index
+import subprocess
+import threading
+import logging
+import json
+import ffmpeg
+import numpy as np
+
+# MARK: constants
+
+PREVIEW_CACHE_SIZE = 512 * 1024 * 1024  # bytes
+BACKWARD_FRAMES = 8  # シーク時に指定位置より手前から読み込んでキャッシュしておくフレーム数
+FORWARD_FRAMES = 30  # この範囲内の前方移動はシークせずに読み進める
+
+logger = logging.getLogger('tsutil')
+
+
+# MARK: LRU frame cache
+class FrameCache:
+    def __init__(self, max_bytes: int = PREVIEW_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.__frames: OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__frames)
+
+    def get(self, key: tuple) -> np.ndarray | None:
+        with self.__lock:
+            frame = self.__frames.get(key)
+            if frame is not None:
+                self.__frames.move_to_end(key)
+            return frame
+
+    def put(self, key: tuple, frame: np.ndarray):
+        with self.__lock:
+            old = self.__frames.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.__frames[key] = frame
+            self.nbytes += frame.nbytes
+            # 最低1フレームは保持する
+            while self.nbytes > self.max_bytes and len(self.__frames) > 1:
+                _, oldest = self.__frames.popitem(last=False)
+                self.nbytes -= oldest.nbytes
+
+    def clear(self):
+        with self.__lock:
+            self.__frames.clear()
+            self.nbytes = 0
+
+
+# MARK: preview decoder
+class PreviewDecoder:
+    def __init__(self, cache_size: int = PREVIEW_CACHE_SIZE):
+        self.cache = FrameCache(cache_size)
+        self.path: Path | None = None
+        self.probe: Probe | None = None
+        self.packet_index: PacketIndex | None = None
+        self.width = 0
+        self.height = 0
+        self.__process: subprocess.Popen | None = None
+        self.__filter_key: str | None = None
+        self.__next_position: int | None = None
+        self.__lock = threading.Lock()
+
+    def open(self, path: Path, probe: Probe | None = None):
+        with self.__lock:
+            self.__stop_process()
+            self.cache.clear()
+            self.path = path
+            self.probe = probe or Probe(path)
+            self.packet_index = None
+            if self.probe.rotation % 180:
+                self.width, self.height = self.probe.height, self.probe.width
+            else:
+                self.width, self.height = self.probe.width, self.probe.height
+
+    def close(self):
+        with self.__lock:
+            self.__stop_process()
+            self.cache.clear()
+            self.path = None
+            self.probe = None
+            self.packet_index = None
+
+    def read_frame(self, position: int, filter_complex: dict | None = None) -> np.ndarray:
+        if self.path is None:
+            raise Exception('No video is opened.')
+        filter_key = make_filter_key(filter_complex)
+        frame = self.cache.get((position, filter_key))
+        if frame is not None:
+            return frame
+        with self.__lock:
+            if (
+                self.__process is None
+                or self.__filter_key != filter_key
+                or not (self.__next_position <= position <= self.__next_position + FORWARD_FRAMES)
+            ):
+                self.__start_process(max(0, position - BACKWARD_FRAMES), filter_complex, filter_key)
+            while self.__next_position <= position:
+                frame = self.__read()
+                self.cache.put((self.__next_position, filter_key), frame)
+                self.__next_position += 1
+            return frame
+
+    def __start_process(self, position: int, filter_complex: dict | None, filter_key: str):
+        self.__stop_process()
+        # 可変フレームレートの動画でも指定位置のフレームから読み込めるように、パケットの表示時刻でシークする
+        # (索引は動画のサムネイルの読み込み時に作成されているので、通常はメモリー上から取得できる)
+        if self.packet_index is None:
+            self.packet_index = load_packet_index(self.path)
+        stream = ffmpeg.input(str(self.path), ss=self.packet_index.seek_time(position)).video
+        if filter_complex:
+            for k, v in filter_complex.items():
+                if type(v) is dict:
+                    stream = stream.filter_(k, **v)
+                elif type(v) is list or type(v) is tuple:
+                    stream = stream.filter_(k, *v)
+                else:
+                    stream = stream.filter_(k, v)
+        # 可変フレームレートの動画でフレームを複製しないように、パケットの表示時刻のまま出力する
+        args = stream.output(
+            'pipe:', format='rawvideo', pix_fmt='rgb24', fps_mode='passthrough', loglevel='error'
+        ).compile()
+        logger.debug(f'preview decoder: {args}')
+        self.__process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.__filter_key = filter_key
+        self.__next_position = position
+
+    def __stop_process(self):
+        process = self.__process
+        if process is None:
+            return
+        self.__process = None
+        self.__filter_key = None
+        self.__next_position = None
+        try:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+            process.stderr.close()
+        except Exception:
+            pass
+
+    def __read(self) -> np.ndarray:
+        size = self.width * self.height * 3
+        buf = self.__process.stdout.read(size)
+        if len(buf) < size:
+            self.__process.wait()
+            err = self.__process.stderr.read().decode('utf-8', errors='replace')
+            self.__stop_process()
+            raise Exception(f'フレームを読み込めませんでした。{err}')
+        return np.frombuffer(buf, np.uint8).reshape(self.height, self.width, 3)
+
+
+# MARK: functions
+
+
+def make_filter_key(filter_complex: dict | None) -> str:
+    # フィルターの適用順序も区別するため、キーのソートは行わない
+    return json.dumps(filter_complex or {})
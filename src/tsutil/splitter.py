@@ -1,11 +1,19 @@
 import wx
 import wx.adv
 import cv2
-from .common import make_file_picker_ctrl, IMAGE_CATALOG_FILE_WILDCARD, dpi_aware_size, get_path, path_exists
+from .common import (
+    make_file_picker_ctrl,
+    IMAGE_CATALOG_FILE_WILDCARD,
+    IMAGE_SOURCE_FILE_WILDCARD,
+    dpi_aware_size,
+    get_path,
+    path_exists,
+)
 from .tool_frame import ToolFrame
 from .components.video_thumbnail import VideoThumbnail, EVT_VIDEO_LOADED, EVT_VIDEO_POSITION_CHANGED
 from .components.image_viewer import ImageViewer
 from .functions import get_common_prefix
+from .frame_stack import is_frame_stack, read_image
 
 # MARK: constants
 
@@ -38,7 +46,7 @@ class MainFrame(ToolFrame):
         self.input_file_picker = make_file_picker_ctrl(
             input_file_panel,
             message='分割する連続画像のカタログファイルを選択してください。',
-            wildcard=IMAGE_CATALOG_FILE_WILDCARD,
+            wildcard=IMAGE_SOURCE_FILE_WILDCARD,
             style=wx.FLP_OPEN | wx.FLP_USE_TEXTCTRL | wx.FLP_FILE_MUST_EXIST,
         )
         self.input_file_picker.Bind(wx.EVT_FILEPICKER_CHANGED, self.__on_input_file_changed)
@@ -204,7 +212,7 @@ class MainFrame(ToolFrame):
         if not image_catalog:
             self.previewer.clear()
             return
-        frame = cv2.imread(str(image_catalog[position]), cv2.IMREAD_UNCHANGED)
+        frame = read_image(image_catalog[position])
         if frame is None:
             self.previewer.clear()
             return
@@ -277,6 +285,14 @@ class MainFrame(ToolFrame):
             event.Skip()
             return
         input_path = get_path(self.input_file_picker.GetPath())
+        if is_frame_stack(input_path):
+            wx.MessageBox(
+                'フレームスタックは分割できません。\ntsutil-stack-exportコマンドでカタログファイルに書き出してください。',
+                'エラー',
+                wx.OK | wx.ICON_ERROR,
+            )
+            event.Skip()
+            return
         output_dir, fn, ext = input_path.parent, input_path.stem, input_path.suffix
         files = list(output_dir.glob(f'{fn}_*{ext}'))
         print(files)
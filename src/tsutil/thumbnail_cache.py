@@ -0,0 +1,221 @@
+from pathlib import Path
+import hashlib
+import logging
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+from dotenv import load_dotenv
+
+# tsutil-cacheコマンドからも.envファイルの設定を読み込む
+load_dotenv()
+
+# NOTE: VideoThumbnailのサムネイルとヒストグラムのキャッシュ (wxPythonに依存しない)
+# - キーは動画ファイル(またはカタログファイルと各画像ファイル)のパス・サイズ・更新日時と読み込み時の設定から作る
+#   (ファイルが更新されるとキーが変わるので、古いキャッシュは容量の上限を超えたときに削除される)
+# - 同じ画像を指すフレーム(間引いて読み込んだ場合)は1つにまとめて、サムネイルはnpy形式(非圧縮)、
+#   フレームとサムネイルの対応とヒストグラムはnpz形式の2つのファイルに保存する
+# - 読み込んだキャッシュファイルの更新日時を更新し、古いものから削除する(LRU)
+
+# MARK: constants
+
+FRAMES_EXTENSION = '.npy'
+META_EXTENSION = '.npz'
+TEMP_PREFIX = 'tmp'  # 書き込み途中の一時ファイル (キーはsha1の16進数なので重ならない)
+DEFAULT_CACHE_SIZE_MB = 2048
+
+logger = logging.getLogger('tsutil')
+
+
+# MARK: functions
+
+
+def get_cache_dir() -> Path:
+    # 環境変数TSUTIL_CACHE_DIRで変更できる
+    if os.environ.get('TSUTIL_CACHE_DIR'):
+        return Path(os.environ['TSUTIL_CACHE_DIR'])
+    if sys.platform == 'win32':
+        base = Path(os.environ.get('LOCALAPPDATA') or Path.home() / 'AppData' / 'Local')
+    elif sys.platform == 'darwin':
+        base = Path.home() / 'Library' / 'Caches'
+    else:
+        base = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache')
+    return base / 'tsutil' / 'thumbnails'
+
+
+def get_cache_size_limit() -> int:
+    # 環境変数TSUTIL_CACHE_SIZE_MBで変更できる (0の場合はキャッシュを使わない)
+    try:
+        return int(os.environ.get('TSUTIL_CACHE_SIZE_MB', DEFAULT_CACHE_SIZE_MB)) * 1024 * 1024
+    except ValueError:
+        return DEFAULT_CACHE_SIZE_MB * 1024 * 1024
+
+
+def is_cache_enabled() -> bool:
+    return get_cache_size_limit() > 0
+
+
+def _make_key(params: dict) -> str:
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _stat(path: Path) -> tuple[int, int]:
+    try:
+        st = path.stat()
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return -1, -1
+
+
+def make_video_cache_key(path: Path | list[Path], **params) -> str:
+    # paramsには回転・フィルター・サムネイルの高さなど、サムネイルの内容を変える設定を渡す
+    # 複数の動画ファイルを結合して読み込む場合はリストで渡す
+    if isinstance(path, list):
+        if len(path) > 1:
+            clips = [(str(i.resolve()), _stat(i)) for i in path]
+            return _make_key(dict(kind='video', clips=clips, **params))
+        path = path[0]
+    return _make_key(dict(kind='video', path=str(path.resolve()), stat=_stat(path), **params))
+
+
+def make_catalog_cache_key(path: Path, entries: list, **params) -> str:
+    # entriesはread_image_catalog()の戻り値 (フレームスタックの場合はファイル自体のサイズ・更新日時で判定する)
+    h = hashlib.sha1()
+    for entry in entries:
+        if isinstance(entry, Path):
+            h.update(f'{entry}\t{_stat(entry)}\n'.encode('utf-8'))
+    return _make_key(dict(kind='catalog', path=str(path.resolve()), stat=_stat(path), entries=h.hexdigest(), **params))
+
+
+def load_thumbnails(key: str) -> tuple[list[np.ndarray], np.ndarray | None] | None:
+    # (サムネイルのリスト, ヒストグラム)を返す (キャッシュが無い場合はNone)
+    if not is_cache_enabled():
+        return None
+    frames_path, meta_path = _get_cache_paths(key)
+    try:
+        with np.load(meta_path, allow_pickle=False) as meta:
+            indices = meta['indices']
+            histogram = meta['histogram'] if 'histogram' in meta else None
+        # 読み込む側で必要な行だけをコピーできるように、メモリーマップで開く
+        unique_frames = np.load(frames_path, mmap_mode='r', allow_pickle=False)
+        os.utime(frames_path)
+        os.utime(meta_path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f'failed to load thumbnail cache: {frames_path}: {e}')
+        return None
+    logger.debug(f'thumbnail cache hit: {frames_path}')
+    # 同じ画像を指すフレームは同じオブジェクトにする
+    views = list(unique_frames)
+    return [views[i] for i in indices], histogram
+
+
+def save_thumbnails(key: str, frames: list[np.ndarray], histogram: np.ndarray | None = None):
+    if not is_cache_enabled() or not frames:
+        return
+    # 同じ配列を指すフレームは1つにまとめる
+    ids: dict[int, int] = {}
+    unique_frames = []
+    indices = np.empty(len(frames), dtype=np.int32)
+    for i, frame in enumerate(frames):
+        j = ids.get(id(frame))
+        if j is None:
+            j = ids[id(frame)] = len(unique_frames)
+            unique_frames.append(frame)
+        indices[i] = j
+    shape = unique_frames[0].shape
+    if any(frame.shape != shape or frame.dtype != unique_frames[0].dtype for frame in unique_frames):
+        logger.debug('thumbnail cache skipped: frames have different sizes')
+        return
+    cache_dir = get_cache_dir()
+    frames_path, meta_path = _get_cache_paths(key)
+    temp_paths = []
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for suffix in (FRAMES_EXTENSION, META_EXTENSION):
+            fd, temp_path = tempfile.mkstemp(suffix=suffix, prefix=TEMP_PREFIX, dir=cache_dir)
+            os.close(fd)
+            temp_paths.append(temp_path)
+        # 全フレームを1つの配列にまとめるとメモリーを倍使うので、1フレームずつファイルに書き込む
+        mm = np.lib.format.open_memmap(
+            temp_paths[0], mode='w+', dtype=unique_frames[0].dtype, shape=(len(unique_frames), *shape)
+        )
+        for i, frame in enumerate(unique_frames):
+            mm[i] = frame
+        mm.flush()
+        del mm
+        meta = dict(indices=indices)
+        if histogram is not None:
+            meta['histogram'] = histogram
+        with open(temp_paths[1], 'wb') as f:
+            np.savez(f, **meta)
+        os.replace(temp_paths[0], frames_path)
+        os.replace(temp_paths[1], meta_path)
+    except OSError as e:
+        logger.warning(f'failed to save thumbnail cache: {e}')
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return
+    evict_thumbnail_cache()
+
+
+def _get_cache_paths(key: str) -> tuple[Path, Path]:
+    cache_dir = get_cache_dir()
+    return cache_dir / (key + FRAMES_EXTENSION), cache_dir / (key + META_EXTENSION)
+
+
+def get_cache_entries() -> list[tuple[Path, int]]:
+    # キャッシュごとに(サムネイルのファイルのパス, 合計サイズ)を古い(最後に使ったのが前の)順に返す
+    cache_dir = get_cache_dir()
+    if not cache_dir.exists():
+        return []
+    entries = []
+    for path in cache_dir.glob('*' + FRAMES_EXTENSION):
+        if path.name.startswith(TEMP_PREFIX):
+            continue
+        try:
+            st = path.stat()
+            meta_path = path.with_suffix(META_EXTENSION)
+            size = st.st_size + (meta_path.stat().st_size if meta_path.exists() else 0)
+            entries.append((st.st_mtime, path, size))
+        except OSError:
+            pass
+    return [(path, size) for _, path, size in sorted(entries)]
+
+
+def _remove_entry(path: Path) -> bool:
+    try:
+        for i in (path, path.with_suffix(META_EXTENSION)):
+            if i.exists():
+                os.remove(i)
+        return True
+    except OSError as e:
+        logger.warning(f'failed to remove thumbnail cache: {path}: {e}')
+        return False
+
+
+def evict_thumbnail_cache(max_bytes: int | None = None):
+    # 合計サイズがmax_bytes以下になるまで古いキャッシュを削除する
+    max_bytes = get_cache_size_limit() if max_bytes is None else max_bytes
+    entries = get_cache_entries()
+    total = sum(size for _, size in entries)
+    for path, size in entries:
+        if total <= max_bytes:
+            break
+        if _remove_entry(path):
+            total -= size
+
+
+def clear_thumbnail_cache() -> int:
+    # 全てのキャッシュを削除して、削除したキャッシュの数を返す
+    count = 0
+    for path, _ in get_cache_entries():
+        if _remove_entry(path):
+            count += 1
+    # 書き込み途中で残った一時ファイルも削除する
+    for path in get_cache_dir().glob(TEMP_PREFIX + '*'):
+        _remove_entry(path)
+    return count
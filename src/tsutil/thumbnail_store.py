@@ -0,0 +1,224 @@
+from typing import Iterable, Iterator
+import logging
+import os
+import tempfile
+import threading
+import numpy as np
+import cv2
+
+# NOTE: VideoThumbnailのサムネイルを1つの(N, H, W, 3)のuint8配列にまとめて保持する (wxPythonに依存しない)
+# - フレームごとに配列を確保しないので、長い動画でもPythonオブジェクトのオーバーヘッドやメモリーの断片化が無い
+# - 各フレームは配列の行を指す番号で、同じサムネイルを表示するフレーム(間引いて読み込んだ場合など)は同じ行を指す
+# - strip_widthを指定した場合は、タイムラインに表示できる中央の幅だけを保持する
+#   (幅の狭いフレームは左詰めで保持し、実際の幅を行ごとに記録する)
+# - 配列の大きさが上限(環境変数TSUTIL_THUMBNAIL_MEMORY_MB)を超える場合は、一時ファイルのメモリーマップに置く
+
+# MARK: constants
+
+DEFAULT_MEMORY_MB = 512
+MIN_CAPACITY = 64
+UNLOADED = -1  # まだ行を割り当てていないフレーム
+
+logger = logging.getLogger('tsutil')
+
+
+# MARK: functions
+
+
+def get_memory_limit() -> int:
+    # 環境変数TSUTIL_THUMBNAIL_MEMORY_MBで変更できる
+    try:
+        return int(os.environ.get('TSUTIL_THUMBNAIL_MEMORY_MB', DEFAULT_MEMORY_MB)) * 1024 * 1024
+    except ValueError:
+        return DEFAULT_MEMORY_MB * 1024 * 1024
+
+
+# MARK: thumbnail store
+class ThumbnailStore:
+    # リストと同じように len(), [i], [i] = frame, append(), extend(), del [n:] で操作できる
+    # [i]は配列の行のビューを返す (同じ行を指すフレームには同じオブジェクトを返す)
+
+    def __init__(self, strip_width: int | None = None, memory_limit: int | None = None):
+        self.strip_width = strip_width
+        self.memory_limit = get_memory_limit() if memory_limit is None else memory_limit
+        self.__capacity = 0
+        self.__rows: np.ndarray | None = None  # (行数, 高さ, 幅, 3)
+        self.__widths = np.zeros(0, dtype=np.int32)  # 行ごとの実際の幅
+        self.__owners = np.zeros(0, dtype=np.int32)  # 行を書き込んだフレーム
+        self.__n_rows = 0
+        self.__slots = np.zeros(0, dtype=np.int32)  # フレームごとの行
+        self.__count = 0
+        self.__views: dict[int, np.ndarray] = {}
+        self.__spill_file = None
+        self.__lock = threading.RLock()
+
+    def __len__(self):
+        return self.__count
+
+    def __bool__(self):
+        return self.__count > 0
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for i in range(self.__count):
+            yield self[i]
+
+    def __getitem__(self, index: int | slice) -> np.ndarray | list[np.ndarray]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.__count))]
+        with self.__lock:
+            if index < 0:
+                index += self.__count
+            if not 0 <= index < self.__count or self.__slots[index] == UNLOADED:
+                raise IndexError('thumbnail index out of range')
+            row = int(self.__slots[index])
+            view = self.__views.get(row)
+            if view is None:
+                view = self.__views[row] = self.__rows[row, :, : self.__widths[row]].view(np.ndarray)
+            return view
+
+    def __setitem__(self, index: int, frame: np.ndarray):
+        with self.__lock:
+            if not 0 <= index < self.__count:
+                raise IndexError('thumbnail index out of range')
+            row = int(self.__slots[index])
+            if row == UNLOADED or self.__owners[row] != index:
+                # 他のフレームの行を指している場合は、新しい行に書き込む
+                row = self.__new_row(frame, index)
+            self.__put(row, frame)
+            self.__slots[index] = row
+
+    def __delitem__(self, index: slice):
+        # 末尾を切り詰める場合(del store[n:])だけに対応する
+        start, stop, step = index.indices(self.__count)
+        if stop != self.__count or step != 1:
+            raise ValueError('only truncation is supported')
+        with self.__lock:
+            self.__count = min(self.__count, start)
+
+    @property
+    def nbytes(self) -> int:
+        return 0 if self.__rows is None else self.__rows.nbytes
+
+    @property
+    def spilled(self) -> bool:
+        return self.__spill_file is not None
+
+    def reset(self, capacity: int = 0, strip_width: int | None = None):
+        # 全てのフレームを削除して、capacity行分を確保し直す (行の大きさは最初のフレームで決まる)
+        with self.__lock:
+            self.__release()
+            self.strip_width = strip_width
+            self.__capacity = capacity
+            self.__n_rows = 0
+            self.__count = 0
+
+    def clear(self):
+        self.reset(0, self.strip_width)
+
+    def append(self, frame: np.ndarray):
+        with self.__lock:
+            self.__resize_slots(self.__count + 1)
+            row = self.__new_row(frame, self.__count)
+            self.__put(row, frame)
+            self.__slots[self.__count] = row
+            self.__count += 1
+
+    def extend(self, frames: Iterable[np.ndarray]):
+        # 同じオブジェクトのフレームは同じ行にまとめる
+        rows: dict[int, int] = {}
+        frames = list(frames)
+        with self.__lock:
+            for frame in frames:
+                row = rows.get(id(frame))
+                if row is None:
+                    self.append(frame)
+                    rows[id(frame)] = int(self.__slots[self.__count - 1])
+                else:
+                    self.__resize_slots(self.__count + 1)
+                    self.__slots[self.__count] = row
+                    self.__count += 1
+
+    def resize(self, count: int):
+        # フレームの数をcountにする (増やしたフレームには行を割り当てない)
+        with self.__lock:
+            self.__resize_slots(count)
+            self.__slots[self.__count : count] = UNLOADED
+            self.__count = count
+
+    def fill(self, targets: np.ndarray, sources: np.ndarray):
+        # targetsのフレームにsourcesのフレームと同じ行を割り当てる (読み込んでいないフレームを埋める)
+        with self.__lock:
+            self.__slots[targets] = self.__slots[sources]
+
+    def snapshot(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # (行の配列, 行ごとの幅, フレームごとの行)を返す (numbaの関数にそのまま渡せる)
+        with self.__lock:
+            slots = self.__slots[: self.__count].copy()
+            if self.__rows is None:
+                return np.zeros((0, 1, 1, 3), dtype=np.uint8), self.__widths[:0], slots
+            return self.__rows[: self.__n_rows].view(np.ndarray), self.__widths[: self.__n_rows], slots
+
+    def __put(self, row: int, frame: np.ndarray):
+        h, w = self.__rows.shape[1:3]
+        if frame.shape[0] != h:
+            frame = cv2.resize(frame, (max(1, frame.shape[1] * h // frame.shape[0]), h), interpolation=cv2.INTER_AREA)
+        if frame.shape[1] > w:
+            # 中央の幅だけを保持する
+            dw = (frame.shape[1] - w) // 2
+            frame = frame[:, dw : dw + w]
+        self.__rows[row, :, : frame.shape[1]] = frame
+        if self.__widths[row] != frame.shape[1]:
+            self.__widths[row] = frame.shape[1]
+            self.__views.pop(row, None)
+
+    def __new_row(self, frame: np.ndarray, owner: int) -> int:
+        if self.__rows is None:
+            h, w = frame.shape[:2]
+            if self.strip_width is not None:
+                w = min(w, self.strip_width)
+            self.__allocate(max(self.__capacity, MIN_CAPACITY), h, w)
+        elif self.__n_rows >= self.__rows.shape[0]:
+            self.__allocate(self.__rows.shape[0] * 2, *self.__rows.shape[1:3])
+        row = self.__n_rows
+        self.__n_rows += 1
+        self.__widths[row] = 0
+        self.__owners[row] = owner
+        return row
+
+    def __resize_slots(self, count: int):
+        if count > len(self.__slots):
+            slots = np.full(max(count, len(self.__slots) * 2, self.__capacity, MIN_CAPACITY), UNLOADED, dtype=np.int32)
+            slots[: self.__count] = self.__slots[: self.__count]
+            self.__slots = slots
+
+    def __allocate(self, capacity: int, height: int, width: int):
+        shape = (capacity, height, width, 3)
+        old_rows, old_widths, old_owners, old_spill_file = self.__rows, self.__widths, self.__owners, self.__spill_file
+        if np.prod(shape) > self.memory_limit:
+            # 上限を超える場合は一時ファイル(閉じると削除される)に置く
+            self.__spill_file = tempfile.TemporaryFile(prefix='tsutil-thumbnails-')
+            self.__rows = np.memmap(self.__spill_file, dtype=np.uint8, mode='w+', shape=shape)
+            logger.debug(f'thumbnail store spilled to disk: {shape}')
+        else:
+            self.__spill_file = None
+            self.__rows = np.empty(shape, dtype=np.uint8)
+        self.__widths = np.zeros(capacity, dtype=np.int32)
+        self.__owners = np.zeros(capacity, dtype=np.int32)
+        self.__views.clear()
+        if old_rows is not None:
+            self.__rows[: self.__n_rows] = old_rows[: self.__n_rows]
+            self.__widths[: self.__n_rows] = old_widths[: self.__n_rows]
+            self.__owners[: self.__n_rows] = old_owners[: self.__n_rows]
+        if old_spill_file is not None:
+            del old_rows
+            old_spill_file.close()
+
+    def __release(self):
+        self.__rows = None
+        self.__widths = np.zeros(0, dtype=np.int32)
+        self.__owners = np.zeros(0, dtype=np.int32)
+        self.__slots = np.zeros(0, dtype=np.int32)
+        self.__views.clear()
+        if self.__spill_file is not None:
+            self.__spill_file.close()
+            self.__spill_file = None
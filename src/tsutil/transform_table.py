@@ -0,0 +1,73 @@
+from pathlib import Path
+from pydantic import BaseModel
+from .thumbnail_cache import make_catalog_cache_key
+import logging
+
+# NOTE: 補正後の連続画像を書き出すときに推定した、フレームごとのブレ(ずれ)の表 (wxPythonに依存しない)
+# - カタログファイルの設定ファイル(.correct.json)と同じフォルダーに保存する
+# - キーはブレ測定枠・基準画像のフレーム位置・連続画像のファイルから作り、どれかが変わった場合は作り直す
+#   (切り抜く範囲・傾き・歪み・出力形式だけを変えて書き出し直す場合は、ずれを推定せずにこの表を使う)
+# - 各フレームのずれは、基準画像に重ねるための回転角(度)と平行移動量(ピクセル)
+# - responseは各測定枠のresponseの最小値 (小さいフレームはずれの推定に失敗している可能性がある)
+
+# MARK: constants
+
+TABLE_EXTENSION = '.correct.transforms.json'
+
+logger = logging.getLogger('tsutil')
+
+
+# MARK: transform table model
+class TransformTable(BaseModel):
+    key: str = ''  # ずれを推定したときの設定と連続画像から作ったキー (表の検証用)
+    dx: list[float] = []
+    dy: list[float] = []
+    angle: list[float] = []
+    response: list[float | None] = []  # ずれを推定しなかったフレーム(測定枠が無い・読み込めない)はNone
+
+    @property
+    def n_frames(self) -> int:
+        return len(self.dx)
+
+    def is_valid(self, key: str, n_frames: int) -> bool:
+        return self.key == key and self.n_frames == n_frames
+
+
+# MARK: functions
+
+
+def get_table_file_path(catalog_path: Path) -> Path:
+    return catalog_path.with_suffix(TABLE_EXTENSION)
+
+
+def make_table_key(catalog_path: Path, entries: list, **params) -> str:
+    # entriesはread_image_catalog()の戻り値、paramsにはブレ測定枠と基準画像のフレーム位置など、ずれを変える設定を渡す
+    return make_catalog_cache_key(catalog_path, entries, table=TABLE_EXTENSION, **params)
+
+
+def load_transform_table(catalog_path: Path, key: str, n_frames: int) -> TransformTable | None:
+    # 同じ設定で推定した表を返す (無い場合や設定が変わった場合はNone)
+    table_path = get_table_file_path(catalog_path)
+    try:
+        with open(table_path, 'r') as f:
+            table = TransformTable.model_validate_json(f.read())
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f'failed to load transform table: {table_path}: {e}')
+        return None
+    if not table.is_valid(key, n_frames):
+        logger.debug(f'transform table is outdated: {table_path}')
+        return None
+    logger.debug(f'transform table loaded: {table_path}')
+    return table
+
+
+def save_transform_table(catalog_path: Path, table: TransformTable):
+    # 書き込めないフォルダーの場合は保存しない (次回の書き出しでもずれを推定する)
+    table_path = get_table_file_path(catalog_path)
+    try:
+        with open(table_path, 'w') as f:
+            f.write(table.model_dump_json())
+    except OSError as e:
+        logger.warning(f'failed to save transform table: {table_path}: {e}')
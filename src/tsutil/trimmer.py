@@ -1,11 +1,10 @@
 import wx
 import wx.adv
 import os
-from subprocess import Popen, PIPE
 from .common import logger, make_file_picker_ctrl, MOVIE_FILE_WILDCARD, get_path, path_exists
 from .tool_frame import ToolFrame
 from .components.video_thumbnail import VideoThumbnail, EVT_VIDEO_RANGE_CHANGED
-from fffio import Probe
+from .trimming import trim_video, trim_video_ranges, check_join_compatibility
 
 # MARK: constants
 
@@ -27,7 +26,7 @@ class MainFrame(ToolFrame):
 
         # input file panel
         input_file_panel = wx.Panel(panel)
-        input_file_sizer = wx.FlexGridSizer(cols=2, gap=wx.Size(MARGIN, 0))
+        input_file_sizer = wx.FlexGridSizer(cols=3, gap=wx.Size(MARGIN, 0))
         input_file_sizer.AddGrowableCol(1)
         input_file_sizer.Add(
             wx.StaticText(input_file_panel, label='トリミングする動画ファイル:'), flag=wx.ALIGN_CENTER_VERTICAL
@@ -40,6 +39,10 @@ class MainFrame(ToolFrame):
         )
         self.input_file_picker.Bind(wx.EVT_FILEPICKER_CHANGED, self.__on_input_file_changed)
         input_file_sizer.Add(self.input_file_picker, flag=wx.EXPAND)
+        join_button = wx.Button(input_file_panel, label='複数の動画ファイルを結合...')
+        join_button.SetToolTip('分割して記録された動画ファイルを、再エンコードせずに1本の動画として結合します。')
+        join_button.Bind(wx.EVT_BUTTON, self.__on_join_button_clicked)
+        input_file_sizer.Add(join_button, flag=wx.ALIGN_CENTER_VERTICAL)
         input_file_panel.SetSizerAndFit(input_file_sizer)
         sizer.Add(input_file_panel, flag=wx.EXPAND | wx.BOTTOM, border=MARGIN)
 
@@ -48,22 +51,55 @@ class MainFrame(ToolFrame):
             wx.StaticText(panel, label='赤いバーをドラッグして、動画の開始位置と終了位置を指定してください。'),
             flag=wx.ALIGN_CENTER,
         )
-        self.input_video_thumbnail = VideoThumbnail(panel, use_range_bar=True)
-        sizer.Add(self.input_video_thumbnail, flag=wx.EXPAND | wx.BOTTOM, border=MARGIN)
+        # 選択範囲のフレームをプレビューに複製するので、中央の幅に切り詰めない
+        self.input_video_thumbnail = VideoThumbnail(panel, use_range_bar=True, keep_full_width=True)
+        sizer.Add(self.input_video_thumbnail, flag=wx.EXPAND | wx.BOTTOM, border=MARGIN // 2)
+
+        # marked ranges
+        range_panel = wx.Panel(panel)
+        range_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        add_range_button = wx.Button(range_panel, label='範囲を追加')
+        add_range_button.SetToolTip(
+            '現在の範囲を追加します。追加した全ての範囲を別々の動画ファイルにトリミングします。'
+        )
+        add_range_button.Bind(wx.EVT_BUTTON, self.__on_add_range_button_clicked)
+        range_sizer.Add(add_range_button, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN // 2)
+        remove_range_button = wx.Button(range_panel, label='最後の範囲を削除')
+        remove_range_button.Bind(wx.EVT_BUTTON, self.__on_remove_range_button_clicked)
+        range_sizer.Add(remove_range_button, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN // 2)
+        clear_ranges_button = wx.Button(range_panel, label='全ての範囲を削除')
+        clear_ranges_button.Bind(wx.EVT_BUTTON, self.__on_clear_ranges_button_clicked)
+        range_sizer.Add(clear_ranges_button, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
+        self.range_text = wx.StaticText(range_panel, label='')
+        range_sizer.Add(self.range_text, flag=wx.ALIGN_CENTER_VERTICAL)
+        range_panel.SetSizerAndFit(range_sizer)
+        sizer.Add(range_panel, flag=wx.ALIGN_CENTER | wx.BOTTOM, border=MARGIN)
+
         self.preview_video_thumbnail = VideoThumbnail(panel)
         sizer.Add(self.preview_video_thumbnail, flag=wx.EXPAND)
 
         # trimming button
-        trimming_button = wx.Button(panel, label='トリミングした動画ファイルを作成する...')
+        trimming_panel = wx.Panel(panel)
+        trimming_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        trimming_button = wx.Button(trimming_panel, label='トリミングした動画ファイルを作成する...')
         trimming_button.Bind(wx.EVT_BUTTON, self.__on_trimming_button_clicked)
-        sizer.Add(trimming_button, flag=wx.ALIGN_CENTER | wx.ALL, border=MARGIN)
+        trimming_sizer.Add(trimming_button, flag=wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, border=MARGIN)
+        self.smart_cut_button = wx.CheckBox(trimming_panel, label='フレーム単位で切り出す(スマートカット)')
+        self.smart_cut_button.SetToolTip(
+            '開始位置・終了位置のキーフレームに満たない部分だけを再エンコードし、それ以外は無劣化でコピーします。'
+        )
+        self.smart_cut_button.Bind(wx.EVT_CHECKBOX, self.__on_smart_cut_changed)
+        trimming_sizer.Add(self.smart_cut_button, flag=wx.ALIGN_CENTER_VERTICAL)
+        trimming_panel.SetSizerAndFit(trimming_sizer)
+        sizer.Add(trimming_panel, flag=wx.ALIGN_CENTER | wx.ALL, border=MARGIN)
 
         # output video thumbnail
         self.output_video_thumbnail = VideoThumbnail(panel)
         sizer.Add(self.output_video_thumbnail, flag=wx.EXPAND)
         sizer.Add(
             wx.StaticText(
-                panel, label='※ffmpegによるトリミングの結果には多少の誤差が生じます。こちらで目視確認してください。'
+                panel,
+                label='※スマートカットを使わない場合、開始位置は直前のキーフレームになります。こちらで確認してください。',
             ),
             flag=wx.ALIGN_CENTER,
         )
@@ -89,23 +125,93 @@ class MainFrame(ToolFrame):
         self.SetSizerAndFit(frame_sizer)
 
         self.input_video_thumbnail.Bind(EVT_VIDEO_RANGE_CHANGED, self.__on_video_range_changed)
+        self.join_paths = None  # 結合する動画ファイルのリスト (結合しない場合はNone)
+        self.input_path = None  # 読み込んだ動画ファイル(結合する場合はリスト)
 
     def __on_input_file_changed(self, event):
         path = get_path(self.input_file_picker.GetPath())
         if not path_exists(path):
             event.Skip()
             return
+        self.join_paths = None
+        self.__load_input_video(path)
+        event.Skip()
+
+    def __on_join_button_clicked(self, event):
+        with wx.FileDialog(
+            self,
+            '結合する動画ファイルを選択してください(ファイル名の順に結合します)。',
+            wildcard=MOVIE_FILE_WILDCARD,
+            style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST | wx.FD_MULTIPLE,
+        ) as fileDialog:
+            if fileDialog.ShowModal() == wx.ID_CANCEL:
+                return
+            paths = sorted(get_path(i) for i in fileDialog.GetPaths())
+        if len(paths) > 1:
+            try:
+                with wx.BusyCursor():
+                    check_join_compatibility(paths)
+            except Exception as e:
+                wx.MessageBox(str(e), TOOL_NAME, wx.OK | wx.ICON_ERROR)
+                event.Skip()
+                return
+        self.join_paths = paths if len(paths) > 1 else None
+        self.input_file_picker.SetPath(str(paths[0]))
+        self.__load_input_video(self.join_paths or paths[0])
+        event.Skip()
+
+    def __load_input_video(self, path):
         self.input_video_thumbnail.clear()
         self.preview_video_thumbnail.clear()
         self.output_video_thumbnail.clear()
         self.output_filename_text.SetValue('')
-        self.input_video_thumbnail.load_video(path)
+        self.__update_range_text()
+        self.input_path = path
+        self.input_video_thumbnail.load_video(path, keyframes_only=self.__keyframes_only())
+
+    def __keyframes_only(self):
+        # -c copyではキーフレームの位置でしか切り出せないので、サムネイルもキーフレームだけをデコードする
+        # スマートカットではフレーム単位で切り出すので、全フレームをデコードする
+        return not self.smart_cut_button.GetValue()
+
+    def __on_smart_cut_changed(self, event):
+        # 読み込み済みの動画は、選択中の範囲と追加した範囲を残したまま、サムネイルだけを読み込み直す
+        # (フレーム数は変わらないので、動画に対する割合で持っている範囲はそのまま使える)
+        thumbnail = self.input_video_thumbnail
+        if self.input_path is not None:
+            positions = thumbnail.start_pos, thumbnail.end_pos, list(thumbnail.marked_ranges)
+            thumbnail.load_video(self.input_path, keyframes_only=self.__keyframes_only())
+            thumbnail.start_pos, thumbnail.end_pos, thumbnail.marked_ranges = positions
+            thumbnail.Refresh()
         event.Skip()
 
     def __on_video_range_changed(self, event):
         self.preview_video_thumbnail.copy_frames(event.frames[event.start : event.end])
         event.Skip()
 
+    def __update_range_text(self):
+        ranges = self.input_video_thumbnail.get_marked_frame_ranges()
+        label = f'{len(self.join_paths)}個の動画ファイルを結合 ' if self.join_paths else ''
+        if ranges:
+            label += f'{len(ranges)}個の範囲: ' + ', '.join(f'{start}-{end - 1}' for start, end in ranges)
+        self.range_text.SetLabel(label)
+        self.Layout()
+
+    def __on_add_range_button_clicked(self, event):
+        self.input_video_thumbnail.add_marked_range()
+        self.__update_range_text()
+        event.Skip()
+
+    def __on_remove_range_button_clicked(self, event):
+        self.input_video_thumbnail.remove_marked_range()
+        self.__update_range_text()
+        event.Skip()
+
+    def __on_clear_ranges_button_clicked(self, event):
+        self.input_video_thumbnail.clear_marked_ranges()
+        self.__update_range_text()
+        event.Skip()
+
     def __on_trimming_button_clicked(self, event):
         if self.input_video_thumbnail.get_frame_count() == 0:
             wx.MessageBox('トリミングする動画が読み込まれていません。', 'エラー', wx.OK | wx.ICON_ERROR)
@@ -113,6 +219,10 @@ class MainFrame(ToolFrame):
             return
 
         input_path = get_path(self.input_file_picker.GetPath())
+        if self.input_video_thumbnail.get_marked_frame_ranges():
+            self.__trim_marked_ranges(input_path)
+            event.Skip()
+            return
         output_filename = input_path.stem + RAW_SUFFIX + input_path.suffix
 
         with wx.FileDialog(
@@ -128,40 +238,58 @@ class MainFrame(ToolFrame):
             output_path = get_path(fileDialog.GetPath())
             self.output_filename_text.SetValue(str(output_path))
 
-            probe = Probe(input_path)
-            total_count = self.input_video_thumbnail.get_frame_count()
             start, end = self.input_video_thumbnail.get_frame_range()
-            # ss = start / probe.fps
-            # to = (end - 1) / probe.fps
-            ss = probe.duration * start / total_count
-            to = probe.duration * (end - 1) / total_count
-            args = [
-                'ffmpeg',
-                '-loglevel',
-                'error',
-                '-ss',
-                str(ss),
-                '-to',
-                str(to),
-                '-i',
-                str(input_path),
-                '-c',
-                'copy',
-                '-y',
-                str(output_path),
-            ]
-            logger.debug(args)
-            process = Popen(args, stdout=PIPE, stderr=PIPE, encoding='utf-8')
-            stdout_data, stderr_data = process.communicate()
-            if process.returncode != 0:
-                wx.MessageBox(f'トリミングに失敗しました:\n{stderr_data}', TOOL_NAME, wx.OK | wx.ICON_ERROR)
+            try:
+                with wx.BusyCursor():
+                    trim_video(self.join_paths or input_path, output_path, start, end, self.smart_cut_button.GetValue())
+            except Exception as e:
+                logger.debug(e)
+                wx.MessageBox(f'トリミングに失敗しました:\n{e}', TOOL_NAME, wx.OK | wx.ICON_ERROR)
                 event.Skip()
                 return
             m_time = input_path.stat().st_mtime
             os.utime(str(output_path), (m_time, m_time))
-            self.output_video_thumbnail.load_video(output_path)
+            self.output_video_thumbnail.load_video(output_path, keyframes_only=self.__keyframes_only())
         event.Skip()
 
+    def __trim_marked_ranges(self, input_path):
+        # 追加した範囲ごとに「動画ファイル名_番号_RAW」の動画ファイルを作成する (ffmpegは並行して動かす)
+        with wx.DirDialog(
+            self,
+            'トリミングした動画の保存先フォルダーを選択してください。',
+            defaultPath=str(input_path.parent),
+            style=wx.DD_DEFAULT_STYLE | wx.DD_DIR_MUST_EXIST,
+        ) as dirDialog:
+            if dirDialog.ShowModal() == wx.ID_CANCEL:
+                return
+            output_dir = get_path(dirDialog.GetPath())
+        ranges = [
+            (output_dir / f'{input_path.stem}_{i + 1:02d}{RAW_SUFFIX}{input_path.suffix}', start, end)
+            for i, (start, end) in enumerate(self.input_video_thumbnail.get_marked_frame_ranges())
+        ]
+        existing = [path.name for path, _, _ in ranges if path.exists()]
+        if existing and (
+            wx.MessageBox(
+                '以下のファイルを上書きしますか?\n' + '\n'.join(existing), TOOL_NAME, wx.YES_NO | wx.ICON_QUESTION
+            )
+            != wx.YES
+        ):
+            return
+        with wx.BusyCursor():
+            failures = trim_video_ranges(self.join_paths or input_path, ranges, self.smart_cut_button.GetValue())
+        m_time = input_path.stat().st_mtime
+        failed = {path for path, _ in failures}
+        for output_path, _, _ in ranges:
+            if output_path not in failed:
+                os.utime(str(output_path), (m_time, m_time))
+        if failures:
+            message = '\n'.join(f'{path.name}: {e}' for path, e in failures)
+            wx.MessageBox(f'トリミングに失敗しました:\n{message}', TOOL_NAME, wx.OK | wx.ICON_ERROR)
+        succeeded = [path for path, _, _ in ranges if path not in failed]
+        if succeeded:
+            self.output_filename_text.SetValue(str(succeeded[0]))
+            self.output_video_thumbnail.load_video(succeeded[0], keyframes_only=self.__keyframes_only())
+
     def __on_folder_button_clicked(self, event):
         path = get_path(self.output_filename_text.GetValue())
         if not path_exists(path):
@@ -0,0 +1,306 @@
+from pathlib import Path
+from pydantic import BaseModel
+from fffio import Probe
+from .packet_index import PacketIndex, load_packet_index, load_joined_packet_index
+import concurrent.futures as futures
+import subprocess
+import tempfile
+import logging
+import json
+
+# NOTE: 動画のトリミング (wxPythonに依存しない)
+# - 通常は-c copyで切り出す (開始位置は直前のキーフレームになる)
+# - スマートカットでは、範囲の両端のキーフレームに満たない部分(GOPの一部)だけを元の動画と同じコーデックの設定で
+#   再エンコードし、間のキーフレームからキーフレームまでは-c copyで切り出して、concat demuxerで無劣化で結合する
+#   (フレーム単位で正確に切り出せて、全体を再エンコードするよりもはるかに速い)
+
+# MARK: constants
+
+# 再エンコードに使うエンコーダー (元の動画のコーデック名 → ffmpegのエンコーダー名)
+VIDEO_ENCODERS = {
+    'h264': 'libx264',
+    'hevc': 'libx265',
+    'mpeg4': 'mpeg4',
+    'vp9': 'libvpx-vp9',
+    'av1': 'libaom-av1',
+}
+MOV_EXTENSIONS = ['.mp4', '.m4v', '.mov']
+TRIM_WORKERS = 4  # 複数の範囲をトリミングするときに並行して動かすffmpegの数
+
+logger = logging.getLogger('tsutil')
+
+
+# MARK: trimming plan
+class TrimPiece(BaseModel):
+    start: int  # 先頭フレームの番号
+    end: int  # 末尾フレームの番号 + 1
+    stream_copy: bool  # Trueの場合は-c copyで切り出す (startはキーフレーム)
+
+
+def plan_smart_cut(index: PacketIndex, start: int, end: int) -> list[TrimPiece]:
+    # [start, end)を、先頭と末尾の再エンコードする部分と、間の-c copyで切り出す部分に分ける
+    start = max(0, start)
+    end = min(end, index.n_frames)
+    if start >= end:
+        return []
+    head_end = index.keyframe_after(start)  # -c copyで切り出せる最初のフレーム
+    tail_start = end if end >= index.n_frames else index.keyframe_before(end)  # -c copyで切り出せる最後+1のフレーム
+    if head_end >= tail_start:
+        # 範囲内にキーフレームからキーフレームまでの区間が無い場合は全体を再エンコードする
+        return [TrimPiece(start=start, end=end, stream_copy=False)]
+    pieces = []
+    if start < head_end:
+        pieces.append(TrimPiece(start=start, end=head_end, stream_copy=False))
+    pieces.append(TrimPiece(start=head_end, end=tail_start, stream_copy=True))
+    if tail_start < end:
+        pieces.append(TrimPiece(start=tail_start, end=end, stream_copy=False))
+    return pieces
+
+
+# MARK: functions
+
+
+def probe_video_stream(path: Path) -> dict:
+    # 再エンコードの設定を合わせるため、映像ストリームのコーデックの設定を読み込む
+    args = [
+        'ffprobe',
+        '-v',
+        'error',
+        '-select_streams',
+        'v:0',
+        '-show_entries',
+        'stream=codec_name,codec_tag_string,profile,level,pix_fmt,bit_rate,time_base,'
+        'color_range,color_space,color_transfer,color_primaries:stream_side_data=rotation:format=bit_rate',
+        '-of',
+        'json',
+        str(path),
+    ]
+    result = subprocess.run(args, capture_output=True, text=True, check=True)
+    data = json.loads(result.stdout)
+    streams = data.get('streams') or [{}]
+    stream = dict(streams[0])
+    for side_data in stream.pop('side_data_list', []):
+        if 'rotation' in side_data:
+            stream['rotation'] = int(side_data['rotation'])
+    if stream.get('bit_rate') in (None, 'N/A'):
+        # MKVなどではストリームのビットレートが無いので、ファイル全体のビットレートを使う
+        stream['bit_rate'] = data.get('format', {}).get('bit_rate')
+    return stream
+
+
+def make_encoder_args(stream: dict, suffix: str) -> list[str]:
+    # 元の動画と同じコーデック・プロファイル・画素形式・ビットレート・色空間で再エンコードする引数
+    codec = stream.get('codec_name')
+    if codec not in VIDEO_ENCODERS:
+        raise ValueError(f'スマートカットに対応していないコーデックです: {codec}')
+    args = ['-c:v', VIDEO_ENCODERS[codec]]
+    profile = (stream.get('profile') or '').lower().replace(' ', '')
+    if codec == 'h264' and profile in ('baseline', 'constrainedbaseline', 'main', 'high', 'high10', 'high422'):
+        args += ['-profile:v', profile.removeprefix('constrained')]
+        if isinstance(stream.get('level'), int) and stream['level'] > 0:
+            args += ['-level:v', f'{stream["level"] / 10:g}']
+    elif codec == 'hevc' and profile in ('main', 'main10'):
+        args += ['-profile:v', profile]
+    if stream.get('pix_fmt'):
+        args += ['-pix_fmt', stream['pix_fmt']]
+    if str(stream.get('bit_rate') or '').isdigit():
+        args += ['-b:v', stream['bit_rate']]
+    for key, option in [
+        ('color_range', '-color_range'),
+        ('color_space', '-colorspace'),
+        ('color_transfer', '-color_trc'),
+        ('color_primaries', '-color_primaries'),
+    ]:
+        if stream.get(key) and stream[key] != 'unknown':
+            args += [option, stream[key]]
+    if stream.get('codec_tag_string') in ('hvc1', 'avc1') and suffix.lower() in MOV_EXTENSIONS:
+        args += ['-tag:v', stream['codec_tag_string']]
+    if suffix.lower() in MOV_EXTENSIONS and '/' in (stream.get('time_base') or ''):
+        # -c copyで切り出した部分とタイムスケールを揃える
+        args += ['-video_track_timescale', stream['time_base'].split('/')[1]]
+    return args
+
+
+def has_audio_stream(path: Path) -> bool:
+    args = [
+        'ffprobe',
+        '-v',
+        'error',
+        '-select_streams',
+        'a',
+        '-show_entries',
+        'stream=index',
+        '-of',
+        'csv=p=0',
+        str(path),
+    ]
+    result = subprocess.run(args, capture_output=True, text=True, check=True)
+    return bool(result.stdout.strip())
+
+
+def run_ffmpeg(args: list[str]):
+    logger.debug(f'{args=}')
+    result = subprocess.run(args, capture_output=True, text=True, encoding='utf-8', errors='replace')
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or f'ffmpeg exited with code {result.returncode}')
+
+
+def check_join_compatibility(paths: list[Path]):
+    # concat demuxerで無劣化で結合できるように、映像の大きさ・フレームレート・回転・コーデックの設定が同じことを確認する
+    # (異なる場合はValueErrorを送出する)
+    def _describe(path: Path) -> dict:
+        probe = Probe(str(path))
+        stream = probe_video_stream(path)
+        return dict(
+            size=f'{probe.width}x{probe.height}',
+            fps=round(probe.fps, 3),
+            rotation=probe.rotation,
+            sample_aspect_ratio=probe.sample_aspect_ratio,
+            codec=stream.get('codec_name'),
+            profile=stream.get('profile'),
+            pix_fmt=stream.get('pix_fmt'),
+            time_base=stream.get('time_base'),
+            audio=has_audio_stream(path),
+        )
+
+    first = _describe(paths[0])
+    for path in paths[1:]:
+        other = _describe(path)
+        diffs = [f'{key}: {first[key]} != {other[key]}' for key in first if first[key] != other[key]]
+        if diffs:
+            raise ValueError(f'{paths[0].name}と{path.name}は結合できません。\n' + '\n'.join(diffs))
+
+
+def trim_video(
+    input_path: Path | list[Path], output_path: Path, start: int = 0, end: int | None = None, smart_cut: bool = False
+):
+    # [start, end)のフレームを切り出す (失敗した場合はffmpegのエラーメッセージでRuntimeErrorを送出する)
+    # input_pathに複数の動画ファイルを指定した場合は、concat demuxerで結合して切り出す
+    input_paths = input_path if isinstance(input_path, list) else [input_path]
+    index = load_joined_packet_index(input_paths)
+    end = index.n_frames if end is None else min(end, index.n_frames)
+    suffix = input_paths[0].suffix
+    with tempfile.TemporaryDirectory(dir=output_path.parent, prefix='.trim') as temp_dir:
+        temp_dir = Path(temp_dir)
+        input_args = _make_input_args(temp_dir, input_paths, index)
+        pieces = plan_smart_cut(index, start, end) if smart_cut else []
+        if not smart_cut or (len(pieces) == 1 and pieces[0].stream_copy):
+            # 範囲の両端がキーフレームの場合は再エンコードが不要
+            _copy_range(input_args, output_path, index, start, end, audio=True)
+            return
+        stream = probe_video_stream(input_paths[0])
+        encoder_args = make_encoder_args(stream, suffix)
+        piece_paths = []
+        for i, piece in enumerate(pieces):
+            piece_path = temp_dir / f'{i:03d}{suffix}'
+            if piece.stream_copy:
+                _copy_range(input_args, piece_path, index, piece.start, piece.end, audio=False)
+            else:
+                _encode_range(input_args, piece_path, index, piece.start, piece.end, encoder_args)
+            piece_paths.append(piece_path)
+        # 映像は部分ごとのファイルを結合し、音声は元の動画の範囲全体を-c copyで切り出す
+        concat_args = ['-f', 'concat', '-safe', '0']
+        if stream.get('rotation'):
+            # 再エンコードした部分は回転情報を持たないので、元の動画の回転情報を付け直す
+            concat_args += ['-display_rotation:v:0', str(stream['rotation'])]
+        args = [
+            'ffmpeg',
+            '-loglevel',
+            'error',
+            *concat_args,
+            '-i',
+            _write_concat_list(temp_dir / 'pieces.txt', piece_paths),
+        ]
+        if has_audio_stream(input_paths[0]):
+            audio_path = temp_dir / 'audio.mka'
+            _copy_audio(input_args, audio_path, index, start, end)
+            args += ['-i', str(audio_path), '-map', '0:v', '-map', '1:a']
+        args += ['-c', 'copy', '-y', str(output_path)]
+        run_ffmpeg(args)
+
+
+def trim_video_ranges(
+    input_path: Path | list[Path],
+    ranges: list[tuple[Path, int, int]],
+    smart_cut: bool = False,
+    workers: int = TRIM_WORKERS,
+) -> list[tuple[Path, Exception]]:
+    # (出力ファイル, 開始フレーム, 終了フレーム + 1)のリストを並行して切り出し、失敗した(出力ファイル, 例外)のリストを返す
+    # (範囲ごとにシークして読み込むので、元の動画全体を何度も読み込むことはない)
+    # 各スレッドで索引を作らないように、先に読み込んでおく
+    load_joined_packet_index(input_path if isinstance(input_path, list) else [input_path])
+    failures = []
+    with futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        jobs = {
+            executor.submit(trim_video, input_path, output_path, start, end, smart_cut): output_path
+            for output_path, start, end in ranges
+        }
+        for job in futures.as_completed(jobs):
+            try:
+                job.result()
+            except Exception as e:
+                logger.warning(f'failed to trim: {jobs[job]}: {e}')
+                failures.append((jobs[job], e))
+    return failures
+
+
+def _make_input_args(temp_dir: Path, input_paths: list[Path], index: PacketIndex) -> list[str]:
+    if len(input_paths) == 1:
+        return ['-i', str(input_paths[0])]
+    # 結合した動画の中でシークできるように、各ファイルの長さを索引と同じ値で指定する
+    durations = [load_packet_index(path).duration for path in input_paths]
+    args = ['-f', 'concat', '-safe', '0']
+    rotation = Probe(str(input_paths[0])).rotation
+    if rotation:
+        args += ['-display_rotation:v:0', str(rotation)]
+    return args + ['-i', _write_concat_list(temp_dir / 'input.txt', input_paths, durations)]
+
+
+def _range_args(index: PacketIndex, start: int, end: int, copy: bool = False) -> list[str]:
+    args = []
+    if start > 0:
+        args += ['-ss', str(index.copy_seek_time(start) if copy else index.seek_time(start))]
+    if end < index.n_frames:
+        args += ['-to', str(index.seek_time(end))]
+    return args
+
+
+def _copy_range(input_args: list[str], output_path: Path, index: PacketIndex, start: int, end: int, audio: bool):
+    # -c copyでは開始位置の直前のキーフレームから切り出される
+    # キーフレームはシーク位置より前なので表示時刻が負になり、mp4では編集リストで表示されなくなる
+    # (-avoid_negative_tsで先頭のキーフレームの表示時刻を0にずらして、キーフレームから表示する)
+    args = ['ffmpeg', '-loglevel', 'error', *_range_args(index, start, end, copy=True), *input_args]
+    args += ['-c', 'copy', '-avoid_negative_ts', 'make_zero']
+    args += ([] if audio else ['-an', '-sn', '-dn']) + ['-y', str(output_path)]
+    run_ffmpeg(args)
+
+
+def _copy_audio(input_args: list[str], output_path: Path, index: PacketIndex, start: int, end: int):
+    # -c copyの入力側の-ssは映像のキーフレームの位置にしかシークしないので、
+    # 直前のキーフレームまでシークしてから、出力側の-ss/-tで音声のパケット単位で切り出す
+    keyframe = index.keyframe_before(start)
+    ss = index.seek_time(start) - index.seek_time(keyframe)
+    args = ['ffmpeg', '-loglevel', 'error', '-ss', str(index.seek_time(keyframe)), *input_args]
+    args += ['-ss', str(ss), '-t', str(index.seek_time(end) - index.seek_time(start))]
+    args += ['-map', '0:a', '-c', 'copy', '-y', str(output_path)]
+    run_ffmpeg(args)
+
+
+def _encode_range(
+    input_args: list[str], output_path: Path, index: PacketIndex, start: int, end: int, encoder_args: list[str]
+):
+    # 回転は-c copyで切り出した部分と同じく回転情報のままにする (-noautorotate)
+    args = ['ffmpeg', '-loglevel', 'error', '-noautorotate', *_range_args(index, start, end), *input_args]
+    args += ['-map', '0:v:0', '-frames:v', str(end - start), *encoder_args, '-y', str(output_path)]
+    run_ffmpeg(args)
+
+
+def _write_concat_list(list_path: Path, paths: list[Path], durations: list[float] | None = None) -> str:
+    # concat demuxerのファイルリスト (パス中の'はエスケープする)
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for i, path in enumerate(paths):
+            escaped = str(path.resolve()).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+            if durations:
+                f.write(f'duration {durations[i]}\n')
+    return str(list_path)
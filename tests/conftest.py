@@ -0,0 +1,56 @@
+import os
+import shutil
+import subprocess
+from pathlib import Path
+import numpy as np
+import pytest
+
+# NOTE: テストで共通に使う、ffmpegの有無の確認と動画の生成
+# - ffmpeg・ffprobeが無い場合、動画を使うテストはスキップする
+#   (CI環境(CIまたはTSUTIL_REQUIRE_FFMPEGが設定されている場合)では、スキップせずにテストを失敗させる)
+# - gray_clipは、フレーム番号ごとに明るさの違う灰色の動画 (デコードしたフレームの番号をframe_number()で照合する)
+#   setptsで表示時刻の間隔を不揃いにすると、可変フレームレートの動画になる
+
+# MARK: constants
+
+GRAY_LEVEL_BASE = 20  # フレーム番号0の明るさ (暗い部分はYUVとの変換で潰れるので避ける)
+GRAY_LEVEL_STEP = 6  # フレームごとの明るさの差(階調)
+GRAY_SIZE = (64, 48)
+
+HAS_FFMPEG = shutil.which('ffmpeg') is not None and shutil.which('ffprobe') is not None
+REQUIRE_FFMPEG = bool(os.environ.get('CI') or os.environ.get('TSUTIL_REQUIRE_FFMPEG'))
+
+requires_ffmpeg = pytest.mark.skipif(not HAS_FFMPEG, reason='ffmpeg is not available')
+
+
+# MARK: hooks
+
+
+def pytest_sessionstart(session):
+    if REQUIRE_FFMPEG and not HAS_FFMPEG:
+        pytest.exit('ffmpeg and ffprobe are required to run the tests', returncode=1)
+
+
+# MARK: helpers
+
+
+def run_ffmpeg(args: list[str], input: bytes | None = None):
+    subprocess.run(['ffmpeg', '-y', '-v', 'error', *args], input=input, check=True)
+
+
+def make_gray_clip(path: Path, n_frames: int, keyframe_interval: int, fps: int = 30, setpts: str | None = None) -> Path:
+    # フレーム番号iの画素値がGRAY_LEVEL_BASE + i * GRAY_LEVEL_STEPの動画 (キーフレームはkeyframe_intervalごと)
+    # setptsを指定すると、表示時刻を変えた可変フレームレートの動画にする (単位は1/fps秒、フレームは複製しない)
+    w, h = GRAY_SIZE
+    levels = GRAY_LEVEL_BASE + np.arange(n_frames, dtype=np.uint8) * GRAY_LEVEL_STEP
+    args = ['-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{w}x{h}', '-r', str(fps), '-i', '-']
+    if setpts is not None:
+        args += ['-vf', f'setpts={setpts}', '-fps_mode', 'passthrough']
+    args += ['-c:v', 'libx264', '-qp', '0', '-pix_fmt', 'yuv420p']
+    args += ['-x264-params', f'keyint={keyframe_interval}:min-keyint={keyframe_interval}:scenecut=0', str(path)]
+    run_ffmpeg(args, input=np.repeat(levels, w * h * 3).tobytes())
+    return path
+
+
+def frame_number(frame: np.ndarray) -> int:
+    return int(round((float(frame.mean()) - GRAY_LEVEL_BASE) / GRAY_LEVEL_STEP))
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+from conftest import requires_ffmpeg, run_ffmpeg
+from tsutil.color_filters import apply_filter_complex, get_color_matrix_name
+from tsutil.extraction import ExtractionSetting
+
+# NOTE: extractorのプレビュー(apply_filter_complex)が、書き出し(ffmpegのフィルター)と同じ色になることを確認する
+# - 滑らかなグラデーションの動画を生成し、ffmpegでフィルターを適用したフレームと比較する
+# - クロマサブサンプリングを再現しないため、RGBの各成分で最大TOLERANCE階調の差を許す
+
+# MARK: constants
+
+TOLERANCE = 10  # 各成分の差の最大値(階調)
+MEAN_TOLERANCE = 1.5  # 各成分の差の平均値(階調)
+GRADIENT_COLORS = ('0xe03020', '0x30c040', '0x2040e0', '0xf0e0a0')
+
+SETTINGS = {
+    'eq_gamma': dict(eq=True, eq_gamma=1.4),
+    'eq_saturation': dict(eq=True, eq_saturation=1.5),
+    'eq_all': dict(eq=True, eq_brightness=0.05, eq_contrast=1.2, eq_gamma=0.8, eq_saturation=0.7),
+    'colortemperature': dict(colortemperature=True, colortemperature_temperature=4000),
+    'colortemperature_pl': dict(
+        colortemperature=True, colortemperature_temperature=9000, colortemperature_pl=0.5, colortemperature_mix=0.8
+    ),
+    'huesaturation': dict(
+        huesaturation=True, huesaturation_hue=30, huesaturation_saturation=0.3, huesaturation_intensity=0.1
+    ),
+    'all': dict(
+        eq=True,
+        eq_gamma=1.2,
+        eq_saturation=1.3,
+        colortemperature=True,
+        colortemperature_temperature=5000,
+        huesaturation=True,
+        huesaturation_hue=-20,
+    ),
+}
+
+# MARK: fixtures
+
+
+def _make_clip(path, width, height, color_space=None):
+    # 色と向きを指定しないとgradientsは毎回違う画像になるので、全て指定する
+    source = f'gradients=size={width}x{height}:rate=10:duration=0.2:seed=1:n={len(GRADIENT_COLORS)}'
+    source += ''.join(f':c{i}={c}' for i, c in enumerate(GRADIENT_COLORS))
+    source += f':x0=0:y0=0:x1={width}:y1={height}'
+    args = ['-f', 'lavfi', '-i', source]
+    args += ['-pix_fmt', 'yuv420p', '-c:v', 'libx264', '-crf', '12']
+    if color_space:
+        args += ['-colorspace', color_space]
+    run_ffmpeg(args + [str(path)])
+    return path
+
+
+@pytest.fixture(scope='module')
+def clips(tmp_path_factory):
+    # (幅, 高さ, 色空間のタグ)ごとの動画
+    tmp = tmp_path_factory.mktemp('clips')
+    return {
+        'sd': _make_clip(tmp / 'sd.mp4', 320, 240),
+        'hd': _make_clip(tmp / 'hd.mp4', 1280, 720),
+        'hd_bt709': _make_clip(tmp / 'hd_bt709.mp4', 1280, 720, 'bt709'),
+    }
+
+
+def _read_frame(path, filter_complex=None):
+    from fffio import FrameReader
+
+    with FrameReader(str(path), filter_complex=filter_complex) as reader:
+        return next(reader.frames()).copy()
+
+
+def _color_matrix(path):
+    from tsutil.trimming import probe_video_stream
+
+    return get_color_matrix_name(probe_video_stream(path).get('color_space'))
+
+
+# MARK: tests
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize('clip', ['sd', 'hd', 'hd_bt709'])
+@pytest.mark.parametrize('name', list(SETTINGS))
+def test_preview_matches_ffmpeg(clips, clip, name):
+    filter_complex = ExtractionSetting(**SETTINGS[name]).make_filter_complex()
+    expected = _read_frame(clips[clip], filter_complex).astype(np.int32)
+    actual = apply_filter_complex(_read_frame(clips[clip]), filter_complex, _color_matrix(clips[clip]))
+    diff = np.abs(actual.astype(np.int32) - expected)
+    assert diff.max() <= TOLERANCE
+    assert diff.mean() <= MEAN_TOLERANCE
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize('clip, color_matrix', [('sd', 'bt601'), ('hd', 'bt601'), ('hd_bt709', 'bt709')])
+def test_color_matrix_follows_stream_color_space(clips, clip, color_matrix):
+    # 色空間のタグが無い場合は、HDの動画でもffmpegはBT.601で変換する
+    assert _color_matrix(clips[clip]) == color_matrix
+    filter_complex = ExtractionSetting(eq=True, eq_saturation=1.5).make_filter_complex()
+    expected = _read_frame(clips[clip], filter_complex).astype(np.int32)
+    frame = _read_frame(clips[clip])
+    errors = {
+        name: np.abs(apply_filter_complex(frame, filter_complex, name).astype(np.int32) - expected).mean()
+        for name in ('bt601', 'bt709')
+    }
+    assert min(errors, key=errors.get) == color_matrix
+
+
+def test_get_color_matrix_name():
+    assert get_color_matrix_name(None) == 'bt601'
+    assert get_color_matrix_name('unknown') == 'bt601'
+    assert get_color_matrix_name('smpte170m') == 'bt601'
+    assert get_color_matrix_name('bt470bg') == 'bt601'
+    assert get_color_matrix_name('bt709') == 'bt709'
+    assert get_color_matrix_name('bt2020nc') == 'bt2020'
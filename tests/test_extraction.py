@@ -0,0 +1,97 @@
+from pathlib import Path
+import cv2
+import pytest
+from conftest import frame_number, make_gray_clip, requires_ffmpeg
+from tsutil.extraction import extract_video, read_frames, read_thumbnails
+from tsutil.packet_index import load_packet_index
+
+# NOTE: 動画からサムネイルを読み込む処理が、正しいフレーム番号のフレームを返すことを確認する
+# - フレームごとに明るさの違う灰色の動画(conftest.make_gray_clip)を生成し、フレーム番号と明るさを照合する
+# - 展開した連続画像は、区間を分割しても分割しなくても同じ画像ファイル名(fNNNNN)に同じフレームを書き出す
+
+# MARK: constants
+
+N_FRAMES = 36
+KEYFRAME_INTERVAL = 8
+# 3フレームごとに2フレーム分の間を空ける (表示時刻は0, 3, 4, 5, 8, 9, 10, ...)
+# 固定フレームレートでデコードすると、間を複製したフレームで埋めてフレーム数が増える
+VFR_SETPTS = 'N+2*ceil(N/3)'
+
+# MARK: fixtures
+
+
+@pytest.fixture(scope='module')
+def gray_clip(tmp_path_factory):
+    return make_gray_clip(tmp_path_factory.mktemp('clips') / 'gray.mp4', N_FRAMES, KEYFRAME_INTERVAL)
+
+
+@pytest.fixture(scope='module')
+def vfr_clip(tmp_path_factory):
+    path = tmp_path_factory.mktemp('clips') / 'vfr.mp4'
+    return make_gray_clip(path, N_FRAMES, KEYFRAME_INTERVAL, setpts=VFR_SETPTS)
+
+
+def _extract(clip, output_path, **kwargs):
+    # 展開したカタログファイルの{画像ファイル名(ディレクトリを除く): 画像のフレーム番号}
+    extract_video(clip, output_path, **kwargs)
+    names = output_path.read_text().splitlines()
+    return {Path(name).name: frame_number(cv2.imread(str(output_path.parent / name))) for name in names}
+
+
+# MARK: tests
+
+
+@requires_ffmpeg
+def test_read_thumbnails(gray_clip):
+    numbers = [(i, frame_number(frame)) for i, frame in read_thumbnails(gray_clip, 24)]
+    assert numbers == [(i, i) for i in range(N_FRAMES)]
+
+
+@requires_ffmpeg
+def test_read_thumbnails_step(gray_clip):
+    numbers = [(i, frame_number(frame)) for i, frame in read_thumbnails(gray_clip, 24, step=5)]
+    assert numbers == [(i, i) for i in range(0, N_FRAMES, 5)]
+
+
+@requires_ffmpeg
+def test_read_thumbnails_keyframes_only(gray_clip):
+    # キーフレームの間を複製したフレームで埋めずに、キーフレームだけを返す
+    keyframes = load_packet_index(gray_clip).keyframes
+    assert keyframes == list(range(0, N_FRAMES, KEYFRAME_INTERVAL))
+    numbers = [(i, frame_number(frame)) for i, frame in read_thumbnails(gray_clip, 24, keyframes_only=True)]
+    assert numbers == [(i, i) for i in keyframes]
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize('step', [1, 5])
+def test_read_thumbnails_vfr(vfr_clip, step):
+    # 可変フレームレートの動画でも、パケットの索引と同じ番号のフレームを返す
+    assert load_packet_index(vfr_clip).n_frames == N_FRAMES
+    numbers = [(i, frame_number(frame)) for i, frame in read_thumbnails(vfr_clip, 24, step=step)]
+    assert numbers == [(i, i) for i in range(0, N_FRAMES, step)]
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize('crop', [None, (8, 8, 32, 24)])
+def test_read_frames_vfr(vfr_clip, crop):
+    numbers = [(i, frame_number(frame)) for i, frame in read_frames(vfr_clip, crop=crop)]
+    assert numbers == [(i, i) for i in range(N_FRAMES)]
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize(
+    'ranges, expected',
+    [
+        (dict(), range(N_FRAMES)),
+        (dict(frame_range=(5, 30)), range(5, 30)),
+        (dict(frame_ranges=[(2, 9), (17, 33)]), [*range(2, 9), *range(17, 33)]),
+        (dict(frame_range=(5, 30), frame_ranges=[(2, 9), (17, 33)], step=3), [6, 18, 21, 24, 27]),
+    ],
+)
+@pytest.mark.parametrize('direct_output', [False, True])
+def test_extract_segments_vfr(vfr_clip, tmp_path, ranges, expected, direct_output):
+    # 可変フレームレートの動画でも、区間を分割した場合としない場合で同じカタログファイルになる
+    single = _extract(vfr_clip, tmp_path / 'single.txt', segments=1, direct_output=direct_output, **ranges)
+    parallel = _extract(vfr_clip, tmp_path / 'parallel.txt', segments=4, direct_output=direct_output, **ranges)
+    assert single == parallel
+    assert single == {f'f{i + 1:05d}.png': i for i in expected}
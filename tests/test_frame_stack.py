@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from tsutil.frame_stack import FrameStack, FrameStackWriter, read_image_catalog
+
+# NOTE: フレームスタックに順不同で書き込んだフレームを、元の動画のフレーム番号と対応付けて読み出せることを確認する
+
+# MARK: constants
+
+SHAPE = (4, 6, 3)
+
+# MARK: fixtures
+
+
+def _frame(number):
+    # フレーム番号から作った内容のフレーム (BGR)
+    return np.full(SHAPE, number % 256, dtype=np.uint8)
+
+
+def _write(path, numbers, compression=None):
+    rng = np.random.default_rng(1)
+    with FrameStackWriter(path, compression=compression) as writer:
+        for i in rng.permutation(numbers):
+            writer.write(int(i), _frame(int(i)))
+    return FrameStack(path)
+
+
+# MARK: tests
+
+
+@pytest.mark.parametrize('compression', ['none', 'zlib'])
+def test_read_written_frames(tmp_path, compression):
+    numbers = list(range(5, 25, 2))
+    stack = _write(tmp_path / 'frames.stack', numbers, compression)
+    assert len(stack) == len(numbers)
+    assert stack.compression == compression
+    for k, number in enumerate(numbers):
+        assert stack.frame_number(k) == number
+        np.testing.assert_array_equal(stack.read(k), _frame(number))
+
+
+def test_many_ranges(tmp_path):
+    # 飛び飛びの範囲が多くても、ヘッダーの大きさを超えずにフレーム番号を記録する
+    numbers = [start + k for start in range(0, 400 * 25, 25) for k in range(10)]
+    path = tmp_path / 'ranges.stack'
+    stack = _write(path, numbers)
+    assert [stack.frame_number(k) for k in range(len(stack))] == numbers
+    np.testing.assert_array_equal(stack.read(len(stack) - 1), _frame(numbers[-1]))
+    names = [i.name for i in read_image_catalog(path)]
+    assert names == [f'f{i + 1:05d}.png' for i in numbers]
@@ -0,0 +1,134 @@
+import cv2
+import numpy as np
+import pytest
+from tsutil.phase_correlation import (
+    BATCH_TOLERANCE,
+    TRACKING_TOLERANCE,
+    BatchPhaseCorrelator,
+    benchmark_phase_correlation,
+    estimate_rigid_transform_homography,
+    estimate_rigid_transforms,
+    phase_correlate_fields,
+)
+
+# NOTE: まとめて求めたずれと剛体変換が、1フレームずつ求めた結果(cv2.phaseCorrelate)と一致することを確認する
+# - 細かい模様の基準画像を、サブピクセルのずれと小さな回転で動かしたサンプル画像と比較する
+#   (強くぼかした模様では高い周波数の成分が小さく、cv2.phaseCorrelate自体がfloat32の丸め誤差で0.1ピクセル以上ずれる)
+
+# MARK: constants
+
+WIDTH, HEIGHT = 480, 360
+N_FRAMES = 20
+BATCH_SIZE = 8  # N_FRAMESの約数にしない (端数のバッチも確認する)
+FIELDS = [(30, 30, 131, 127), (340, 40, 441, 137), (40, 220, 141, 317), (330, 230, 431, 327)]
+
+# MARK: fixtures
+
+
+def _make_image(seed=1):
+    # 少しぼかしたノイズの模様 (BGR)
+    rng = np.random.default_rng(seed)
+    noise = rng.random((HEIGHT, WIDTH)).astype(np.float32)
+    gray = cv2.GaussianBlur(noise, (0, 0), 1)
+    gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+
+def _move(image, angle, dx, dy):
+    mat = cv2.getRotationMatrix2D((WIDTH / 2, HEIGHT / 2), angle, 1.0)
+    mat[:, 2] += (dx, dy)
+    return cv2.warpAffine(image, mat, (WIDTH, HEIGHT), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REFLECT)
+
+
+@pytest.fixture(scope='module')
+def images():
+    # (基準画像, サンプル画像のリスト)
+    base = _make_image()
+    rng = np.random.default_rng(2)
+    samples = [_move(base, rng.uniform(-0.5, 0.5), *rng.uniform(-6, 6, 2)) for _ in range(N_FRAMES)]
+    return base, samples
+
+
+def _gray(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+
+# MARK: tests
+
+
+def test_batch_matches_phase_correlate(images):
+    base, samples = images
+    gray_base = _gray(base)
+    expected = [phase_correlate_fields(gray_base, _gray(i), FIELDS) for i in samples]
+    correlator = BatchPhaseCorrelator(FIELDS, gray_base)
+    for start in range(0, N_FRAMES, BATCH_SIZE):
+        batch = samples[start : start + BATCH_SIZE]
+        shifts, responses = correlator.correlate([correlator.crop(i) for i in batch])
+        for k in range(len(batch)):
+            np.testing.assert_allclose(shifts[k], expected[start + k][0], atol=BATCH_TOLERANCE)
+            np.testing.assert_allclose(responses[k], expected[start + k][1], atol=0.01)
+
+
+def test_batch_estimate_matches_homography(images):
+    base, samples = images
+    gray_base = _gray(base)
+    correlator = BatchPhaseCorrelator(FIELDS, gray_base)
+    mats, angles, offsets, _ = correlator.estimate([correlator.crop(i) for i in samples])
+    for k, image in enumerate(samples):
+        shifts, _ = phase_correlate_fields(gray_base, _gray(image), FIELDS)
+        points = (correlator.base_points + shifts).astype(np.float32)
+        mat, angle, offset = estimate_rigid_transform_homography(points, correlator.base_points)
+        np.testing.assert_allclose(mats[k, :2, :2], mat[:2, :2], atol=1e-4)
+        np.testing.assert_allclose(angles[k], angle, atol=1e-3)
+        np.testing.assert_allclose(offsets[k], offset, atol=BATCH_TOLERANCE)
+
+
+def test_rigid_transforms_match_per_frame():
+    # まとめて求めた剛体変換が、1組ずつ求めた結果と一致し、既知の回転と平行移動を復元する
+    rng = np.random.default_rng(3)
+    base_points = rng.uniform(0, 400, (6, 2)).astype(np.float32)
+    moves = [(rng.uniform(-2, 2), *rng.uniform(-10, 10, 2)) for _ in range(5)]
+    sample_points = np.stack(
+        [
+            cv2.transform(base_points[np.newaxis], cv2.getRotationMatrix2D((0, 0), a, 1.0) + [[0, 0, dx], [0, 0, dy]])[
+                0
+            ]
+            for a, dx, dy in moves
+        ]
+    ).astype(np.float32)
+    mats, angles, offsets = estimate_rigid_transforms(sample_points, np.broadcast_to(base_points, sample_points.shape))
+    for k, (a, dx, dy) in enumerate(moves):
+        mat, angle, offset = estimate_rigid_transform_homography(sample_points[k], base_points)
+        np.testing.assert_allclose(mats[k], mat, atol=1e-5)
+        np.testing.assert_allclose(angles[k], angle, atol=1e-5)
+        np.testing.assert_allclose(offsets[k], offset, atol=1e-4)
+        # サンプルを基準に重ねる変換は、動かした変換の逆
+        np.testing.assert_allclose(angle, a, atol=1e-3)
+        inverse = cv2.invertAffineTransform(mat[:2])
+        np.testing.assert_allclose(inverse[:, 2], (dx, dy), atol=1e-2)
+
+
+def test_benchmark_fails_when_tolerance_exceeded(images):
+    base, samples = images
+    _, _, diff = benchmark_phase_correlation(base, samples, FIELDS, BATCH_SIZE)
+    assert diff <= BATCH_TOLERANCE
+    with pytest.raises(RuntimeError):
+        benchmark_phase_correlation(base, samples, FIELDS, BATCH_SIZE, tracking_size=32, tolerance=0.0)
+
+
+def test_tracking_follows_previous_frame():
+    # 手ブレのように連続して動く場合は、まとめたフレームの中でも直前のフレームのずれの近くを探す
+    # (最後のフレームのずれから予測すると、まとめたフレームの後ろほど予測が外れる)
+    base = _make_image()
+    samples = [_move(base, 0.0, 10 * np.sin(np.pi * k / 6), 8 * np.cos(np.pi * k / 6)) for k in range(48)]
+    gray_base = _gray(base)
+    full = BatchPhaseCorrelator(FIELDS, gray_base)
+    expected, _ = full.correlate([full.crop(i) for i in samples])
+    correlator = BatchPhaseCorrelator(FIELDS, gray_base, tracking_size=32)
+    shifts = np.concatenate(
+        [correlator.correlate([correlator.crop(i) for i in samples[s : s + 16]])[0] for s in range(0, 48, 16)]
+    )
+    # 呼び出しごとの最初のフレームは、測定枠の全体で求める
+    assert correlator.tracked_count == (len(samples) - 3) * len(FIELDS)
+    assert correlator.lost_count == 0
+    assert np.abs(shifts - expected).max() <= TRACKING_TOLERANCE
@@ -0,0 +1,103 @@
+import os
+import pytest
+from tsutil.transform_table import (
+    TransformTable,
+    get_table_file_path,
+    load_transform_table,
+    make_table_key,
+    save_transform_table,
+)
+
+# NOTE: 保存したずれの表は、カタログファイル・連続画像・ずれを変える設定のどれかが変わった場合に使わないことを確認する
+
+# MARK: constants
+
+N_FRAMES = 3
+PARAMS = dict(fields=[[(10, 10, 60, 60)]], field_set_table='0', base_frame_pos=0, pyramid=(0, 128), tracking=None)
+
+# MARK: fixtures
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    # (カタログファイル, 連続画像のファイル)
+    entries = []
+    for i in range(N_FRAMES):
+        path = tmp_path / f'f{i + 1:05d}.png'
+        path.write_bytes(b'png' * (i + 1))
+        entries.append(path)
+    catalog_path = tmp_path / 'catalog.txt'
+    catalog_path.write_text(''.join(f'{i.name}\n' for i in entries))
+    return catalog_path, entries
+
+
+def _save(catalog_path, entries, **params):
+    key = make_table_key(catalog_path, entries, **(PARAMS | params))
+    n = N_FRAMES
+    save_transform_table(
+        catalog_path, TransformTable(key=key, dx=[1.0] * n, dy=[2.0] * n, angle=[0.5] * n, response=[0.9] * n)
+    )
+    return key
+
+
+def _touch(path):
+    # 内容を変えずに更新日時だけを進める
+    st = path.stat()
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+
+# MARK: tests
+
+
+def test_load_same_key(catalog):
+    catalog_path, entries = catalog
+    key = _save(catalog_path, entries)
+    assert get_table_file_path(catalog_path).name == 'catalog.correct.transforms.json'
+    table = load_transform_table(catalog_path, make_table_key(catalog_path, entries, **PARAMS), N_FRAMES)
+    assert table is not None
+    assert table.key == key
+    assert table.dx == [1.0] * N_FRAMES
+
+
+@pytest.mark.parametrize(
+    'params',
+    [
+        dict(fields=[[(10, 10, 60, 61)]]),
+        dict(field_set_table='1'),
+        dict(base_frame_pos=1),
+        dict(pyramid=(2, 128)),
+        dict(tracking=(128, 0.3)),
+    ],
+)
+def test_ignore_when_settings_change(catalog, params):
+    catalog_path, entries = catalog
+    _save(catalog_path, entries)
+    key = make_table_key(catalog_path, entries, **(PARAMS | params))
+    assert load_transform_table(catalog_path, key, N_FRAMES) is None
+
+
+def test_ignore_when_catalog_changes(catalog):
+    catalog_path, entries = catalog
+    _save(catalog_path, entries)
+    _touch(catalog_path)
+    assert load_transform_table(catalog_path, make_table_key(catalog_path, entries, **PARAMS), N_FRAMES) is None
+
+
+def test_ignore_when_image_changes(catalog):
+    catalog_path, entries = catalog
+    _save(catalog_path, entries)
+    entries[1].write_bytes(b'changed')
+    assert load_transform_table(catalog_path, make_table_key(catalog_path, entries, **PARAMS), N_FRAMES) is None
+
+
+def test_ignore_when_frame_count_changes(catalog):
+    catalog_path, entries = catalog
+    key = _save(catalog_path, entries)
+    assert load_transform_table(catalog_path, key, N_FRAMES + 1) is None
+
+
+def test_ignore_broken_table(catalog):
+    catalog_path, entries = catalog
+    key = _save(catalog_path, entries)
+    get_table_file_path(catalog_path).write_text('{')
+    assert load_transform_table(catalog_path, key, N_FRAMES) is None
@@ -0,0 +1,124 @@
+import subprocess
+from pathlib import Path
+import numpy as np
+import pytest
+from conftest import frame_number, make_gray_clip, requires_ffmpeg, run_ffmpeg
+from tsutil.extraction import read_frames
+from tsutil.packet_index import PacketIndex, get_index_file_path, load_joined_packet_index, probe_packets
+from tsutil.trimming import TrimPiece, plan_smart_cut, trim_video
+
+# NOTE: 分割された動画を結合して切り出したときに、つなぎ目でフレームの間隔がずれないことを確認する
+# - スマートカットで切り出した動画が、指定したフレームで始まり指定したフレームで終わることを確認する
+
+# MARK: constants
+
+FPS = 10
+N_FRAMES = 10  # 1ファイルのフレーム数
+GRAY_FRAMES = 36
+KEYFRAME_INTERVAL = 8
+
+# MARK: fixtures
+
+
+@pytest.fixture(scope='module')
+def split_clips(tmp_path_factory):
+    # 音声付きで分割して録画した動画 (N_FRAMESフレームずつ)
+    tmp = tmp_path_factory.mktemp('clips')
+    paths = []
+    for i in range(2):
+        path = tmp / f'part{i}.mp4'
+        args = ['-f', 'lavfi', '-i', f'testsrc2=size=64x48:rate={FPS}']
+        args += ['-f', 'lavfi', '-i', f'sine=frequency={440 * (i + 1)}:sample_rate=48000']
+        args += ['-frames:v', str(N_FRAMES), '-t', str(N_FRAMES / FPS), '-c:v', 'libx264', '-g', '5']
+        args += ['-pix_fmt', 'yuv420p', '-c:a', 'aac', str(path)]
+        run_ffmpeg(args)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture(scope='module')
+def gray_clip(tmp_path_factory):
+    return make_gray_clip(tmp_path_factory.mktemp('clips') / 'gray.mp4', GRAY_FRAMES, KEYFRAME_INTERVAL)
+
+
+def _probe_stream_duration(path, stream):
+    args = ['ffprobe', '-v', 'error', '-select_streams', stream, '-show_entries', 'stream=duration', '-of', 'csv=p=0']
+    return float(subprocess.run(args + [str(path)], capture_output=True, text=True, check=True).stdout)
+
+
+# MARK: tests
+
+
+def test_duration_includes_last_frame():
+    # 最後のフレームも1フレーム分の長さを持つ
+    assert PacketIndex(pts=[0.0, 0.1, 0.2]).duration == pytest.approx(0.3)
+    assert PacketIndex(pts=[0.0]).duration == 0.0
+    assert PacketIndex().duration == 0.0
+
+
+def test_index_file_path_keeps_extension():
+    # 拡張子だけが違う動画ファイルの索引は別のファイルにする
+    assert get_index_file_path(Path('clip.mp4')).name == 'clip.mp4.index.json'
+    assert get_index_file_path(Path('clip.mp4')) != get_index_file_path(Path('clip.mov'))
+
+
+@requires_ffmpeg
+def test_joined_packet_index(split_clips):
+    index = load_joined_packet_index(split_clips)
+    assert index.n_frames == N_FRAMES * 2
+    assert np.allclose(np.diff(index.pts), 1 / FPS, atol=1e-3)
+
+
+@requires_ffmpeg
+def test_join_has_no_gap_or_overlap(tmp_path, split_clips):
+    output_path = tmp_path / 'joined.mp4'
+    trim_video(split_clips, output_path)
+    index = probe_packets(output_path)
+    assert index.n_frames == N_FRAMES * 2
+    assert np.allclose(np.diff(index.pts), 1 / FPS, atol=1e-3)
+    # 音声も各ファイルの長さの合計 (つなぎ目で重ならない)
+    assert _probe_stream_duration(output_path, 'a:0') == pytest.approx(N_FRAMES * 2 / FPS, abs=0.05)
+
+
+def _pieces(*pieces):
+    return [TrimPiece(start=start, end=end, stream_copy=copy) for start, end, copy in pieces]
+
+
+@pytest.mark.parametrize(
+    'start, end, expected',
+    [
+        # 先頭と末尾のキーフレームに満たない部分だけを再エンコードする
+        (3, 30, _pieces((3, 8, False), (8, 24, True), (24, 30, False))),
+        # 両端がキーフレームの場合は全体を-c copyで切り出す
+        (8, 24, _pieces((8, 24, True))),
+        # 末尾が動画の最後の場合は、最後のキーフレーム以降も-c copyで切り出せる
+        (20, 100, _pieces((20, 24, False), (24, 36, True))),
+        # キーフレームからキーフレームまでの区間を含まない場合は全体を再エンコードする
+        (10, 14, _pieces((10, 14, False))),
+        (3, 12, _pieces((3, 12, False))),
+        (30, 20, []),
+    ],
+)
+def test_plan_smart_cut(start, end, expected):
+    index = PacketIndex(
+        pts=[i / 30 for i in range(GRAY_FRAMES)], keyframes=list(range(0, GRAY_FRAMES, KEYFRAME_INTERVAL))
+    )
+    assert plan_smart_cut(index, start, end) == expected
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize('start, end', [(3, 30), (8, 24), (10, 14), (20, GRAY_FRAMES)])
+def test_smart_cut_starts_and_ends_on_requested_frames(tmp_path, gray_clip, start, end):
+    output_path = tmp_path / 'trimmed.mp4'
+    trim_video(gray_clip, output_path, start, end, smart_cut=True)
+    numbers = [frame_number(frame) for _, frame in read_frames(output_path)]
+    assert numbers == list(range(start, end))
+
+
+@requires_ffmpeg
+def test_stream_copy_starts_at_keyframe(tmp_path, gray_clip):
+    # スマートカットを使わない場合は、開始位置の直前のキーフレームから切り出す (キーフレームも表示される)
+    output_path = tmp_path / 'trimmed.mp4'
+    trim_video(gray_clip, output_path, 9, 24)
+    numbers = [frame_number(frame) for _, frame in read_frames(output_path)]
+    assert numbers == list(range(8, 24))